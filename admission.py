@@ -0,0 +1,329 @@
+"""
+Admission control for the Flask app (init_app) and the ASGI app
+(AdmissionMiddleware).
+
+Caps the requests a worker process handles at once (ADMISSION_MAX_CONCURRENT)
+so that a burst of webhook deliveries is answered quickly with 503/429 and a
+Retry-After header instead of piling up until the gunicorn timeout.
+Requests over the limit wait in a bounded queue (ADMISSION_MAX_QUEUE) for up
+to ADMISSION_MAX_WAIT_MS; a request whose estimated wait already exceeds
+that is rejected straight away. POST requests (webhooks, flows, user writes)
+are served first; GET requests may only use ADMISSION_LOW_PRIORITY_SHARE of
+the slots and never overtake a waiting POST.
+
+With ADMISSION_MAX_QUEUE_TIME_MS set, requests that already spent that long
+in a proxy or gunicorn backlog (per the X-Request-Start header) are rejected
+before any work is done, since the sender has likely given up on them.
+"""
+
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import metrics
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', '0'))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '100'))
+ADMISSION_MAX_WAIT_MS = int(os.getenv('ADMISSION_MAX_WAIT_MS', '2000'))
+ADMISSION_LOW_PRIORITY_SHARE = float(os.getenv('ADMISSION_LOW_PRIORITY_SHARE', '0.5'))
+ADMISSION_MAX_QUEUE_TIME_MS = int(os.getenv('ADMISSION_MAX_QUEUE_TIME_MS', '0'))
+
+PRIORITIES = ('high', 'low')
+
+
+class AdmissionController:
+    """Per-process concurrency limit with a bounded, priority-ordered wait queue"""
+
+    def __init__(self, max_concurrent: int, max_queue: int = 100, max_wait: float = 2.0,
+                 low_priority_share: float = 0.5):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.low_priority_limit = max(1, int(max_concurrent * low_priority_share))
+
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.avg_service_time = 0.0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrent > 0
+
+    def _can_run(self, priority: str) -> bool:
+        if priority == 'high':
+            return self.active < self.max_concurrent
+        return self.active < self.low_priority_limit and self.waiting['high'] == 0
+
+    def estimated_wait(self) -> float:
+        """Seconds a request joining the queue now is expected to wait"""
+        queued = sum(self.waiting.values()) + 1
+        return self.avg_service_time * queued / self.max_concurrent
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.estimated_wait()))
+
+    def _reject(self, reason: str) -> Tuple[str, int]:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return reason, self.retry_after()
+
+    def acquire(self, priority: str) -> Optional[Tuple[str, int]]:
+        """Take a slot, waiting if needed. Returns None once admitted, else (reason, retry_after)."""
+        with self._cond:
+            if not self._can_run(priority):
+                rejected = self._check_queue()
+                if rejected:
+                    return rejected
+
+                deadline = time.monotonic() + self.max_wait
+                self.waiting[priority] += 1
+                try:
+                    while not self._can_run(priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._reject('timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting[priority] -= 1
+                    # A high priority waiter leaving may unblock low priority ones
+                    self._cond.notify_all()
+
+            self._admit()
+            return None
+
+    def _check_queue(self) -> Optional[Tuple[str, int]]:
+        """Reject a request that can't run now if the queue is full or too slow"""
+        if sum(self.waiting.values()) >= self.max_queue:
+            return self._reject('queue_full')
+        if self.estimated_wait() > self.max_wait:
+            return self._reject('deadline')
+        return None
+
+    def _admit(self) -> None:
+        self.active += 1
+        self.admitted += 1
+
+    def _finish(self, seconds: float) -> None:
+        self.active -= 1
+        if self.avg_service_time:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * seconds
+        else:
+            self.avg_service_time = seconds
+
+    def release(self, seconds: float) -> None:
+        """Free a slot and fold the request's duration into the service time estimate"""
+        with self._cond:
+            self._finish(seconds)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'enabled': self.enabled,
+                'max_concurrent': self.max_concurrent,
+                'low_priority_limit': self.low_priority_limit,
+                'active': self.active,
+                'waiting': dict(self.waiting),
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'avg_service_ms': round(self.avg_service_time * 1000, 2),
+            }
+
+
+class AsyncAdmissionController(AdmissionController):
+    """AdmissionController for an event loop: waiters await an asyncio.Condition instead of blocking"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._async_cond: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        # Created on first use so it binds to the server's running loop
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        return self._async_cond
+
+    async def acquire(self, priority: str) -> Optional[Tuple[str, int]]:
+        cond = self._condition()
+        async with cond:
+            if not self._can_run(priority):
+                rejected = self._check_queue()
+                if rejected:
+                    return rejected
+
+                deadline = time.monotonic() + self.max_wait
+                self.waiting[priority] += 1
+                try:
+                    while not self._can_run(priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return self._reject('timeout')
+                        try:
+                            await asyncio.wait_for(cond.wait(), remaining)
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self.waiting[priority] -= 1
+                    cond.notify_all()
+
+            self._admit()
+            return None
+
+    async def release(self, seconds: float) -> None:
+        cond = self._condition()
+        async with cond:
+            self._finish(seconds)
+            cond.notify_all()
+
+
+def queue_time(header: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """Seconds since the X-Request-Start time (t=<seconds|ms|us>), or None if absent/invalid"""
+    if not header:
+        return None
+    try:
+        started = float(header.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, (now if now is not None else time.time()) - started)
+
+
+controller = AdmissionController(
+    ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT_MS / 1000.0,
+    low_priority_share=ADMISSION_LOW_PRIORITY_SHARE
+)
+
+
+async_controller = AsyncAdmissionController(
+    ADMISSION_MAX_CONCURRENT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_wait=ADMISSION_MAX_WAIT_MS / 1000.0,
+    low_priority_share=ADMISSION_LOW_PRIORITY_SHARE
+)
+
+
+def init_app(app, exempt_endpoints: Iterable[str] = (), read_endpoints: Iterable[str] = ()) -> None:
+    """Register hooks that admit or reject each request.
+
+    Endpoints in exempt_endpoints always run; POST endpoints in read_endpoints
+    only read data and get GET (low) priority.
+    """
+    if not controller.enabled and ADMISSION_MAX_QUEUE_TIME_MS <= 0:
+        return
+
+    from flask import g, jsonify, request
+
+    exempt = set(exempt_endpoints)
+    reads = set(read_endpoints)
+
+    def busy_response(priority: str, reason: str, retry_after: int):
+        metrics.observe_admission_rejected(priority, reason)
+        response = jsonify({
+            'status': 'error',
+            'message': 'Server is busy, retry later'
+        })
+        # 429 asks a read client to slow down; 503 tells the webhook sender to redeliver later
+        response.status_code = 503 if priority == 'high' else 429
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint in exempt:
+            return None
+        priority = 'high' if request.method == 'POST' and request.endpoint not in reads else 'low'
+
+        if ADMISSION_MAX_QUEUE_TIME_MS > 0:
+            waited = queue_time(request.headers.get('X-Request-Start'))
+            if waited is not None and waited * 1000 > ADMISSION_MAX_QUEUE_TIME_MS:
+                return busy_response(priority, 'queue_time', controller.retry_after() if controller.enabled else 1)
+
+        if not controller.enabled:
+            return None
+        rejected = controller.acquire(priority)
+        if rejected:
+            return busy_response(priority, *rejected)
+        g.admission_started = time.perf_counter()
+        return None
+
+    @app.after_request
+    def hold_slot_while_streaming(response):
+        # Teardown runs before a streamed body is produced, so the stream releases on close
+        if response.is_streamed and 'admission_started' in g:
+            started = g.pop('admission_started')
+            response.call_on_close(lambda: controller.release(time.perf_counter() - started))
+        return response
+
+    @app.teardown_request
+    def release_request(exc):
+        started = g.pop('admission_started', None)
+        if started is not None:
+            controller.release(time.perf_counter() - started)
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying the same limits as init_app.
+
+    Paths in exempt_paths always run; POST paths in read_paths get GET (low)
+    priority. The slot is held until the response body has been sent, so an
+    open stream counts against the limit.
+    """
+
+    def __init__(self, app, exempt_paths: Iterable[str] = (), read_paths: Iterable[str] = (),
+                 controller: Optional[AsyncAdmissionController] = None):
+        self.app = app
+        self.exempt = set(exempt_paths)
+        self.reads = set(read_paths)
+        self.controller = controller or async_controller
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.exempt or (
+                not self.controller.enabled and ADMISSION_MAX_QUEUE_TIME_MS <= 0):
+            await self.app(scope, receive, send)
+            return
+        priority = 'high' if scope['method'] == 'POST' and scope['path'] not in self.reads else 'low'
+
+        if ADMISSION_MAX_QUEUE_TIME_MS > 0:
+            from starlette.datastructures import Headers
+
+            waited = queue_time(Headers(scope=scope).get('x-request-start'))
+            if waited is not None and waited * 1000 > ADMISSION_MAX_QUEUE_TIME_MS:
+                retry_after = self.controller.retry_after() if self.controller.enabled else 1
+                await self.busy_response(send, priority, 'queue_time', retry_after)
+                return
+
+        if not self.controller.enabled:
+            await self.app(scope, receive, send)
+            return
+        rejected = await self.controller.acquire(priority)
+        if rejected:
+            await self.busy_response(send, priority, *rejected)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.controller.release(time.perf_counter() - started)
+
+    @staticmethod
+    async def busy_response(send, priority: str, reason: str, retry_after: int) -> None:
+        metrics.observe_admission_rejected(priority, reason)
+        body = json.dumps({'status': 'error', 'message': 'Server is busy, retry later'}).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': 503 if priority == 'high' else 429,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                        (b'retry-after', str(retry_after).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': body})
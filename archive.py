@@ -0,0 +1,385 @@
+"""
+Cold storage for old messages.
+
+compact_messages.py moves messages older than ARCHIVE_AFTER_DAYS out of the
+messages table into gzip-compressed JSON Lines files, one per UTC day of the
+message timestamp:
+
+    <ARCHIVE_DIR>/manifest.json         id and timestamp range of every day
+    <ARCHIVE_DIR>/2026-01-05.jsonl.gz   blocks of rows, each its own gzip member
+    <ARCHIVE_DIR>/2026-01-05.idx        one JSON line per block: offset, length,
+                                        rows and id/timestamp range
+
+A lookup by id only decompresses the blocks whose id range covers it, and a
+listing only reads the days its time range and cursor reach. Files are only
+ever appended to, and a block is indexed (and its rows deleted from the
+database, when compaction deletes) only after its data is fsynced, so readers
+never see half a block.
+
+The archive is a plain directory. Rows are only deleted from a remote
+database (Supabase) when ARCHIVE_SHARED says ARCHIVE_DIR is durable storage
+that every server reads; otherwise compaction copies rows and keeps them.
+
+/messages and /messages/<id> read the database first and fall through to the
+archive: get() for ids the database doesn't have, merge() for pages (limit
+or cursor) and since/until ranges whose rows may continue into archived
+days. An unbounded listing only reads the table.
+"""
+
+import fcntl
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import serialization
+from cache import LRUCache
+from storage.base import MESSAGE_FILTER_COLUMNS
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+# Set to true only when ARCHIVE_DIR is durable storage mounted on every server
+# (e.g. a network volume); required to delete archived rows from Supabase
+ARCHIVE_SHARED = os.getenv('ARCHIVE_SHARED', 'false').lower() == 'true'
+# Rows per gzip block: the unit decompressed to serve one archived message
+ARCHIVE_BLOCK_ROWS = int(os.getenv('ARCHIVE_BLOCK_ROWS', '500'))
+ARCHIVE_COMPRESS_LEVEL = int(os.getenv('ARCHIVE_COMPRESS_LEVEL', '6'))
+# Decompressed blocks kept in memory for repeated reads
+ARCHIVE_BLOCK_CACHE_SIZE = int(os.getenv('ARCHIVE_BLOCK_CACHE_SIZE', '64'))
+
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = '.lock'
+DATA_SUFFIX = '.jsonl.gz'
+INDEX_SUFFIX = '.idx'
+OLDEST = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def parse_timestamp(value: Any) -> datetime:
+    """A stored timestamp as an aware datetime (naive values are UTC); unparseable values sort oldest"""
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except ValueError:
+            try:
+                parsed = datetime.fromtimestamp(float(value), timezone.utc)
+            except (TypeError, ValueError, OverflowError):
+                return OLDEST
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def row_key(row: dict) -> Tuple[datetime, int]:
+    """Sort key of the /messages order (newest first when reversed)"""
+    return parse_timestamp(row.get('timestamp')), int(row.get('id') or 0)
+
+
+def day_of(row: dict) -> str:
+    return parse_timestamp(row.get('timestamp')).date().isoformat()
+
+
+def fsync_dir(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MessageArchive:
+    """Day-partitioned, block-compressed message archive under one directory"""
+
+    def __init__(self, root: str, block_rows: int = 500, compress_level: int = 6,
+                 block_cache_size: int = 64):
+        self.root = root
+        self.block_rows = max(1, block_rows)
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._manifest: Dict[str, dict] = {}
+        self._manifest_stamp: Optional[Tuple[int, int]] = None
+        self._indexes: Dict[str, Tuple[Tuple[int, int], List[dict]]] = {}
+        self._blocks = LRUCache(max_size=block_cache_size, ttl=3600.0)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    # Metadata
+
+    def days(self) -> Dict[str, dict]:
+        """The manifest: {day: {rows, min_id, max_id, min_ts, max_ts}}, re-read when the file changes"""
+        try:
+            st = os.stat(self.path(MANIFEST_FILE))
+        except OSError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if stamp != self._manifest_stamp:
+                with open(self.path(MANIFEST_FILE)) as f:
+                    self._manifest = json.load(f)['days']
+                self._manifest_stamp = stamp
+            return self._manifest
+
+    def _write_manifest(self, days: Dict[str, dict]) -> None:
+        path = self.path(MANIFEST_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'days': days}, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        fsync_dir(self.root)
+
+    def blocks(self, day: str) -> List[dict]:
+        """Index entries of a day's blocks; a line cut short by a crash is ignored"""
+        path = self.path(day + INDEX_SUFFIX)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._indexes.get(day)
+            if cached and cached[0] == stamp:
+                return cached[1]
+        entries = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+        with self._lock:
+            self._indexes[day] = (stamp, entries)
+        return entries
+
+    def last_key(self) -> Optional[Tuple[str, int]]:
+        """(timestamp, id) of the newest archived row as stored, or None if the archive is empty"""
+        days = self.days()
+        if not days:
+            return None
+        latest = days[max(days)]
+        return latest['max_ts'], latest['max_id']
+
+    def newest(self) -> Optional[Tuple[datetime, int]]:
+        """Sort key of the newest archived row, or None if the archive is empty"""
+        days = self.days()
+        if not days:
+            return None
+        latest = days[max(days)]
+        return parse_timestamp(latest['max_ts']), latest['max_id']
+
+    # Reading
+
+    def read_block(self, day: str, block: dict) -> List[dict]:
+        key = (day, block['offset'])
+        found, data = self._blocks.get(key)
+        if not found:
+            with open(self.path(day + DATA_SUFFIX), 'rb') as f:
+                f.seek(block['offset'])
+                data = gzip.decompress(f.read(block['length']))
+            self._blocks.set(key, data)
+        return [serialization.loads(line) for line in data.splitlines() if line]
+
+    def get(self, message_id: int) -> Optional[dict]:
+        """One archived message row by id"""
+        for day, info in self.days().items():
+            if not info['min_id'] <= message_id <= info['max_id']:
+                continue
+            for block in self.blocks(day):
+                if block['min_id'] <= message_id <= block['max_id']:
+                    for row in self.read_block(day, block):
+                        if row.get('id') == message_id:
+                            return row
+        return None
+
+    def _day_rows(self, day: str, since: Optional[datetime], until: Optional[datetime],
+                  after: Optional[Tuple[datetime, int]]) -> Iterator[dict]:
+        for block in self.blocks(day):
+            if since and parse_timestamp(block['max_ts']) < since:
+                continue
+            if until and parse_timestamp(block['min_ts']) >= until:
+                continue
+            if after and (parse_timestamp(block['min_ts']), block['min_id']) >= after:
+                continue
+            yield from self.read_block(day, block)
+
+    def list(self, limit: Optional[int] = None, after: Optional[Sequence[Any]] = None,
+             filters: Optional[Dict[str, str]] = None,
+             columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Archived messages in /messages order (newest first by timestamp, id) after a keyset cursor.
+
+        Takes the same filters and columns as StorageBackend.list_messages.
+        """
+        filters = filters or {}
+        since = parse_timestamp(filters['since']) if filters.get('since') else None
+        until = parse_timestamp(filters['until']) if filters.get('until') else None
+        cursor = (parse_timestamp(after[0]), int(after[1])) if after else None
+        exact = [(column, filters[column]) for column in MESSAGE_FILTER_COLUMNS if filters.get(column)]
+
+        rows: List[dict] = []
+        days = self.days()
+        # Days don't overlap in time, so the newest days fill the page first
+        for day in sorted(days, reverse=True):
+            info = days[day]
+            if since and parse_timestamp(info['max_ts']) < since:
+                break
+            if until and parse_timestamp(info['min_ts']) >= until:
+                continue
+            if cursor and (parse_timestamp(info['min_ts']), info['min_id']) >= cursor:
+                continue
+            matched = []
+            for row in self._day_rows(day, since, until, cursor):
+                key = row_key(row)
+                if since and key[0] < since or until and key[0] >= until or cursor and key >= cursor:
+                    continue
+                if any(row.get(column) != value for column, value in exact):
+                    continue
+                matched.append((key, row))
+            matched.sort(key=lambda item: item[0], reverse=True)
+            rows.extend(row for _, row in matched)
+            if limit is not None and len(rows) >= limit:
+                break
+
+        rows = rows[:limit] if limit is not None else rows
+        if columns:
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+    def merge(self, rows: List[dict], limit: Optional[int] = None, after: Optional[Sequence[Any]] = None,
+              filters: Optional[Dict[str, str]] = None,
+              columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Complete a page of database rows with archived rows that belong in it.
+
+        rows must be what list_messages returned for the same arguments (with
+        id and timestamp selected). A full page whose last row is newer than
+        anything archived, or a listing with no limit, cursor or time range,
+        is returned as is, without touching the archive.
+        """
+        filters = filters or {}
+        if limit is None and not after and not filters.get('since') and not filters.get('until'):
+            return rows
+        newest = self.newest()
+        if newest is None:
+            return rows
+        if limit is not None and len(rows) >= limit and row_key(rows[-1]) > newest:
+            return rows
+        if filters.get('since') and parse_timestamp(filters['since']) > newest[0]:
+            return rows
+
+        archived = self.list(limit, after, filters, columns)
+        if not archived:
+            return rows
+        # A row still in the database after being archived (compaction
+        # interrupted before its delete) is listed once
+        ids = {row.get('id') for row in rows}
+        merged = rows + [row for row in archived if row.get('id') not in ids]
+        merged.sort(key=row_key, reverse=True)
+        return merged[:limit] if limit is not None else merged
+
+    # Writing (compaction)
+
+    def lock(self) -> Optional[int]:
+        """Take the compaction lock; returns its fd, or None if another compaction holds it"""
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(self.path(LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def archived_ids(self, day: str, low: int, high: int) -> Set[int]:
+        """Ids already archived for a day within [low, high]"""
+        ids: Set[int] = set()
+        for block in self.blocks(day):
+            if block['max_id'] >= low and block['min_id'] <= high:
+                ids.update(row['id'] for row in self.read_block(day, block))
+        return ids
+
+    def write(self, rows: List[dict]) -> int:
+        """Append full message rows to their days' files and index them durably.
+
+        Rows that are already archived (a batch retried after a crash) are
+        skipped. Returns the number of rows written. Call with the lock held.
+        """
+        by_day: Dict[str, List[dict]] = {}
+        for row in rows:
+            by_day.setdefault(day_of(row), []).append(row)
+
+        days = dict(self.days())
+        written = 0
+        for day, day_rows in sorted(by_day.items()):
+            ids = [row['id'] for row in day_rows]
+            existing = self.archived_ids(day, min(ids), max(ids)) if day in days else set()
+            day_rows = sorted((row for row in day_rows if row['id'] not in existing), key=row_key)
+            if not day_rows:
+                continue
+
+            entries = []
+            with open(self.path(day + DATA_SUFFIX), 'ab') as f:
+                offset = f.tell()
+                for start in range(0, len(day_rows), self.block_rows):
+                    block = day_rows[start:start + self.block_rows]
+                    data = b''.join(serialization.dumps_bytes(row) + b'\n' for row in block)
+                    compressed = gzip.compress(data, compresslevel=self.compress_level, mtime=0)
+                    f.write(compressed)
+                    keys = [row_key(row) for row in block]
+                    entries.append({
+                        'offset': offset,
+                        'length': len(compressed),
+                        'rows': len(block),
+                        'min_id': min(row['id'] for row in block),
+                        'max_id': max(row['id'] for row in block),
+                        'min_ts': block[keys.index(min(keys))]['timestamp'],
+                        'max_ts': block[keys.index(max(keys))]['timestamp'],
+                    })
+                    offset += len(compressed)
+                f.flush()
+                os.fsync(f.fileno())
+
+            with open(self.path(day + INDEX_SUFFIX), 'a') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            info = dict(days[day]) if day in days else None
+            first = min(entries, key=lambda e: (parse_timestamp(e['min_ts']), e['min_id']))
+            last = max(entries, key=lambda e: (parse_timestamp(e['max_ts']), e['max_id']))
+            if info is None:
+                info = {'rows': 0, 'min_id': first['min_id'], 'max_id': last['max_id'],
+                        'min_ts': first['min_ts'], 'max_ts': last['max_ts']}
+            if (parse_timestamp(first['min_ts']), first['min_id']) < (parse_timestamp(info['min_ts']), info['min_id']):
+                info['min_ts'] = first['min_ts']
+            if (parse_timestamp(last['max_ts']), last['max_id']) > (parse_timestamp(info['max_ts']), info['max_id']):
+                info['max_ts'] = last['max_ts']
+            info['min_id'] = min(info['min_id'], min(e['min_id'] for e in entries))
+            info['max_id'] = max(info['max_id'], max(e['max_id'] for e in entries))
+            info['rows'] += len(day_rows)
+            days[day] = info
+            written += len(day_rows)
+
+        if written:
+            self._write_manifest(days)
+        return written
+
+    def stats(self) -> Dict[str, Any]:
+        days = self.days()
+        size = 0
+        for day in days:
+            try:
+                size += os.path.getsize(self.path(day + DATA_SUFFIX))
+            except OSError:
+                pass
+        return {
+            'directory': self.root,
+            'days': len(days),
+            'rows': sum(info['rows'] for info in days.values()),
+            'bytes': size,
+            'oldest_day': min(days) if days else None,
+            'newest_day': max(days) if days else None,
+            'block_cache': self._blocks.stats(),
+        }
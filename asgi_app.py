@@ -0,0 +1,773 @@
+"""
+ASGI entry point for the WhatsApp Flow API.
+
+Serves the routes of app.py (except /debug) on an async server, so a single process can
+keep hundreds of webhook deliveries in flight while they wait on the
+database. With the Supabase backend all requests share one pooled
+keep-alive httpx.AsyncClient; with SQLite, calls run in worker threads.
+
+Row building, decoding, cursors and caches are shared with the WSGI app in
+app.py, which keeps working unchanged for existing deployments. Request
+metrics, admission control and brotli/gzip compression follow the same
+settings as the Flask app, through the ASGI middleware in metrics.py,
+admission.py and compression.py.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse as StarletteJSONResponse
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import admission
+import app as wsgi
+import compression
+import metrics
+import resilience
+import serialization
+from storage import OPERATION_NAMES
+from storage.async_backend import AsyncSupabaseStorage, ThreadedAsyncStorage
+
+# Size of the shared PostgREST connection pool
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', '100'))
+ASYNC_MAX_KEEPALIVE = int(os.getenv('ASYNC_MAX_KEEPALIVE', '100'))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', '10'))
+
+if wsgi.STORAGE_BACKEND == 'supabase':
+    # Same timeouts, read retries and circuit breaker as the WSGI app's backend
+    storage = resilience.ResilientStorage(AsyncSupabaseStorage(
+        wsgi.SUPABASE_URL, wsgi.SUPABASE_KEY,
+        max_connections=ASYNC_MAX_CONNECTIONS,
+        max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        timeout=ASYNC_HTTP_TIMEOUT
+    ), OPERATION_NAMES)
+else:
+    # Already wrapped by resilience.ResilientStorage in app.py
+    storage = ThreadedAsyncStorage(wsgi.get_storage())
+
+
+class JSONResponse(StarletteJSONResponse):
+    """JSON response encoded with the shared (orjson when available) serializer"""
+
+    def render(self, content: Any) -> bytes:
+        return serialization.dumps_bytes(content)
+
+
+def error(message: str, status: int) -> JSONResponse:
+    retry_after = resilience.rejected_retry_after() if status == 500 else None
+    if retry_after is not None:
+        # The circuit breaker turned the call away: ask the client to come back later
+        return JSONResponse({'status': 'error', 'message': message}, status_code=503,
+                            headers={'Retry-After': str(retry_after)})
+    return JSONResponse({'status': 'error', 'message': message}, status_code=status)
+
+
+def server_error(request: Request, e: Exception) -> JSONResponse:
+    """500 (or circuit breaker 503) response for an unexpected error, counted on /metrics"""
+    metrics.observe_exception(metrics.asgi_route_label(request.scope), e)
+    return error(str(e), 500)
+
+
+async def read_json(request: Request) -> Any:
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def parse_page_args(request: Request) -> Tuple[int, Optional[list]]:
+    """Read and validate the limit/after query parameters"""
+    try:
+        limit = int(request.query_params.get('limit', wsgi.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    if limit < 1 or limit > wsgi.MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {wsgi.MAX_PAGE_SIZE}')
+    after = request.query_params.get('after')
+    return limit, wsgi.decode_cursor(after) if after else None
+
+
+def wants_ndjson(request: Request) -> bool:
+    if request.query_params.get('format') == 'ndjson':
+        return True
+    return 'application/x-ndjson' in request.headers.get('accept', '')
+
+
+def ndjson_response(rows: AsyncIterator[dict]) -> StreamingResponse:
+    async def generate():
+        try:
+            async for row in rows:
+                yield serialization.dumps(row) + '\n'
+        except Exception as e:
+            print(f"❌ Streaming response aborted: {e}")
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+
+def json_array_response(rows: AsyncIterator[dict], key: str) -> StreamingResponse:
+    """Stream rows as a chunked JSON document of the form {"status": ..., key: [...]}"""
+    async def generate():
+        yield '{"status": "success", "%s": [' % key
+        try:
+            first = True
+            async for row in rows:
+                yield ('' if first else ',') + serialization.dumps(row)
+                first = False
+        except Exception as e:
+            print(f"❌ Streaming response aborted: {e}")
+        yield ']}'
+
+    return StreamingResponse(generate(), media_type='application/json')
+
+
+# ============================================================================
+# DATA FUNCTIONS
+# ============================================================================
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of an ETag against If-None-Match"""
+    tags = [t.strip().removeprefix('W/') for t in request.headers.get('if-none-match', '').split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+
+async def conditional_list(request: Request, load_version) -> Tuple[Optional[str], Optional[Response]]:
+    """Weak ETag of a list request, and a 304 response if the client already has it"""
+    if not wsgi.LIST_ETAGS:
+        return None, None
+    version = await load_version()
+    if version is None:
+        return None, None
+    etag = 'W/"%s"' % wsgi.list_etag(request.url.path, request.url.query, wants_ndjson(request), version)
+    if etag_matches(request, etag):
+        return etag, Response(status_code=304, headers={'ETag': etag})
+    return etag, None
+
+
+def with_etag(response: Response, etag: Optional[str]) -> Response:
+    if etag:
+        response.headers['ETag'] = etag
+    return response
+
+
+async def list_messages(limit: Optional[int] = None, after: Optional[list] = None,
+                        filters: Optional[Dict[str, str]] = None, columns: Optional[List[str]] = None) -> List[dict]:
+    """Message rows from the table, completed with archived rows (read in a thread) where needed"""
+    rows = await storage.list_messages(limit, tuple(after) if after else None, filters, columns)
+    if wsgi.message_archive.newest() is None:
+        return rows
+    return await asyncio.to_thread(wsgi.message_archive.merge, rows, limit, after, filters, columns)
+
+
+async def messages_version() -> Optional[str]:
+    version = await storage.messages_version()
+    return str(version) if version is not None else None
+
+
+async def users_version() -> Optional[str]:
+    version = await storage.users_version()
+    return str(version) if version is not None else None
+
+
+async def get_user(phone: str) -> Optional[dict]:
+    """Get user by phone, served from the shared user cache when possible"""
+    found, user = wsgi.user_cache.get(phone)
+    if found:
+        return user
+    stamp = wsgi.user_cache.stamp()
+    try:
+        user = await wsgi.single_flight.acall('get_user', load_user, phone)
+    except Exception as e:
+        if resilience.is_unavailable(e):
+            found, user = wsgi.user_cache.get_stale(phone)
+            if found:
+                return user
+        raise
+    wsgi.user_cache.fill(phone, user, stamp)
+    return user
+
+
+async def load_user(phone: str) -> Optional[dict]:
+    row = await storage.get_user(phone)
+    return wsgi.decode_user(row) if row else None
+
+
+async def save_users(users_data: List[Dict[Any, Any]]) -> list:
+    """Upsert users and write the saved rows through to the user cache"""
+    rows_by_phone = {u['phone']: wsgi.build_user_row(u) for u in users_data}
+    rows = list(rows_by_phone.values())
+    saved_users = []
+    for i in range(0, len(rows), wsgi.SAVE_USERS_CHUNK_SIZE):
+        for row in await storage.upsert_users(rows[i:i + wsgi.SAVE_USERS_CHUNK_SIZE]):
+            saved_user = wsgi.decode_user(row)
+            wsgi.user_saved(saved_user)
+            saved_users.append(saved_user)
+    return saved_users
+
+
+async def get_messages(filters: Optional[Dict[str, str]] = None, fields: Optional[List[str]] = None) -> list:
+    """Get all messages matching the filters"""
+    rows = await list_messages(filters=filters, columns=wsgi.message_columns(fields))
+    return [wsgi.shape_message(row, fields) for row in rows]
+
+
+async def get_messages_page(limit: int, after: Optional[list] = None, filters: Optional[Dict[str, str]] = None,
+                            fields: Optional[List[str]] = None) -> Tuple[list, Optional[str]]:
+    rows = await list_messages(limit, after, filters, wsgi.message_columns(fields))
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = wsgi.encode_cursor([rows[-1]['timestamp'], rows[-1]['id']])
+    return [wsgi.shape_message(row, fields) for row in rows], next_cursor
+
+
+async def iter_messages(page_size: int, after: Optional[list] = None, filters: Optional[Dict[str, str]] = None,
+                        fields: Optional[List[str]] = None) -> AsyncIterator[dict]:
+    cursor = after
+    while True:
+        messages, next_cursor = await get_messages_page(page_size, cursor, filters, fields)
+        for message in messages:
+            yield message
+        if not next_cursor:
+            return
+        cursor = wsgi.decode_cursor(next_cursor)
+
+
+async def get_all_users(fields: Optional[List[str]] = None) -> dict:
+    """Get all users, keyed by phone"""
+    columns = None
+    if fields:
+        columns = fields if 'phone' in fields else ['phone'] + fields
+    return {row['phone']: wsgi.decode_user(row) for row in await storage.list_users(columns=columns)}
+
+
+async def get_users_page(limit: int, after: Optional[list] = None,
+                         fields: Optional[List[str]] = None) -> Tuple[list, Optional[str]]:
+    columns = None
+    if fields:
+        columns = fields if 'id' in fields else ['id'] + fields
+    rows = await storage.list_users(limit, int(after[0]) if after else None, columns)
+    next_cursor = wsgi.encode_cursor([rows[-1]['id']]) if len(rows) == limit else None
+    users = []
+    for row in rows:
+        if fields and 'id' not in fields:
+            row.pop('id', None)
+        users.append(wsgi.decode_user(row))
+    return users, next_cursor
+
+
+async def iter_users(page_size: int, after: Optional[list] = None,
+                     fields: Optional[List[str]] = None) -> AsyncIterator[dict]:
+    cursor = after
+    while True:
+        users, next_cursor = await get_users_page(page_size, cursor, fields)
+        for user in users:
+            yield user
+        if not next_cursor:
+            return
+        cursor = wsgi.decode_cursor(next_cursor)
+
+
+async def lookup_users(phones: List[str], fields: Optional[List[str]] = None) -> Dict[str, Optional[dict]]:
+    """Resolve many phones with one IN query per chunk, the chunks run concurrently"""
+    users, pending = wsgi.cached_users(phones, fields)
+    columns = wsgi.lookup_columns(fields)
+    chunks = [pending[i:i + wsgi.USERS_LOOKUP_CHUNK_SIZE]
+              for i in range(0, len(pending), wsgi.USERS_LOOKUP_CHUNK_SIZE)]
+    for rows in await asyncio.gather(*(storage.get_users(chunk, columns) for chunk in chunks)):
+        for row in rows:
+            users[row['phone']] = wsgi.project_user(wsgi.decode_user(row), fields)
+    return {phone: users.get(phone) for phone in phones}
+
+
+async def load_menu_items() -> list:
+    return [{'id': row['id'], 'title': row['title']} for row in await storage.list_menu_items()]
+
+
+async def load_primary_input_fields() -> list:
+    return await storage.list_primary_input_fields()
+
+
+# ============================================================================
+# API ROUTES
+# ============================================================================
+
+async def whatsapp_webhook(request: Request) -> Response:
+    """Webhook endpoint to receive WhatsApp messages"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return error('No data received', 400)
+
+        row = wsgi.build_message_row(data)
+        duplicate = wsgi.seen_message(row)
+        if duplicate:
+            message = 'Duplicate message ignored'
+        elif wsgi.spool and await asyncio.to_thread(wsgi.spool.append, row):
+            message = 'Message received and spooled'
+        elif wsgi.ingest_queue and wsgi.ingest_queue.put(row):
+            message = 'Message received and queued'
+        else:
+            try:
+                inserted = await storage.insert_messages([row])
+            except Exception:
+                wsgi.forget_messages([row])
+                raise
+            duplicate = not inserted
+            if duplicate:
+                metrics.observe_webhook_duplicates('database')
+                message = 'Duplicate message ignored'
+            else:
+                message = 'Message received and stored'
+
+        body = {
+            'status': 'success',
+            'message': message,
+            'received_at': datetime.now().isoformat()
+        }
+        if duplicate:
+            body['duplicate'] = True
+        return JSONResponse(body)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def load_flow_session(flow_token: str, phone: Optional[str]) -> dict:
+    """The session for a flow token, see wsgi.load_flow_session"""
+    user = await get_user(phone) if phone else None
+    if user:
+        return wsgi.flow.new_session(user)
+    found, session = wsgi.flow_sessions.get(flow_token)
+    if found:
+        return session
+    return wsgi.flow_session_of(await storage.get_flow_session(flow_token, wsgi.FLOW_SESSION_TTL))
+
+
+async def flow_exchange(flow_token: str, phone: Optional[str], exchange: dict) -> dict:
+    """Answer one data exchange, saving its changes first (see wsgi.flow_exchange)"""
+    flow = wsgi.flow
+    if not flow.uses_session(exchange):
+        return flow.handle(exchange, flow.new_session())[0]
+    session = await load_flow_session(flow_token, phone)
+    for _ in range(wsgi.FLOW_SAVE_ATTEMPTS):
+        response, changes, completed = flow.handle(exchange, session)
+        if phone and flow.profile_complete(session) and (changes or (completed and not session['saved'])):
+            row = await storage.apply_flow_changes(phone, *flow.user_changes(session, changes))
+            if row is None:
+                session['saved'] = False
+                row = await storage.apply_flow_changes(phone, *flow.user_changes(session, changes))
+            return flow.redraw(response, wsgi.flow_user_saved(flow_token, row))
+        if not changes:
+            return response
+        version = await storage.save_flow_session(flow_token, wsgi.stored_flow_session(session),
+                                                  session.get('version'), wsgi.FLOW_SESSION_TTL)
+        if wsgi.remember_flow_session(flow_token, session, version):
+            return response
+        session = wsgi.flow_session_of(await storage.get_flow_session(flow_token, wsgi.FLOW_SESSION_TTL))
+    raise RuntimeError('Flow session was changed by another request, try again')
+
+
+async def flow_data_exchange(request: Request) -> Response:
+    """WhatsApp Flow data_exchange endpoint for the wishlist flow"""
+    try:
+        body = await read_json(request)
+        if not isinstance(body, dict) or not body:
+            return error('No data received', 400)
+
+        exchange = wsgi.flow.exchange_of(body)
+        if exchange.get('action') == 'ping':
+            return JSONResponse(wsgi.flow.handle(exchange, {})[0])
+
+        flow_token = exchange.get('flow_token')
+        if not flow_token:
+            return error('flow_token is required', 400)
+
+        response = await flow_exchange(flow_token, wsgi.flow.phone_of(body), exchange)
+        return JSONResponse(response)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def verify_webhook(request: Request) -> Response:
+    """Webhook verification endpoint"""
+    params = request.query_params
+    verify_token = os.getenv('WHATSAPP_VERIFY_TOKEN', 'your_verify_token_here')
+    if params.get('hub.mode') == 'subscribe' and params.get('hub.verify_token') == verify_token:
+        return PlainTextResponse(params.get('hub.challenge') or '')
+    return error('Verification failed', 403)
+
+
+async def get_messages_endpoint(request: Request) -> Response:
+    """Retrieve stored messages, filtered, projected, paginated or streamed"""
+    try:
+        filters = wsgi.parse_message_filters(request.query_params)
+        fields = wsgi.parse_fields_arg(wsgi.MESSAGE_FIELDS, request.query_params)
+        page_size, after = parse_page_args(request)
+        etag, not_modified = await conditional_list(request, messages_version)
+        if not_modified:
+            return not_modified
+        if wants_ndjson(request):
+            return with_etag(ndjson_response(iter_messages(page_size, after, filters, fields)), etag)
+
+        if 'limit' in request.query_params or 'after' in request.query_params:
+            messages, next_cursor = await get_messages_page(page_size, after, filters, fields)
+            return with_etag(JSONResponse({
+                'status': 'success',
+                'count': len(messages),
+                'messages': messages,
+                'next_cursor': next_cursor
+            }), etag)
+
+        messages = await get_messages(filters, fields)
+        return with_etag(JSONResponse({
+            'status': 'success',
+            'count': len(messages),
+            'messages': messages
+        }), etag)
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def refresh_stats_if_due() -> None:
+    """Roll up new messages at most every STATS_REFRESH_SECONDS (shares the WSGI app's schedule)"""
+    if not wsgi.start_stats_refresh():
+        return
+    try:
+        with resilience.time_budget(wsgi.STATS_REFRESH_TIMEOUT):
+            total = 0
+            while True:
+                processed = await storage.refresh_message_rollups(wsgi.STATS_REFRESH_BATCH, wsgi.STATS_SETTLE_SECONDS)
+                total += processed
+                if not wsgi.more_rollups_allowed(total, processed, wsgi.STATS_REFRESH_MAX_ROWS):
+                    break
+    except Exception as e:
+        print(f"⚠️ Stats rollup refresh failed: {e}")
+    finally:
+        wsgi.stats_refresh['lock'].release()
+
+
+async def get_stats_endpoint(request: Request) -> Response:
+    """Message volume per hour, sender and type, and unique active senders, from the rollups"""
+    try:
+        since, until, top = wsgi.parse_stats_args(request.query_params)
+        await refresh_stats_if_due()
+        stats = await storage.message_stats(since, until, top)
+        return JSONResponse({'status': 'success', 'since': since, 'until': until, **stats})
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def get_message_endpoint(request: Request) -> Response:
+    """Retrieve a specific message by ID"""
+    try:
+        message_id = request.path_params['message_id']
+        row = await storage.get_message(message_id)
+        if not row and wsgi.message_archive.newest() is not None:
+            row = await asyncio.to_thread(wsgi.message_archive.get, message_id)
+        if row:
+            return JSONResponse({'status': 'success', 'message': wsgi.decode_message(row)})
+        return error('Message not found', 404)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def check_or_create_user(request: Request) -> Response:
+    """Check if user exists by phone number"""
+    try:
+        data = await read_json(request)
+        if not data or 'phone' not in data:
+            return error('Phone number is required', 400)
+
+        user = await get_user(data['phone'])
+        if user:
+            return JSONResponse({
+                'exists': True,
+                'parent_name': user.get('parent_name', ''),
+                'child_name': user.get('child_name', ''),
+                'wishlist': user.get('wishlist', [])
+            })
+        return JSONResponse({'exists': False})
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def save_user_endpoint(request: Request) -> Response:
+    """Save or update user information"""
+    try:
+        data = await read_json(request)
+        if not data:
+            return error('No data received', 400)
+
+        for field in ['user', 'parent_name', 'child_name']:
+            if field not in data:
+                return error(f'{field} is required', 400)
+
+        saved = await save_users([{
+            'phone': data['user'],
+            'parent_name': data['parent_name'],
+            'child_name': data['child_name'],
+            'wishlist': data.get('wishlist', [])
+        }])
+        return JSONResponse({
+            'status': 'success',
+            'message': 'User saved successfully',
+            'user': saved[0]
+        })
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def wishlist_item_endpoint(request: Request, operation: str) -> Response:
+    """Shared body of /add-item, /remove-item and /mark-bought"""
+    try:
+        data = await read_json(request)
+        phone, item_id, item_name = wsgi.parse_wishlist_item_request(data, require_name=operation == 'add')
+        if operation == 'add':
+            item = wsgi.new_wishlist_item(item_name, wsgi.parse_wishlist_status(data, 'Pending'))
+            result = await storage.add_wishlist_item(phone, item)
+        elif operation == 'remove':
+            result = await storage.remove_wishlist_item(phone, item_id=item_id, item_name=item_name)
+        else:
+            status = wsgi.parse_wishlist_status(data, 'Bought')
+            result = await storage.set_wishlist_item_status(phone, status, item_id=item_id, item_name=item_name)
+        wsgi.user_changed(phone)
+        body, code = wsgi.wishlist_item_response(result)
+        return JSONResponse(body, status_code=code)
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def add_item_endpoint(request: Request) -> Response:
+    """Add one item to a user's wishlist"""
+    return await wishlist_item_endpoint(request, 'add')
+
+
+async def remove_item_endpoint(request: Request) -> Response:
+    """Remove one item from a user's wishlist"""
+    return await wishlist_item_endpoint(request, 'remove')
+
+
+async def mark_bought_endpoint(request: Request) -> Response:
+    """Set the status of one wishlist item (Bought unless status says otherwise)"""
+    return await wishlist_item_endpoint(request, 'mark')
+
+
+async def get_all_users_endpoint(request: Request) -> Response:
+    """Retrieve users, paginated, streamed or projected"""
+    try:
+        fields = wsgi.parse_fields_arg(wsgi.USER_FIELDS, request.query_params)
+
+        page_size, after = parse_page_args(request)
+        etag, not_modified = await conditional_list(request, users_version)
+        if not_modified:
+            return not_modified
+        if wants_ndjson(request):
+            return with_etag(ndjson_response(iter_users(page_size, after, fields)), etag)
+        if request.query_params.get('stream') == 'json':
+            return with_etag(json_array_response(iter_users(page_size, after, fields), 'users'), etag)
+
+        if 'limit' in request.query_params or 'after' in request.query_params:
+            users, next_cursor = await get_users_page(page_size, after, fields)
+            return with_etag(JSONResponse({
+                'status': 'success',
+                'count': len(users),
+                'users': users,
+                'next_cursor': next_cursor
+            }), etag)
+
+        users = await get_all_users(fields)
+        return with_etag(JSONResponse({
+            'status': 'success',
+            'count': len(users),
+            'users': users
+        }), etag)
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def lookup_users_endpoint(request: Request) -> Response:
+    """Look up many users by phone in a few batched queries"""
+    try:
+        phones, fields = wsgi.parse_lookup_request(await read_json(request), request.query_params)
+        users = await lookup_users(phones, fields)
+        missing = [phone for phone, user in users.items() if user is None]
+        return JSONResponse({
+            'status': 'success',
+            'count': len(users) - len(missing),
+            'users': users,
+            'missing': missing
+        })
+    except ValueError as e:
+        return error(str(e), 400)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def get_user_endpoint(request: Request) -> Response:
+    """Retrieve a specific user by phone number"""
+    try:
+        user = await get_user(request.path_params['phone'])
+        if user:
+            return JSONResponse({'status': 'success', 'user': user})
+        return error('User not found', 404)
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def reference_endpoint(request: Request, key: str, loader, payload_key: str) -> Response:
+    entry = await wsgi.reference_cache.aget(key, lambda: wsgi.single_flight.acall(key, loader))
+    etag = f'"{entry.etag}"'
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse({
+        'status': 'success',
+        'count': len(entry.value),
+        payload_key: entry.value
+    }, headers={'ETag': etag})
+
+
+async def get_menu_endpoint(request: Request) -> Response:
+    """Retrieve all menu items"""
+    try:
+        return await reference_endpoint(request, 'menu', load_menu_items, 'menu')
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def get_primary_input_fields_endpoint(request: Request) -> Response:
+    """Retrieve all primary input fields"""
+    try:
+        return await reference_endpoint(request, 'primary_input_fields', load_primary_input_fields, 'data')
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def invalidate_cache_endpoint(request: Request) -> Response:
+    """Drop cached reference data (all of it, or one key)"""
+    data = await read_json(request)
+    key = data.get('key') if isinstance(data, dict) else None
+    if key is not None and key not in wsgi.REFERENCE_LOADERS:
+        return error(f'Unknown cache key: {key}', 400)
+
+    wsgi.invalidate_reference_cache(key)
+    return JSONResponse({
+        'status': 'success',
+        'message': 'Cache invalidated',
+        'key': key
+    })
+
+
+async def cache_stats_endpoint(request: Request) -> Response:
+    """Cache hit/miss counters"""
+    return JSONResponse({
+        'status': 'success',
+        'reference': wsgi.reference_cache.stats(),
+        'users': wsgi.user_cache.stats(),
+        'single_flight': wsgi.single_flight.stats()
+    })
+
+
+async def health_check(request: Request) -> Response:
+    """Health check endpoint"""
+    db_error = None
+    if request.query_params.get('check') == 'db':
+        try:
+            await storage.ping()
+        except Exception as e:
+            db_error = str(e)
+    circuit = resilience.breaker.stats()
+    return JSONResponse({
+        'status': 'healthy' if circuit['state'] == 'closed' else 'degraded',
+        'service': 'WhatsApp Webhook API (ASGI)',
+        'database': 'Supabase' if wsgi.STORAGE_BACKEND == 'supabase' else wsgi.STORAGE_BACKEND,
+        'db_check_error': db_error,
+        'admission': admission.async_controller.stats(),
+        'circuit_breaker': circuit
+    })
+
+
+async def ingest_stats_endpoint(request: Request) -> Response:
+    """Ingest queue and spool depth, flush latency and webhook dedup counters"""
+    return JSONResponse({
+        'status': 'success',
+        'mode': wsgi.INGEST_MODE,
+        'stats': wsgi.ingest_queue.stats() if wsgi.ingest_queue else None,
+        'spool': wsgi.spool.stats() if wsgi.spool else None,
+        'dead_letter': wsgi.dead_letter.stats() if wsgi.dead_letter else None,
+        'dedup': wsgi.webhook_dedup.stats()
+    })
+
+
+async def archive_stats_endpoint(request: Request) -> Response:
+    """Size and date range of the message archive"""
+    try:
+        return JSONResponse({
+            'status': 'success',
+            'stats': await asyncio.to_thread(wsgi.message_archive.stats)
+        })
+    except Exception as e:
+        return server_error(request, e)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Prometheus metrics in text exposition format"""
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    yield
+    await storage.aclose()
+    wsgi.shutdown_ingest()
+
+
+app = Starlette(
+    routes=[
+        Route('/webhook', whatsapp_webhook, methods=['POST']),
+        Route('/webhook', verify_webhook, methods=['GET']),
+        Route('/flow', flow_data_exchange, methods=['POST']),
+        Route('/messages', get_messages_endpoint, methods=['GET']),
+        Route('/messages/{message_id:int}', get_message_endpoint, methods=['GET']),
+        Route('/stats', get_stats_endpoint, methods=['GET']),
+        Route('/check-or-create-user', check_or_create_user, methods=['POST']),
+        Route('/save-user', save_user_endpoint, methods=['POST']),
+        Route('/add-item', add_item_endpoint, methods=['POST']),
+        Route('/remove-item', remove_item_endpoint, methods=['POST']),
+        Route('/mark-bought', mark_bought_endpoint, methods=['POST']),
+        Route('/users', get_all_users_endpoint, methods=['GET']),
+        Route('/users/lookup', lookup_users_endpoint, methods=['POST']),
+        Route('/users/{phone}', get_user_endpoint, methods=['GET']),
+        Route('/menu', get_menu_endpoint, methods=['GET']),
+        Route('/primary-input-fields', get_primary_input_fields_endpoint, methods=['GET']),
+        Route('/cache/invalidate', invalidate_cache_endpoint, methods=['POST']),
+        Route('/cache/stats', cache_stats_endpoint, methods=['GET']),
+        Route('/ingest/stats', ingest_stats_endpoint, methods=['GET']),
+        Route('/archive/stats', archive_stats_endpoint, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/health', health_check, methods=['GET']),
+    ],
+    # Outermost first: metrics see rejected requests, compression only admitted ones
+    middleware=[
+        Middleware(metrics.MetricsMiddleware),
+        Middleware(admission.AdmissionMiddleware, exempt_paths=('/health', '/metrics'),
+                   read_paths=('/users/lookup',)),
+    ] + ([Middleware(compression.CompressionMiddleware)] if compression.COMPRESSION_ENABLED else []),
+    lifespan=lifespan,
+)
@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the WhatsApp Flow API.
+
+Runs the Flask app in-process (werkzeug, threaded) or under gunicorn against
+a local SQLite database, drives the main endpoints at a configurable
+concurrency and reports p50/p95/p99 latency, throughput and server RSS.
+Results are written as JSON so runs can be compared across commits.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --server gunicorn --concurrency 32 --duration 20
+    python benchmark.py --preset gthread --output gthread.json
+    python benchmark.py --endpoints webhook,menu --output before.json
+    python benchmark.py --output after.json --compare before.json
+    python benchmark.py --import-time --import-budget-ms 300
+    python benchmark.py --serialization
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (method, path, JSON body)
+Request = Tuple[str, str, Optional[dict]]
+
+
+def seed_phone(i: int) -> str:
+    return f'+1555{i:07d}'
+
+
+def webhook_request(rng: random.Random, seeded_users: int) -> Request:
+    phone = seed_phone(rng.randrange(max(1, seeded_users)))
+    return 'POST', '/webhook', {
+        'entry': [{
+            'changes': [{
+                'value': {
+                    'messages': [{
+                        'from': phone,
+                        'id': f'wamid.bench{rng.getrandbits(64):016x}',
+                        'type': 'text',
+                        'text': {'body': 'Benchmark message'}
+                    }]
+                }
+            }]
+        }]
+    }
+
+
+def check_user_request(rng: random.Random, seeded_users: int) -> Request:
+    # Roughly 10% misses, so negative lookups are part of the mix
+    return 'POST', '/check-or-create-user', {'phone': seed_phone(rng.randrange(max(1, int(seeded_users * 1.1))))}
+
+
+def save_user_request(rng: random.Random, seeded_users: int) -> Request:
+    return 'POST', '/save-user', {
+        'user': seed_phone(rng.randrange(max(1, seeded_users))),
+        'parent_name': 'Bench Parent',
+        'child_name': 'Bench Child',
+        'wishlist': ['toy1', 'toy2', 'toy3']
+    }
+
+
+def messages_request(rng: random.Random, seeded_users: int) -> Request:
+    return 'GET', '/messages?limit=100', None
+
+
+def users_request(rng: random.Random, seeded_users: int) -> Request:
+    return 'GET', '/users?limit=100', None
+
+
+def menu_request(rng: random.Random, seeded_users: int) -> Request:
+    return 'GET', '/menu', None
+
+
+ENDPOINTS: Dict[str, Callable[[random.Random, int], Request]] = {
+    'webhook': webhook_request,
+    'check-or-create-user': check_user_request,
+    'save-user': save_user_request,
+    'messages': messages_request,
+    'users': users_request,
+    'menu': menu_request,
+}
+
+
+# ============================================================================
+# SERVER
+# ============================================================================
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def seed_database(path: str, users: int, messages: int) -> None:
+    """Fill a fresh SQLite database with users and messages"""
+    sys.path.insert(0, ROOT)
+    from storage.sqlite_backend import SQLiteStorage
+
+    db = SQLiteStorage(path)
+    now = datetime.now().isoformat()
+    rows = []
+    for i in range(users):
+        rows.append({
+            'phone': seed_phone(i),
+            'parent_name': f'Parent {i}',
+            'child_name': f'Child {i}',
+            'wishlist': [f'item {j}' for j in range(i % 5)]
+        })
+        if len(rows) == 500:
+            db.upsert_users(rows)
+            rows = []
+    db.upsert_users(rows)
+
+    rng = random.Random(1)
+    batch = []
+    for i in range(messages):
+        payload = webhook_request(rng, users)[2]
+        payload['timestamp'] = now
+        batch.append({'data': payload, 'timestamp': now})
+        if len(batch) == 1000:
+            db.insert_messages(batch)
+            batch = []
+    db.insert_messages(batch)
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+
+def rss_kb(pid: int) -> int:
+    """Resident set size of a process in KiB (Linux only, 0 elsewhere)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def pss_kb(pid: int) -> int:
+    """Proportional set size in KiB: pages shared with other processes count fractionally,
+    so summing it over gunicorn workers shows the copy-on-write savings of preload_app"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def child_pids(pid: int) -> List[int]:
+    children = []
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                if int(fields[1]) == pid:
+                    children.append(int(entry))
+            except OSError:
+                continue
+    except OSError:
+        pass
+    return children
+
+
+class InProcessServer:
+    """The Flask app served by werkzeug's threaded server in this process"""
+
+    def __init__(self, env: Dict[str, str]):
+        os.environ.update(env)
+        sys.path.insert(0, ROOT)
+        from werkzeug.serving import make_server
+        import app as app_module
+
+        # Per-request access logs would dominate the measurement
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        self.port = free_port()
+        self.server = make_server('127.0.0.1', self.port, app_module.app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.app_module = app_module
+
+    def start(self) -> None:
+        self.thread.start()
+        wait_for_port(self.port)
+
+    def rss_kb(self) -> int:
+        return rss_kb(os.getpid())
+
+    def pss_kb(self) -> int:
+        return pss_kb(os.getpid())
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        if hasattr(self.app_module, 'shutdown_ingest'):
+            self.app_module.shutdown_ingest()
+
+
+class GunicornServer:
+    """The app served by gunicorn in a subprocess"""
+
+    def __init__(self, env: Dict[str, str], extra_args: List[str]):
+        self.port = free_port()
+        self.env = dict(os.environ, **env)
+        self.args = [sys.executable, '-m', 'gunicorn', 'app:app',
+                     '--config', os.path.join(ROOT, 'gunicorn_config.py'),
+                     '--bind', f'127.0.0.1:{self.port}'] + extra_args
+        self.proc: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        self.proc = subprocess.Popen(self.args, cwd=ROOT, env=self.env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(self.port)
+        time.sleep(1.0)
+
+    def rss_kb(self) -> int:
+        if not self.proc:
+            return 0
+        return rss_kb(self.proc.pid) + sum(rss_kb(pid) for pid in child_pids(self.proc.pid))
+
+    def pss_kb(self) -> int:
+        if not self.proc:
+            return 0
+        return pss_kb(self.proc.pid) + sum(pss_kb(pid) for pid in child_pids(self.proc.pid))
+
+    def stop(self) -> None:
+        if self.proc:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+# ============================================================================
+# IMPORT TIME
+# ============================================================================
+
+IMPORT_SNIPPET = (
+    'import time; started = time.perf_counter(); import app; '
+    'print((time.perf_counter() - started) * 1000)'
+)
+
+
+def measure_import_time(env: Dict[str, str], runs: int = 5) -> Dict[str, Any]:
+    """Time `import app` in fresh interpreters (what a cold start pays before serving)"""
+    full_env = dict(os.environ, **env)
+    timings = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET], cwd=ROOT, env=full_env,
+                                      stderr=subprocess.DEVNULL)
+        timings.append(float(out.decode().strip().splitlines()[-1]))
+    timings.sort()
+
+    # One more run with -X importtime to name the slowest modules app imports directly
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT,
+                          env=full_env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    modules = []
+    for line in proc.stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, raw_name = line[len('import time:'):].split('|')
+        # Nesting depth is encoded as two spaces per level after the separator
+        depth = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        if depth == 0:
+            # Children are listed before their parent, so keep only app's subtree
+            if raw_name.strip() == 'app':
+                break
+            modules = []
+        elif depth == 1:
+            modules.append((int(cumulative), raw_name.strip()))
+    top = sorted(modules, reverse=True)[:8]
+
+    return {
+        'runs_ms': [round(t, 1) for t in timings],
+        'median_ms': round(timings[len(timings) // 2], 1),
+        'slowest_direct_imports_ms': {name: round(us / 1000, 1) for us, name in top},
+    }
+
+
+# ============================================================================
+# SERIALIZATION
+# ============================================================================
+
+def time_per_call_us(fn: Callable[[], Any], iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def measure_serialization(iterations: int = 2000) -> Dict[str, Any]:
+    """Time the JSON work per message on the write and read paths, string-encoded vs native payloads"""
+    sys.path.insert(0, ROOT)
+    import serialization
+
+    rng = random.Random(1)
+    payload = webhook_request(rng, 1000)[2]
+    payload['timestamp'] = datetime.now().isoformat()
+    page = [{'id': i, 'data': webhook_request(rng, 1000)[2], 'timestamp': payload['timestamp']} for i in range(100)]
+    legacy_page_body = json.dumps([dict(row, data=json.dumps(row['data'])) for row in page])
+    native_page_body = serialization.dumps(page)
+
+    def legacy_write():
+        # json.dumps in the app, then the client encodes the resulting string again
+        json.dumps([{'data': json.dumps(payload), 'timestamp': payload['timestamp']}])
+
+    def native_write():
+        serialization.dumps_bytes([{'data': payload, 'timestamp': payload['timestamp']}])
+
+    def legacy_read():
+        rows = json.loads(legacy_page_body)
+        messages = [dict(json.loads(row['data']), id=row['id']) for row in rows]
+        json.dumps({'status': 'success', 'messages': messages})
+
+    def native_read():
+        rows = serialization.loads(native_page_body)
+        messages = [dict(row['data'], id=row['id']) for row in rows]
+        serialization.dumps_bytes({'status': 'success', 'messages': messages})
+
+    return {
+        'encoder': 'orjson' if serialization.orjson is not None else 'json',
+        'write_us_per_message': {
+            'string_encoded': round(time_per_call_us(legacy_write, iterations), 2),
+            'native': round(time_per_call_us(native_write, iterations), 2),
+        },
+        'read_us_per_100_messages': {
+            'string_encoded': round(time_per_call_us(legacy_read, max(1, iterations // 10)), 1),
+            'native': round(time_per_call_us(native_read, max(1, iterations // 10)), 1),
+        },
+    }
+
+
+# ============================================================================
+# LOAD GENERATION
+# ============================================================================
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank percentile
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_endpoint(port: int, name: str, concurrency: int, duration: float,
+                 requests_per_worker: Optional[int], seeded_users: int,
+                 sample_rss: Callable[[], int]) -> Dict[str, Any]:
+    """Drive one endpoint from `concurrency` keep-alive clients"""
+    builder = ENDPOINTS[name]
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    statuses: Dict[int, int] = {}
+    status_lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+    peak_rss = [sample_rss()]
+
+    def worker(index: int) -> None:
+        rng = random.Random(index)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        done = 0
+        while True:
+            if requests_per_worker is not None:
+                if done >= requests_per_worker:
+                    break
+            elif time.monotonic() >= stop_at:
+                break
+            method, path, body = builder(rng, seeded_users)
+            payload = json.dumps(body).encode() if body is not None else None
+            headers = {'Content-Type': 'application/json'} if payload is not None else {}
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                status = 0
+            latencies[index].append((time.perf_counter() - started) * 1000)
+            if status == 0 or status >= 500:
+                errors[index] += 1
+            with status_lock:
+                statuses[status] = statuses.get(status, 0) + 1
+            done += 1
+        conn.close()
+
+    def sampler(stop: threading.Event) -> None:
+        while not stop.wait(0.25):
+            peak_rss[0] = max(peak_rss[0], sample_rss())
+
+    stop_sampling = threading.Event()
+    sampling = threading.Thread(target=sampler, args=(stop_sampling,), daemon=True)
+    sampling.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop_sampling.set()
+    sampling.join()
+
+    values = sorted(v for worker_values in latencies for v in worker_values)
+    total = len(values)
+    return {
+        'requests': total,
+        'errors': sum(errors),
+        'status_codes': {str(k): v for k, v in sorted(statuses.items())},
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(sum(values) / total, 3) if total else 0.0,
+            'p50': round(percentile(values, 50), 3),
+            'p95': round(percentile(values, 95), 3),
+            'p99': round(percentile(values, 99), 3),
+            'max': round(values[-1], 3) if values else 0.0,
+        },
+        'server_rss_kb': {
+            'after': sample_rss(),
+            'peak': peak_rss[0],
+        },
+    }
+
+
+# ============================================================================
+# REPORTING
+# ============================================================================
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    header = f"{'endpoint':<22}{'reqs':>8}{'err':>6}{'rps':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'rss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for name, r in results['endpoints'].items():
+        lat = r['latency_ms']
+        line = (f"{name:<22}{r['requests']:>8}{r['errors']:>6}{r['throughput_rps']:>10.1f}"
+                f"{lat['p50']:>9.2f}{lat['p95']:>9.2f}{lat['p99']:>9.2f}"
+                f"{r['server_rss_kb']['peak'] / 1024:>9.1f}")
+        print(line)
+        if baseline and name in baseline.get('endpoints', {}):
+            b = baseline['endpoints'][name]
+
+            def delta(new: float, old: float) -> str:
+                return f"{(new - old) / old * 100:+.0f}%" if old else 'n/a'
+
+            print(f"{'  vs baseline':<22}{'':>8}{'':>6}"
+                  f"{delta(r['throughput_rps'], b['throughput_rps']):>10}"
+                  f"{delta(lat['p50'], b['latency_ms']['p50']):>9}"
+                  f"{delta(lat['p95'], b['latency_ms']['p95']):>9}"
+                  f"{delta(lat['p99'], b['latency_ms']['p99']):>9}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the WhatsApp Flow API against a local SQLite backend')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--gunicorn-args', default='', help='Extra gunicorn arguments, e.g. "--workers 4 --threads 8"')
+    parser.add_argument('--preset', choices=['sync', 'gthread', 'gevent'], default=None,
+                        help='Run under gunicorn with this gunicorn_config.py worker preset')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Comma-separated endpoints to drive')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per endpoint')
+    parser.add_argument('--requests', type=int, default=None, help='Requests per client instead of a duration')
+    parser.add_argument('--users', type=int, default=5000, help='Users to seed')
+    parser.add_argument('--messages', type=int, default=20000, help='Messages to seed')
+    parser.add_argument('--db', default=None, help='SQLite file to use (default: a fresh temp file)')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the app, e.g. --env INGEST_MODE=queue')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None, help='Previous results file to compare against')
+    parser.add_argument('--import-time', action='store_true',
+                        help='Only measure `import app` time and check it against the budget')
+    parser.add_argument('--import-budget-ms', type=float,
+                        default=float(os.getenv('IMPORT_TIME_BUDGET_MS', '500')),
+                        help='Import time budget in ms (default: IMPORT_TIME_BUDGET_MS or 500)')
+    parser.add_argument('--serialization', action='store_true',
+                        help='Only run the JSON serialization micro-benchmark')
+    args = parser.parse_args(argv)
+
+    if args.serialization:
+        print(json.dumps(measure_serialization(), indent=2))
+        return 0
+
+    if args.import_time:
+        # Default (Supabase) configuration: importing must not touch the network
+        import_env = dict(kv.split('=', 1) for kv in args.env)
+        result = measure_import_time(import_env)
+        print(json.dumps(result, indent=2))
+        within = result['median_ms'] <= args.import_budget_ms
+        print(f"\nimport app: {result['median_ms']} ms median, budget {args.import_budget_ms:g} ms "
+              f"- {'OK' if within else 'OVER BUDGET'}")
+        return 0 if within else 1
+
+    endpoints = [e.strip() for e in args.endpoints.split(',') if e.strip()]
+    unknown = [e for e in endpoints if e not in ENDPOINTS]
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(unknown)}")
+
+    tmpdir = None
+    db_path = args.db
+    if not db_path:
+        tmpdir = tempfile.mkdtemp(prefix='whatsapp-flow-bench-')
+        db_path = os.path.join(tmpdir, 'bench.db')
+        print(f"Seeding {args.users} users and {args.messages} messages into {db_path}")
+        seed_database(db_path, args.users, args.messages)
+
+    env = {'STORAGE_BACKEND': 'sqlite', 'SQLITE_PATH': db_path}
+    if args.preset:
+        args.server = 'gunicorn'
+        env['GUNICORN_WORKER_CLASS'] = args.preset
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+
+    if args.server == 'gunicorn':
+        server = GunicornServer(env, args.gunicorn_args.split())
+    else:
+        server = InProcessServer(env)
+
+    results: Dict[str, Any] = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'server': args.server,
+            'gunicorn_args': args.gunicorn_args,
+            'preset': args.preset,
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'requests_per_client': args.requests,
+            'seeded_users': args.users,
+            'seeded_messages': args.messages,
+            'env': {k: v for k, v in env.items() if k != 'SQLITE_PATH'},
+        },
+        'endpoints': {},
+    }
+
+    results['import_time'] = measure_import_time(env, runs=3)
+    results['import_time']['budget_ms'] = args.import_budget_ms
+    results['serialization'] = measure_serialization()
+
+    server.start()
+    try:
+        results['server_rss_kb_idle'] = server.rss_kb()
+        results['server_pss_kb_idle'] = server.pss_kb()
+        for name in endpoints:
+            print(f"Running {name} ...", flush=True)
+            results['endpoints'][name] = run_endpoint(
+                server.port, name, args.concurrency, args.duration,
+                args.requests, args.users, server.rss_kb)
+            results['endpoints'][name]['server_pss_kb'] = server.pss_kb()
+    finally:
+        server.stop()
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print()
+    print_table(results, baseline)
+    print(f"\nidle memory: {results['server_rss_kb_idle'] / 1024:.1f} MB RSS, "
+          f"{results['server_pss_kb_idle'] / 1024:.1f} MB PSS")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
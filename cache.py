@@ -0,0 +1,465 @@
+"""
+In-process caches for database reads and webhook deduplication.
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class CacheEntry:
+    """A cached value with its content ETag and load time"""
+
+    __slots__ = ('value', 'etag', 'loaded_at')
+
+    def __init__(self, value: Any, loaded_at: float):
+        self.value = value
+        self.etag = content_etag(value)
+        self.loaded_at = loaded_at
+
+
+def content_etag(value: Any) -> str:
+    """Strong ETag derived from the JSON content of a value"""
+    raw = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class ReferenceCache:
+    """TTL cache for small, near-static reference tables.
+
+    Entries are reloaded once they are older than ttl seconds. If the reload
+    fails, the stale entry keeps being served for up to max_stale seconds.
+    """
+
+    def __init__(self, ttl: float = 300.0, max_stale: float = 86400.0):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._entries: Dict[Hashable, CacheEntry] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+        self.load_errors = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> CacheEntry:
+        """Return the cached entry for key, loading it when missing or expired"""
+        entry, fresh = self._lookup(key)
+        if fresh:
+            return entry
+        try:
+            value = loader()
+        except Exception:
+            return self._stale_or_raise(entry)
+        return self._store(key, value)
+
+    async def aget(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> CacheEntry:
+        """Async variant of get() for coroutine loaders"""
+        entry, fresh = self._lookup(key)
+        if fresh:
+            return entry
+        try:
+            value = await loader()
+        except Exception:
+            return self._stale_or_raise(entry)
+        return self._store(key, value)
+
+    def _lookup(self, key: Hashable) -> Tuple[Optional[CacheEntry], bool]:
+        entry = self._entries.get(key)
+        fresh = entry is not None and time.monotonic() - entry.loaded_at < self.ttl
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry, fresh
+
+    def _stale_or_raise(self, entry: Optional[CacheEntry]) -> CacheEntry:
+        """Serve a stale entry after a failed reload, or re-raise the error"""
+        with self._lock:
+            self.load_errors += 1
+            if entry is not None and time.monotonic() - entry.loaded_at < self.ttl + self.max_stale:
+                self.stale_served += 1
+                return entry
+        raise
+
+    def _store(self, key: Hashable, value: Any) -> CacheEntry:
+        entry = CacheEntry(value, time.monotonic())
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = entry
+        return entry
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Drop one entry, or every entry when key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and cached keys"""
+        with self._lock:
+            return {
+                'ttl_seconds': self.ttl,
+                'keys': sorted(str(k) for k in self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_served': self.stale_served,
+                'load_errors': self.load_errors,
+            }
+
+
+class LRUCache:
+    """Bounded LRU cache with per-entry expiry.
+
+    A value of None records a negative result ("not found") and expires after
+    negative_ttl seconds instead of ttl. Values are deep-copied on the way in
+    and out so callers can't mutate cached data. Expired values are kept for
+    another max_stale seconds, for get_stale() to serve while the database
+    is unavailable.
+
+    Reads that fill the cache take a stamp() before loading and store with
+    fill(), which is skipped if the key was set or invalidated since: a load
+    that started before a write can't put the old value back.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0, negative_ttl: float = 5.0,
+                 max_stale: float = 0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Write clock and the clock value of each key's last write; keys beyond
+        # max_size are forgotten and _forgotten_at covers them
+        self._clock = 0
+        self._written: "OrderedDict[Hashable, int]" = OrderedDict()
+        self._forgotten_at = 0
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_served = 0
+        self.stale_fills = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def _wrote(self, key: Hashable) -> None:
+        """Record a write to key (caller holds _lock)"""
+        self._clock += 1
+        self._written[key] = self._clock
+        self._written.move_to_end(key)
+        while len(self._written) > max(1, self.max_size):
+            _, stamp = self._written.popitem(last=False)
+            self._forgotten_at = max(self._forgotten_at, stamp)
+
+    def stamp(self) -> int:
+        """Take before loading a value from the database; pass to fill()"""
+        with self._lock:
+            return self._clock
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, value). found is False on a miss or an expired entry."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return False, None
+            value, expires_at = item
+            now = time.monotonic()
+            if now >= expires_at:
+                if value is None or now >= expires_at + self.max_stale:
+                    del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            if value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+        return True, copy.deepcopy(value)
+
+    def get_stale(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, value) for a value that may have expired up to max_stale seconds ago"""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] is None or time.monotonic() >= item[1] + self.max_stale:
+                return False, None
+            self.stale_served += 1
+            value = item[0]
+        return True, copy.deepcopy(value)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store a value just written to the database (or None for a negative result)"""
+        self._store(key, value, None)
+
+    def fill(self, key: Hashable, value: Any, stamp: int) -> bool:
+        """Store a value read from the database, unless key was written since stamp(); returns whether it was"""
+        return self._store(key, value, stamp)
+
+    def _store(self, key: Hashable, value: Any, stamp: Optional[int]) -> bool:
+        if not self.enabled:
+            return False
+        ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            if stamp is None:
+                self.invalidate(key)
+            return False
+        item = (copy.deepcopy(value), time.monotonic() + ttl)
+        with self._lock:
+            if stamp is None:
+                self._wrote(key)
+            elif max(self._written.get(key, 0), self._forgotten_at) > stamp:
+                self.stale_fills += 1
+                return False
+            self._entries[key] = item
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key: Hashable) -> None:
+        """Drop one entry after its value changed in the database"""
+        with self._lock:
+            self._wrote(key)
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self._lock:
+            self._entries.clear()
+            self._written.clear()
+            self._clock += 1
+            self._forgotten_at = self._clock
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'negative_ttl_seconds': self.negative_ttl,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'max_stale_seconds': self.max_stale,
+                'stale_served': self.stale_served,
+                'stale_fills': self.stale_fills,
+            }
+
+
+class SeenSet:
+    """Bounded set of recently seen keys; the least recently seen are evicted first"""
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._keys: "OrderedDict[Hashable, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def add(self, key: Hashable) -> bool:
+        """Record key; returns False if it was already in the set"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return False
+            self._keys[key] = None
+            self.misses += 1
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def discard(self, key: Hashable) -> None:
+        """Forget key, e.g. when storing the item it stands for failed"""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and current size"""
+        with self._lock:
+            return {
+                'size': len(self._keys),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class Flight:
+    """One in-flight call and the callers waiting for its result"""
+
+    __slots__ = ('done', 'result', 'error', 'loop_thread', 'waiters')
+
+    def __init__(self, loop_thread: Optional[int]):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        # Thread of the event loop running the call, when the leader is a coroutine
+        self.loop_thread = loop_thread
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls into one.
+
+    The first caller for a (name, *args) key runs the call; callers that
+    arrive while it is in flight, from other threads or async tasks, wait
+    for it and get a deep copy of its result (or its exception). Nothing is
+    kept once the call returns, so this never serves stale data. After a
+    write, forget() the key so later callers start a fresh call instead of
+    joining one that may have read the old value.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._flights: Dict[Hashable, Flight] = {}
+        self._lock = threading.Lock()
+        self._counts: Dict[str, List[int]] = {}  # name -> [executed, coalesced]
+
+    def _join(self, key: Tuple, loop: Optional[asyncio.AbstractEventLoop] = None
+              ) -> Tuple[Optional[Flight], bool, Optional[asyncio.Future]]:
+        """Return (flight, is_leader, future to await); flight is None when the caller must run alone"""
+        with self._lock:
+            counts = self._counts.setdefault(key[0], [0, 0])
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(threading.get_ident() if loop else None)
+                counts[0] += 1
+                return flight, True, None
+            if loop is None and flight.loop_thread == threading.get_ident():
+                # Blocking here would stall the event loop that has to finish the call
+                counts[0] += 1
+                return None, False, None
+            counts[1] += 1
+            future = None
+            if loop is not None:
+                future = loop.create_future()
+                flight.waiters.append((loop, future))
+            return flight, False, future
+
+    def _finish(self, key: Tuple, flight: Flight, result: Any, error: Optional[BaseException]) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.result, flight.error = result, error
+            flight.done.set()
+            waiters, flight.waiters = flight.waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass  # loop already closed
+
+    @staticmethod
+    def _shared(flight: Flight) -> Any:
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy(flight.result)
+
+    def call(self, name: str, fn: Callable[..., Any], *args: Hashable) -> Any:
+        """fn(*args), shared with concurrent calls for the same name and args"""
+        if not self.enabled:
+            return fn(*args)
+        key = (name,) + args
+        flight, leader, _ = self._join(key)
+        if flight is None:
+            return fn(*args)
+        if not leader:
+            flight.done.wait()
+            if not isinstance(flight.error, Exception) and flight.error is not None:
+                # The leader was cancelled; run the call ourselves
+                return fn(*args)
+            return self._shared(flight)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self._finish(key, flight, None, e)
+            raise
+        self._finish(key, flight, result, None)
+        return result
+
+    async def acall(self, name: str, fn: Callable[..., Awaitable[Any]], *args: Hashable) -> Any:
+        """Async variant of call() for coroutine functions"""
+        if not self.enabled:
+            return await fn(*args)
+        key = (name,) + args
+        flight, leader, future = self._join(key, asyncio.get_running_loop())
+        if not leader:
+            await future
+            if not isinstance(flight.error, Exception) and flight.error is not None:
+                return await fn(*args)
+            return self._shared(flight)
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            self._finish(key, flight, None, e)
+            raise
+        self._finish(key, flight, result, None)
+        return result
+
+    def forget(self, name: str, *args: Hashable) -> None:
+        """Stop new callers joining the in-flight call for name and args; its current waiters still get its result"""
+        with self._lock:
+            self._flights.pop((name,) + args, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Calls run and calls coalesced, per name"""
+        with self._lock:
+            executed = sum(c[0] for c in self._counts.values())
+            coalesced = sum(c[1] for c in self._counts.values())
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self._flights),
+                'executed': executed,
+                'coalesced': coalesced,
+                'coalesce_ratio': coalesce_ratio(executed, coalesced),
+                'by_name': {
+                    name: {'executed': c[0], 'coalesced': c[1], 'coalesce_ratio': coalesce_ratio(*c)}
+                    for name, c in sorted(self._counts.items())
+                },
+            }
+
+
+def coalesce_ratio(executed: int, coalesced: int) -> float:
+    """Share of calls that were served by another caller's backend call"""
+    total = executed + coalesced
+    return round(coalesced / total, 4) if total else 0.0
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Retention job: move messages older than ARCHIVE_AFTER_DAYS from the messages
+table into the compressed archive (see archive.py), a batch at a time.
+
+The cutoff is rounded down to midnight UTC, so each run archives whole days.
+Archived rows are deleted from the table when that is safe: always with
+SQLite, and with Supabase only when ARCHIVE_SHARED=true, since a local
+archive directory is lost with the server and not seen by other instances.
+Otherwise (or with --keep) rows stay in the table and each run carries on
+after the newest archived message; --delete insists on deleting and fails
+when it isn't safe. Each batch is written and fsynced to the archive before
+its rows are deleted; if the job is interrupted in between, the next run
+skips the rows that were already archived and deletes them.
+Only one compaction runs at a time per ARCHIVE_DIR. The /stats rollups are
+brought up to date first, so archived messages stay counted. Schedule it
+daily (cron, Render cron job) against the same storage backend the app uses.
+
+Usage:
+    python compact_messages.py --days 90 --batch-size 500 --pause 0.1 [--keep | --delete]
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    import archive
+
+    parser = argparse.ArgumentParser(description='Archive old messages and delete them from the messages table when safe')
+    parser.add_argument('--days', type=int, default=archive.ARCHIVE_AFTER_DAYS,
+                        help='Archive messages older than this many days')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per batch')
+    parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between batches')
+    parser.add_argument('--max-batches', type=int, default=0, help='Stop after this many batches (0 = no limit)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--delete', action='store_true',
+                      help='Delete archived messages from the table, failing if the archive is not shared')
+    mode.add_argument('--keep', action='store_true', help='Only copy messages; keep them in the table')
+    args = parser.parse_args(argv)
+
+    from app import get_storage, message_archive, refresh_message_rollups
+    db = get_storage()
+
+    safe_to_delete = db.name == 'sqlite' or archive.ARCHIVE_SHARED
+    if args.delete and not safe_to_delete:
+        print(f"❌ Not deleting from {db.name}: {message_archive.root} is local to this server. "
+              f"Set ARCHIVE_SHARED=true if ARCHIVE_DIR is durable storage every server reads.")
+        return 2
+    delete = safe_to_delete and not args.keep
+    if not delete and not args.keep:
+        print(f"⚠️ Keeping archived rows in {db.name}: set ARCHIVE_SHARED=true to delete them")
+
+    # Count every message in the /stats rollups before it leaves the table
+    rolled_up = refresh_message_rollups()
+    print(f"✅ Rolled up {rolled_up} messages for /stats")
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=args.days)
+    before = cutoff.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+
+    lock_fd = message_archive.lock()
+    if lock_fd is None:
+        print(f"⚠️ Another compaction is running on {message_archive.root}")
+        return 1
+
+    archived = deleted = batches = 0
+    started = time.perf_counter()
+    try:
+        # Kept rows are still in the table, so carry on after the archived ones
+        after = None if delete else message_archive.last_key()
+        print(f"🔄 Archiving messages before {before} to {message_archive.root}")
+        while not args.max_batches or batches < args.max_batches:
+            rows = db.list_messages_before(before, args.batch_size, after)
+            if not rows:
+                break
+            archived += message_archive.write(rows)
+            if delete:
+                deleted += db.delete_messages([row['id'] for row in rows])
+            after = rows[-1]['timestamp'], rows[-1]['id']
+            batches += 1
+            print(f"🔄 Archived {archived} and deleted {deleted} messages so far")
+            time.sleep(args.pause)
+    finally:
+        os.close(lock_fd)
+
+    print(f"✅ Archived {archived} and deleted {deleted} messages in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,201 @@
+"""
+HTTP response compression for the Flask app (init_app) and the ASGI app
+(CompressionMiddleware).
+
+Responses are brotli- or gzip-encoded when the client's Accept-Encoding
+allows it, the content type is JSON or text and the body is at least
+COMPRESS_MIN_SIZE bytes. Streamed responses (NDJSON, streamed JSON arrays)
+are compressed on the fly and flushed every COMPRESS_STREAM_FLUSH bytes of
+input, so rows keep arriving while the stream is produced. Brotli is only
+offered if the brotli package is installed.
+"""
+
+import os
+import zlib
+from typing import Iterable, Iterator, Optional, Union
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() != 'false'
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '4'))
+COMPRESS_STREAM_FLUSH = int(os.getenv('COMPRESS_STREAM_FLUSH', '65536'))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+def available_encodings() -> tuple:
+    """Supported encodings, most preferred first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encodings) -> Optional[str]:
+    """Best supported encoding allowed by a werkzeug Accept-Encoding header"""
+    return accept_encodings.best_match(available_encodings())
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class StreamCompressor:
+    """Incremental compressor that flushes every COMPRESS_STREAM_FLUSH bytes of input"""
+
+    def __init__(self, encoding: str):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._process, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+            self._process = compressor.compress
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = compressor.flush
+        self._pending = 0
+
+    def compress(self, chunk: Union[str, bytes]) -> bytes:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = self._process(chunk)
+        self._pending += len(chunk)
+        if self._pending >= COMPRESS_STREAM_FLUSH:
+            data += self._flush()
+            self._pending = 0
+        return data
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+def compress_stream(chunks: Iterable[Union[str, bytes]], encoding: str) -> Iterator[bytes]:
+    """Compress a response body iterator chunk by chunk"""
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def init_app(app) -> None:
+    """Register an after_request hook that compresses eligible responses"""
+    if not COMPRESSION_ENABLED:
+        return
+
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or request.method == 'HEAD' or 'Content-Encoding' in response.headers
+                or not (response.mimetype or '').startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < COMPRESS_MIN_SIZE:
+                return response
+            response.set_data(compress(body, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        # The encoded body differs byte for byte, so a strong ETag becomes weak
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+class CompressionMiddleware:
+    """ASGI middleware applying the same rules as init_app to every response"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] == 'HEAD':
+            await self.app(scope, receive, send)
+            return
+
+        from starlette.datastructures import Headers
+        from werkzeug.http import parse_accept_header
+
+        encoding = choose_encoding(parse_accept_header(Headers(scope=scope).get('accept-encoding')))
+        await self.app(scope, receive, CompressingSend(send, encoding))
+
+
+class CompressingSend:
+    """send() wrapper that holds back the response start until the first body chunk decides the encoding"""
+
+    def __init__(self, send, encoding: Optional[str]):
+        self.send = send
+        self.encoding = encoding
+        self.start = None
+        self.compressor: Optional[StreamCompressor] = None
+
+    async def __call__(self, message) -> None:
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        if message['type'] != 'http.response.body':
+            await self.send(message)
+            return
+        if self.start is not None:
+            start, self.start = self.start, None
+            message = self.begin(start, message)
+            await self.send(start)
+        elif self.compressor is not None:
+            message = self.compressed(message)
+        await self.send(message)
+
+    def begin(self, start, message):
+        """Set the response headers and return the first body message"""
+        from starlette.datastructures import MutableHeaders
+
+        headers = MutableHeaders(raw=start['headers'])
+        status = start['status']
+        if (status < 200 or status in (204, 304) or 'content-encoding' in headers
+                or not headers.get('content-type', '').startswith(COMPRESSIBLE_TYPES)):
+            return message
+
+        headers.add_vary_header('Accept-Encoding')
+        body, streamed = message.get('body', b''), message.get('more_body', False)
+        if self.encoding is None or (not streamed and len(body) < COMPRESS_MIN_SIZE):
+            return message
+
+        headers['Content-Encoding'] = self.encoding
+        etag = headers.get('etag')
+        if etag and not etag.startswith('W/'):
+            # The encoded body differs byte for byte, so a strong ETag becomes weak
+            headers['ETag'] = 'W/' + etag
+        if not streamed:
+            body = compress(body, self.encoding)
+            headers['Content-Length'] = str(len(body))
+            return {**message, 'body': body}
+        del headers['Content-Length']
+        self.compressor = StreamCompressor(self.encoding)
+        return self.compressed(message)
+
+    def compressed(self, message):
+        data = self.compressor.compress(message.get('body', b''))
+        if not message.get('more_body', False):
+            data += self.compressor.finish()
+        return {**message, 'body': data}
@@ -0,0 +1,17 @@
+"""
+pytest setup: the app under test runs on a throwaway SQLite database.
+
+test_api.py is a manual script against a running server and is not collected.
+"""
+
+import os
+import tempfile
+
+collect_ignore = ['test_api.py']
+
+_tmp = tempfile.mkdtemp(prefix='whatsapp_flow_tests_')
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(_tmp, 'test.db'))
+os.environ.setdefault('SPOOL_DIR', os.path.join(_tmp, 'spool'))
+os.environ.setdefault('ARCHIVE_DIR', os.path.join(_tmp, 'archive'))
+os.environ.setdefault('INGEST_DEAD_LETTER_DIR', os.path.join(_tmp, 'dead-letter'))
@@ -0,0 +1,190 @@
+"""
+WhatsApp Flow data_exchange handler for the wishlist flow.
+
+Implements the screen logic of the worker in data.txt
+(INIT -> PARENT_INFO -> ADD_ITEM -> CHECKOUT). The functions here are pure:
+they read and update a session dict and build the screen response, while
+app.py saves the changes of a complete profile to the users table before
+answering, and builds a saved user's session from that row.
+"""
+
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+FLOW_VERSION = '3.0'
+
+
+def new_session(user: Optional[dict] = None) -> dict:
+    """Empty session state, or the state of a saved user (saved=True)"""
+    session = {'parent_name': '', 'child_name': '', 'items': [], 'saved': bool(user)}
+    if user:
+        session['parent_name'] = user.get('parent_name') or ''
+        session['child_name'] = user.get('child_name') or ''
+        for i, entry in enumerate(user.get('wishlist') or []):
+            if isinstance(entry, dict):
+                title = entry.get('item_name') or entry.get('title')
+                item_id = entry.get('item_id')
+                status = entry.get('status') or 'Pending'
+            else:
+                title, item_id, status = entry, None, 'Pending'
+            if isinstance(title, str) and title:
+                item = {'id': item_id or f'item_saved_{i}', 'title': title, 'status': status}
+                if not item_id:
+                    # Legacy item without an id: the backend finds it by name
+                    item['by_name'] = True
+                session['items'].append(item)
+    return session
+
+
+def exchange_of(body: Dict[str, Any]) -> Dict[str, Any]:
+    """The data_exchange part of a request (Kapso wraps it, WhatsApp sends it bare)"""
+    exchange = body.get('data_exchange')
+    return exchange if isinstance(exchange, dict) else body
+
+
+def phone_of(body: Dict[str, Any]) -> Optional[str]:
+    """The user's phone number, if the caller included it"""
+    exchange = exchange_of(body)
+    for source in (body, exchange):
+        for key in ('user', 'phone'):
+            if isinstance(source.get(key), str) and source[key]:
+                return source[key]
+    return None
+
+
+def uses_session(exchange: Dict[str, Any]) -> bool:
+    """Whether the answer depends on the session (ping and INIT don't)"""
+    return exchange.get('action') in ('data_exchange', 'BACK')
+
+
+def profile_complete(session: dict) -> bool:
+    return bool(session['parent_name'] and session['child_name'])
+
+
+def wishlist_titles(session: dict) -> List[str]:
+    return [item['title'] for item in session['items']]
+
+
+def wishlist_item(item: dict) -> dict:
+    """A session item as a users.wishlist item ({item_id, item_name, status})"""
+    return {'item_id': item['id'], 'item_name': item['title'], 'status': item.get('status', 'Pending')}
+
+
+def wishlist_items(session: dict) -> List[dict]:
+    return [wishlist_item(item) for item in session['items']]
+
+
+def item_ref(item: dict) -> Dict[str, Optional[str]]:
+    """item_id/item_name arguments that find a session item in users.wishlist"""
+    if item.get('by_name'):
+        return {'item_id': None, 'item_name': item['title']}
+    return {'item_id': item['id'], 'item_name': None}
+
+
+def user_changes(session: dict, changes: List[Tuple[str, Optional[dict]]]
+                 ) -> Tuple[Optional[Dict[str, str]], List[dict], List[dict]]:
+    """(profile, items to add, item refs to remove) that save changes to the users row.
+
+    A session that isn't saved yet is saved whole: the profile and every item.
+    """
+    profile = {'parent_name': session['parent_name'], 'child_name': session['child_name']}
+    if not session.get('saved'):
+        return profile, wishlist_items(session), []
+    add = [wishlist_item(item) for kind, item in changes if kind == 'add']
+    remove = [item_ref(item) for kind, item in changes if kind == 'remove']
+    return (profile if any(kind == 'profile' for kind, _ in changes) else None), add, remove
+
+
+def screen(name: str, data: Optional[dict] = None) -> dict:
+    return {'version': FLOW_VERSION, 'screen': name, 'data': data or {}}
+
+
+def add_item_screen(session: dict) -> dict:
+    return screen('ADD_ITEM', {
+        'wishlist_items': [{'id': item['id'], 'title': item['title']} for item in session['items']],
+        'has_items': len(session['items']) > 0
+    })
+
+
+def checkout_screen(session: dict) -> dict:
+    """Summary screen with the wishlist as a markdown table"""
+    lines = [
+        '# Amazing Wishlist!\n\n',
+        "Your wishlist has been created successfully. We're excited to help make these wishes come true!\n\n",
+        f"**Parent:** {session['parent_name']}\n\n",
+        f"**Child:** {session['child_name']}\n\n",
+    ]
+    if session['items']:
+        lines.append('| # | Item |\n')
+        lines.append('|---|------|\n')
+        for index, item in enumerate(session['items']):
+            lines.append(f"| {index + 1} | {item['title']} |\n")
+    else:
+        lines.append('*No items in wishlist*')
+
+    return screen('CHECKOUT', {
+        'wishlist_table': ''.join(lines),
+        'parent': session['parent_name'],
+        'child': session['child_name'],
+        'wishlist': wishlist_titles(session)
+    })
+
+
+def redraw(response: dict, session: dict) -> dict:
+    """The response's wishlist screen drawn again from session (e.g. the saved row)"""
+    if response.get('screen') == 'ADD_ITEM':
+        return add_item_screen(session)
+    if response.get('screen') == 'CHECKOUT':
+        return checkout_screen(session)
+    return response
+
+
+def handle(exchange: Dict[str, Any], session: dict) -> Tuple[dict, List[Tuple[str, Optional[dict]]], bool]:
+    """Apply one request to the session.
+
+    Returns (response, changes, completed): changes lists what was modified
+    as ('profile', None), ('add', item) or ('remove', item), so only those
+    items are saved; completed is True when the user finished the flow.
+    """
+    action = exchange.get('action')
+    current = exchange.get('screen')
+    data = exchange.get('data') or {}
+
+    if action == 'ping':
+        return {'data': {'status': 'active'}}, [], False
+
+    if action == 'INIT':
+        return screen('PARENT_INFO'), [], False
+
+    if action == 'data_exchange':
+        if current == 'PARENT_INFO' and data.get('parent_name') and data.get('child_name'):
+            session['parent_name'] = data['parent_name']
+            session['child_name'] = data['child_name']
+            return add_item_screen(session), [('profile', None)], False
+
+        if current == 'ADD_ITEM':
+            if data.get('done') == 'true':
+                return checkout_screen(session), [], True
+
+            changes: List[Tuple[str, Optional[dict]]] = []
+            if data.get('remove_action') == 'remove_items' and data.get('remove_item_ids'):
+                ids = data['remove_item_ids']
+                ids = ids if isinstance(ids, list) else [ids]
+                changes.extend(('remove', item) for item in session['items'] if item['id'] in ids)
+                session['items'] = [item for item in session['items'] if item['id'] not in ids]
+
+            if data.get('add_action') == 'add_item':
+                title = data.get('new_item')
+                title = title.strip() if isinstance(title, str) else ''
+                # Items already on the list aren't added twice (prd.txt FR-3)
+                if title and title.lower() not in {t.lower() for t in wishlist_titles(session)}:
+                    item = {'id': f'item_{time.time_ns() // 1000}', 'title': title, 'status': 'Pending'}
+                    session['items'].append(item)
+                    changes.append(('add', item))
+
+            return add_item_screen(session), changes, False
+
+    if action == 'BACK' and current == 'ADD_ITEM':
+        return add_item_screen(session), [], False
+
+    return screen('PARENT_INFO'), [], False
@@ -1,6 +1,82 @@
 # Gunicorn configuration for production
+import os
+import shutil
+import sys
+import tempfile
+
 bind = "0.0.0.0:5000"
-workers = 2
-timeout = 120
 keepalive = 5
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+# Worker preset: 'gthread' (default), 'sync' or 'gevent'. Worker and thread
+# counts follow the CPUs available to this process; GUNICORN_WORKERS (or
+# WEB_CONCURRENCY), GUNICORN_THREADS and GUNICORN_WORKER_CONNECTIONS override them
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread').lower()
+
+try:
+    cpus = len(os.sched_getaffinity(0))
+except AttributeError:
+    cpus = os.cpu_count() or 1
+
+if worker_class == 'sync':
+    # One request per process: more processes to overlap database waits
+    default_workers, default_threads = 2 * cpus + 1, 1
+elif worker_class == 'gevent':
+    # One process per CPU, each multiplexing many connections
+    default_workers, default_threads = cpus, 1
+    # Patch before the app is imported (preload) so its locks and sockets cooperate
+    from gevent import monkey
+    monkey.patch_all()
+elif worker_class == 'gthread':
+    # Requests mostly wait on the database, so threads overlap them cheaply
+    default_workers, default_threads = cpus + 1, 8
+else:
+    raise ValueError(f"Unknown GUNICORN_WORKER_CLASS: {worker_class}. Use 'sync', 'gthread' or 'gevent'.")
+
+workers = int(os.getenv('GUNICORN_WORKERS') or os.getenv('WEB_CONCURRENCY') or max(2, default_workers))
+threads = int(os.getenv('GUNICORN_THREADS') or default_threads)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+# Import the app once in the master so workers share its memory copy-on-write;
+# database clients are dropped around each fork (see pre_fork/post_fork)
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() != 'false'
+
+# Recycle workers after this many requests (plus jitter); 0 disables
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+# Workers write Prometheus samples here so /metrics can aggregate them
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'whatsapp-flow-metrics'))
+
+
+def on_starting(server):
+    """Start every server run with an empty metrics directory"""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def pre_fork(server, worker):
+    """Close any database connection the master opened so no worker inherits it"""
+    app = sys.modules.get('app')
+    if app is not None:
+        app.reset_storage()
+
+
+def post_fork(server, worker):
+    """Make the worker create its own database client and connections"""
+    app = sys.modules.get('app')
+    if app is not None:
+        app.reset_storage()
+
+
+def worker_exit(server, worker):
+    """Flush the webhook ingest queue before a worker exits"""
+    from app import shutdown_ingest
+    shutdown_ingest()
+
 
+def child_exit(server, worker):
+    """Drop the live gauges of a worker that exited"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
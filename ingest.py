@@ -0,0 +1,195 @@
+"""
+Write-behind ingest queue for webhook messages.
+
+Payloads are accepted into a bounded in-process queue and a background
+flusher thread writes them to the messages table in multi-row batches,
+flushing when a batch is full or when the oldest queued row gets too old.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+
+class IngestQueue:
+    """Bounded queue with a background batch flusher.
+
+    A batch is taken off the queue and written while holding the flush lock,
+    so flush() returns only once every row queued before it was called has
+    been written (or handed to dead_letter). Rows that still fail after
+    max_retries are passed to dead_letter(rows) when one is given, and only
+    dropped if that fails too.
+    """
+
+    def __init__(self, flush_fn: Callable[[List[Dict[str, Any]]], None],
+                 max_size: int = 10000, batch_size: int = 100,
+                 max_delay: float = 0.5, max_retries: int = 3,
+                 dead_letter: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self.flush_fn = flush_fn
+        self.max_size = max_size
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max(0.0, max_delay)
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+
+        self._rows: Deque[Dict[str, Any]] = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(threading.Lock())
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.dead_lettered = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def _ensure_started(self) -> None:
+        """Start the flusher thread (again, after a fork) if it is not running"""
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self._pid != os.getpid():
+                # Locks may have been held by another thread at fork time
+                self._ready = threading.Condition(threading.Lock())
+                self._flush_lock = threading.Lock()
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='ingest-flusher', daemon=True)
+            self._thread.start()
+
+    def put(self, row: Dict[str, Any]) -> bool:
+        """Queue a row for writing. Returns False if the queue is full."""
+        self._ensure_started()
+        with self._ready:
+            if len(self._rows) >= self.max_size:
+                with self._lock:
+                    self.rejected += 1
+                return False
+            self._rows.append(row)
+            if len(self._rows) == 1 or len(self._rows) >= self.batch_size:
+                self._ready.notify()
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _wait_for_batch(self) -> bool:
+        """Wait until a full batch is queued or the oldest row is max_delay old; False if nothing queued"""
+        with self._ready:
+            if not self._rows and not self._ready.wait_for(lambda: self._rows or self._stop.is_set(), 0.25):
+                return False
+            if not self._rows:
+                return False
+            deadline = time.monotonic() + self.max_delay
+            while len(self._rows) < self.batch_size and not self._stop.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            return bool(self._rows)
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        with self._ready:
+            count = min(self.batch_size, len(self._rows))
+            return [self._rows.popleft() for _ in range(count)]
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        """Write one batch, retrying a few times before dead-lettering it"""
+        for attempt in range(self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                with self._lock:
+                    self.flush_errors += 1
+                print(f"⚠️ Ingest flush of {len(batch)} rows failed (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    time.sleep(min(2.0, 0.1 * (2 ** attempt)))
+                    continue
+                self._give_up(batch)
+                return
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.flushed += len(batch)
+                self.flush_count += 1
+                self.last_flush_ms = elapsed_ms
+                self.total_flush_ms += elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            return
+
+    def _give_up(self, batch: List[Dict[str, Any]]) -> None:
+        """Hand a batch that keeps failing to the dead letter store, or drop it"""
+        if self.dead_letter is not None:
+            try:
+                self.dead_letter(batch)
+            except Exception as e:
+                print(f"❌ Dead-lettering {len(batch)} rows failed: {e}")
+            else:
+                with self._lock:
+                    self.dead_lettered += len(batch)
+                print(f"⚠️ Dead-lettered {len(batch)} rows after {self.max_retries + 1} attempts")
+                return
+        with self._lock:
+            self.dropped += len(batch)
+        print(f"❌ Dropped {len(batch)} queued rows after {self.max_retries + 1} attempts")
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if not self._wait_for_batch():
+                continue
+            # Taken and written under one lock, so flush() can't miss the batch
+            with self._flush_lock:
+                batch = self._take_batch()
+                if batch:
+                    self._write(batch)
+
+    def flush(self) -> None:
+        """Synchronously write everything currently queued, including a batch the flusher is writing"""
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return
+                self._write(batch)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop the flusher thread and drain the queue"""
+        self._stop.set()
+        with self._ready:
+            self._ready.notify_all()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            thread.join(timeout)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, throughput and flush latency counters"""
+        with self._lock:
+            return {
+                'queue_depth': len(self._rows),
+                'queue_capacity': self.max_size,
+                'batch_size': self.batch_size,
+                'max_delay_ms': int(self.max_delay * 1000),
+                'enqueued': self.enqueued,
+                'rejected': self.rejected,
+                'flushed': self.flushed,
+                'dead_lettered': self.dead_lettered,
+                'dropped': self.dropped,
+                'flush_count': self.flush_count,
+                'flush_errors': self.flush_errors,
+                'last_flush_ms': round(self.last_flush_ms, 3),
+                'avg_flush_ms': round(self.total_flush_ms / self.flush_count, 3) if self.flush_count else 0.0,
+                'max_flush_ms': round(self.max_flush_ms, 3),
+            }
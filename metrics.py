@@ -0,0 +1,277 @@
+"""
+Prometheus metrics for the WhatsApp Flow API.
+
+Request timing per route and status (Flask hooks via init_app, ASGI via
+MetricsMiddleware), timing and errors per storage
+operation, retries and circuit breaker rejections, in-flight gauges, payload
+sizes, ingest queue metrics, webhook duplicate counts and admission control
+rejections.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR (gunicorn_config.py does this by
+default) so every worker writes its samples to that directory and /metrics
+aggregates them across processes. If prometheus_client is not installed,
+everything here is a no-op and /metrics reports that it is unavailable.
+"""
+
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+        REGISTRY, generate_latest
+    )
+    from prometheus_client import multiprocess
+except ImportError:
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+    multiprocess = None
+    Counter = None
+
+METRICS_ENABLED = Counter is not None and os.getenv('METRICS_ENABLED', 'true').lower() != 'false'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+if METRICS_ENABLED:
+    REQUESTS = Counter(
+        'whatsapp_flow_http_requests_total', 'HTTP requests',
+        ['method', 'route', 'status'])
+    REQUEST_DURATION = Histogram(
+        'whatsapp_flow_http_request_duration_seconds', 'HTTP request duration',
+        ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+    REQUESTS_IN_PROGRESS = Gauge(
+        'whatsapp_flow_http_requests_in_progress', 'HTTP requests being handled',
+        ['method', 'route'], multiprocess_mode='livesum')
+    REQUEST_SIZE = Histogram(
+        'whatsapp_flow_http_request_size_bytes', 'HTTP request body size',
+        ['method', 'route'], buckets=SIZE_BUCKETS)
+    RESPONSE_SIZE = Histogram(
+        'whatsapp_flow_http_response_size_bytes', 'HTTP response body size (unknown for streamed responses)',
+        ['method', 'route'], buckets=SIZE_BUCKETS)
+    HTTP_EXCEPTIONS = Counter(
+        'whatsapp_flow_http_exceptions_total', 'Exceptions raised while handling a request',
+        ['route', 'exception'])
+    DB_DURATION = Histogram(
+        'whatsapp_flow_db_operation_duration_seconds', 'Storage backend call duration',
+        ['backend', 'operation'], buckets=LATENCY_BUCKETS)
+    DB_ERRORS = Counter(
+        'whatsapp_flow_db_errors_total', 'Storage backend call errors',
+        ['backend', 'operation', 'exception'])
+    INGEST_QUEUE_DEPTH = Gauge(
+        'whatsapp_flow_ingest_queue_depth', 'Messages waiting in the ingest queue',
+        multiprocess_mode='livesum')
+    INGEST_FLUSH_DURATION = Histogram(
+        'whatsapp_flow_ingest_flush_duration_seconds', 'Ingest batch flush duration',
+        buckets=LATENCY_BUCKETS)
+    INGEST_FLUSH_ROWS = Histogram(
+        'whatsapp_flow_ingest_flush_rows', 'Rows written per ingest flush',
+        buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+    WEBHOOK_DUPLICATES = Counter(
+        'whatsapp_flow_webhook_duplicates_total', 'Redelivered webhook messages skipped',
+        ['layer'])
+    DB_RETRIES = Counter(
+        'whatsapp_flow_db_retries_total', 'Storage backend reads retried after a transient error',
+        ['operation'])
+    DB_CIRCUIT_REJECTED = Counter(
+        'whatsapp_flow_db_circuit_rejected_total', 'Storage backend calls rejected while the circuit was open',
+        ['operation'])
+    ADMISSION_REJECTED = Counter(
+        'whatsapp_flow_admission_rejected_total', 'Requests turned away by admission control',
+        ['priority', 'reason'])
+
+
+def route_label(request) -> str:
+    """The matched URL rule, so path parameters don't explode label cardinality"""
+    rule = getattr(request, 'url_rule', None)
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def init_app(app) -> None:
+    """Register request hooks that time every Flask request"""
+    if not METRICS_ENABLED:
+        return
+
+    from flask import g, got_request_exception, request
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_labels = (request.method, route_label(request))
+        REQUESTS_IN_PROGRESS.labels(*g.metrics_labels).inc()
+        if request.content_length:
+            REQUEST_SIZE.labels(*g.metrics_labels).observe(request.content_length)
+
+    @app.after_request
+    def record_request(response):
+        labels = getattr(g, 'metrics_labels', None)
+        if labels is not None:
+            status = str(response.status_code)
+            elapsed = time.perf_counter() - g.metrics_started
+            REQUESTS.labels(labels[0], labels[1], status).inc()
+            REQUEST_DURATION.labels(labels[0], labels[1], status).observe(elapsed)
+            if response.content_length is not None:
+                RESPONSE_SIZE.labels(*labels).observe(response.content_length)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        labels = g.pop('metrics_labels', None)
+        if labels is not None:
+            REQUESTS_IN_PROGRESS.labels(*labels).dec()
+
+    def record_exception(sender, exception, **extra):
+        # Only exceptions a route didn't handle; handled ones go through observe_exception
+        observe_exception(route_label(request), exception)
+
+    got_request_exception.connect(record_exception, app, weak=False)
+
+
+def observe_exception(route: str, error: BaseException) -> None:
+    """Count an exception that turned into a 5xx response"""
+    if METRICS_ENABLED:
+        HTTP_EXCEPTIONS.labels(route, type(error).__name__).inc()
+
+
+def asgi_route_label(scope) -> str:
+    """The path template of the Starlette route matching scope, like route_label"""
+    from starlette.routing import Match
+
+    for route in getattr(scope.get('app'), 'routes', ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, 'path', 'unmatched')
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the same request metrics as init_app"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not METRICS_ENABLED or scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        from starlette.datastructures import Headers
+
+        labels = (scope['method'], asgi_route_label(scope))
+        started = time.perf_counter()
+        REQUESTS_IN_PROGRESS.labels(*labels).inc()
+        request_size = Headers(scope=scope).get('content-length')
+        if request_size and request_size.isdigit() and int(request_size):
+            REQUEST_SIZE.labels(*labels).observe(int(request_size))
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                status = str(message['status'])
+                REQUESTS.labels(labels[0], labels[1], status).inc()
+                REQUEST_DURATION.labels(labels[0], labels[1], status).observe(time.perf_counter() - started)
+                size = Headers(raw=message['headers']).get('content-length')
+                if size is not None:
+                    RESPONSE_SIZE.labels(*labels).observe(int(size))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            REQUESTS_IN_PROGRESS.labels(*labels).dec()
+
+
+def observe_db_call(backend: str, operation: str, seconds: float,
+                    error: Optional[BaseException] = None) -> None:
+    """Record one storage backend call"""
+    if not METRICS_ENABLED:
+        return
+    DB_DURATION.labels(backend, operation).observe(seconds)
+    if error is not None:
+        DB_ERRORS.labels(backend, operation, type(error).__name__).inc()
+
+
+def observe_db_retry(operation: str) -> None:
+    if METRICS_ENABLED:
+        DB_RETRIES.labels(operation).inc()
+
+
+def observe_db_circuit_rejected(operation: str) -> None:
+    if METRICS_ENABLED:
+        DB_CIRCUIT_REJECTED.labels(operation).inc()
+
+
+def observe_ingest_flush(rows: int, seconds: float) -> None:
+    """Record one ingest queue flush"""
+    if not METRICS_ENABLED:
+        return
+    INGEST_FLUSH_DURATION.observe(seconds)
+    INGEST_FLUSH_ROWS.observe(rows)
+
+
+def observe_webhook_duplicates(layer: str, count: int = 1) -> None:
+    """Count duplicates caught by the in-memory set ('memory') or the unique index ('database')"""
+    if METRICS_ENABLED:
+        WEBHOOK_DUPLICATES.labels(layer).inc(count)
+
+
+def observe_admission_rejected(priority: str, reason: str) -> None:
+    """Count a request rejected with 429/503 (reason: queue_full, deadline, timeout or queue_time)"""
+    if METRICS_ENABLED:
+        ADMISSION_REJECTED.labels(priority, reason).inc()
+
+
+def set_ingest_queue_depth(depth: int) -> None:
+    if METRICS_ENABLED:
+        INGEST_QUEUE_DEPTH.set(depth)
+
+
+class InstrumentedStorage:
+    """Wraps a storage backend and times every call by operation name"""
+
+    def __init__(self, backend, operation_names: Dict[str, str]):
+        self._backend = backend
+        self._operation_names = operation_names
+        self.name = backend.name
+
+    def reset(self) -> None:
+        # Not a database call, so not timed
+        self._backend.reset()
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._backend, attr)
+        if not callable(value) or attr.startswith('_'):
+            return value
+        operation = self._operation_names.get(attr, attr)
+        backend_name = self._backend.name
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                observe_db_call(backend_name, operation, time.perf_counter() - started, e)
+                raise
+            observe_db_call(backend_name, operation, time.perf_counter() - started)
+            return result
+
+        timed.__name__ = attr
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, attr, timed)
+        return timed
+
+
+def render() -> Tuple[bytes, str]:
+    """Metrics in Prometheus text format, aggregated across workers when needed"""
+    if not METRICS_ENABLED:
+        return b'# metrics disabled (prometheus_client not installed or METRICS_ENABLED=false)\n', CONTENT_TYPE_LATEST
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """Clean up a dead worker's live gauges (call from gunicorn's child_exit)"""
+    if METRICS_ENABLED and (os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+One-off migration for rows written by older versions:
+
+1. convert message payloads and user wishlists stored as JSON strings into
+   real JSON objects
+2. fill the columns derived from message payloads (sender_phone,
+   message_type, flow_token) that /messages filters on
+
+Works in batches against the configured storage backend (STORAGE_BACKEND,
+SUPABASE_URL/SUPABASE_KEY or SQLITE_PATH), so it can run against a live
+database. Each batch is one transaction, so an interrupted run leaves no
+half-converted batch behind, and it is safe to re-run. For Supabase, create the convert_json_strings
+and backfill_message_columns functions from supabase_setup.sql first.
+
+Usage:
+    python migrate_payloads.py --batch-size 1000 --pause 0.1
+"""
+
+import argparse
+import time
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Convert string-encoded JSON payloads and backfill message columns')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per table per batch')
+    parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between batches')
+    args = parser.parse_args(argv)
+
+    from app import get_storage
+    db = get_storage()
+
+    total = 0
+    started = time.perf_counter()
+    while True:
+        converted = db.convert_json_strings(args.batch_size)
+        if not converted:
+            break
+        total += converted
+        print(f"🔄 Converted {total} rows so far")
+        time.sleep(args.pause)
+
+    print(f"✅ Converted {total} rows in {time.perf_counter() - started:.1f}s")
+
+    last_id = 0
+    started = time.perf_counter()
+    while True:
+        next_id = db.backfill_message_columns(last_id, args.batch_size)
+        if next_id is None:
+            break
+        last_id = next_id
+        print(f"🔄 Backfilled message columns up to id {last_id}")
+        time.sleep(args.pause)
+
+    print(f"✅ Backfilled message columns in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,368 @@
+"""
+Timeouts, retries and a circuit breaker around storage backend calls.
+
+ResilientStorage wraps a backend (like metrics.InstrumentedStorage) and for
+every call:
+
+- gives the operation a deadline (DB_TIMEOUT_READ, DB_TIMEOUT_WRITE or
+  DB_TIMEOUT_BATCH, or a per-operation value from DB_TIMEOUTS), which the
+  backends apply to their HTTP requests and SQLite statements
+- retries reads, which are idempotent, up to DB_READ_RETRIES times after a
+  transient error, with exponential backoff and full jitter; writes are
+  never retried here
+- fails fast with CircuitOpenError while the circuit breaker is open: after
+  CIRCUIT_FAILURE_THRESHOLD transient failures in a row, calls are rejected
+  for CIRCUIT_RESET_SECONDS, then a single trial call decides whether the
+  circuit closes again
+
+Only transient errors (timeouts, connection errors, 5xx responses, ...)
+count as failures; a constraint violation or a bad query means the database
+is answering. The breaker is shared by every wrapper in the process, so the
+sync and async backends of the ASGI app see the same state.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import math
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+import metrics
+
+DB_TIMEOUT_READ = float(os.getenv('DB_TIMEOUT_READ', '5'))
+DB_TIMEOUT_WRITE = float(os.getenv('DB_TIMEOUT_WRITE', '10'))
+# Migrations and rollup refreshes
+DB_TIMEOUT_BATCH = float(os.getenv('DB_TIMEOUT_BATCH', '60'))
+# Per-operation overrides, e.g. "messages.select=2,users.upsert=15"
+DB_TIMEOUTS = os.getenv('DB_TIMEOUTS', '')
+DB_READ_RETRIES = int(os.getenv('DB_READ_RETRIES', '2'))
+DB_RETRY_BASE_MS = int(os.getenv('DB_RETRY_BASE_MS', '100'))
+DB_RETRY_MAX_MS = int(os.getenv('DB_RETRY_MAX_MS', '2000'))
+# Consecutive transient failures that open the circuit; 0 disables the breaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_SECONDS = float(os.getenv('CIRCUIT_RESET_SECONDS', '30'))
+
+# Actions of storage.OPERATION_NAMES ("<table>.<action>")
+READ_ACTIONS = ('select',)
+BATCH_ACTIONS = ('migrate', 'refresh')
+
+# Postgres SQLSTATE classes/codes and PostgREST codes worth retrying:
+# connection exceptions, insufficient resources, operator intervention
+# (incl. statement timeout), serialization failure, deadlock, and PostgREST
+# failing to reach or pool connections to the database
+TRANSIENT_CODES = ('08', '53', '57', '40001', '40P01', 'PGRST000', 'PGRST001', 'PGRST002', 'PGRST003')
+# SQLite errors worth retrying: another connection holds a lock, or the
+# statement was interrupted at its deadline (like a Postgres statement
+# timeout). Everything else - a missing table, a full or read-only disk, a
+# corrupt file - won't clear up by retrying. Error names need Python 3.11+,
+# the messages cover older versions.
+SQLITE_TRANSIENT_NAMES = ('SQLITE_BUSY', 'SQLITE_LOCKED', 'SQLITE_INTERRUPT')
+SQLITE_TRANSIENT_MESSAGES = ('database is locked', 'database table is locked', 'database schema is locked',
+                             'interrupted')
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar('db_deadline', default=None)
+_rejected: contextvars.ContextVar = contextvars.ContextVar('db_circuit_rejected', default=None)
+_budget: contextvars.ContextVar = contextvars.ContextVar('db_budget', default=None)
+
+
+def parse_timeouts(spec: str) -> Dict[str, float]:
+    """Parse "operation=seconds,..." overrides"""
+    timeouts = {}
+    for part in spec.split(','):
+        if '=' in part:
+            operation, seconds = part.split('=', 1)
+            timeouts[operation.strip()] = float(seconds)
+    return timeouts
+
+
+OPERATION_TIMEOUTS = parse_timeouts(DB_TIMEOUTS)
+
+
+def action_of(operation: str) -> str:
+    return operation.rsplit('.', 1)[-1]
+
+
+def operation_timeout(operation: str) -> float:
+    if operation in OPERATION_TIMEOUTS:
+        return OPERATION_TIMEOUTS[operation]
+    action = action_of(operation)
+    if action in READ_ACTIONS:
+        return DB_TIMEOUT_READ
+    if action in BATCH_ACTIONS:
+        return DB_TIMEOUT_BATCH
+    return DB_TIMEOUT_WRITE
+
+
+def current_timeout() -> Optional[float]:
+    """Seconds left for the backend call in progress, or None outside ResilientStorage"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.001, deadline - time.monotonic())
+
+
+@contextmanager
+def time_budget(seconds: float):
+    """Cut every storage call made inside the block off at most seconds from now"""
+    outer = _budget.get()
+    deadline = time.monotonic() + seconds
+    token = _budget.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+def budget_left() -> Optional[float]:
+    """Seconds left of the enclosing time_budget, or None outside one"""
+    budget = _budget.get()
+    return None if budget is None else budget - time.monotonic()
+
+
+def call_deadline(timeout: float) -> float:
+    deadline = time.monotonic() + timeout
+    budget = _budget.get()
+    return deadline if budget is None else min(deadline, budget)
+
+
+def deadline_passed() -> bool:
+    deadline = _deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def retry_delay(attempt: int) -> float:
+    """Full jitter: uniform in [0, min(max, base * 2^attempt)]"""
+    return random.uniform(0, min(DB_RETRY_MAX_MS, DB_RETRY_BASE_MS * 2 ** attempt)) / 1000.0
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether a failed call may succeed if repeated and says the database is unhealthy"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    module = type(exc).__module__
+    if module.startswith(('httpx', 'httpcore')):
+        return True
+    if module == 'sqlite3':
+        name = getattr(exc, 'sqlite_errorname', None)
+        if name:
+            return name.startswith(SQLITE_TRANSIENT_NAMES)
+        return str(exc).startswith(SQLITE_TRANSIENT_MESSAGES)
+    code = str(getattr(exc, 'code', None) or '')
+    if len(code) == 3 and code.isdigit():
+        return int(code) >= 500
+    if code.startswith(TRANSIENT_CODES):
+        return True
+    # AsyncSupabaseStorage errors: "PostgREST <status>: <body>"
+    return str(exc).startswith('PostgREST 5')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the backend while the circuit is open"""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'Database unavailable, retry in {self.retry_after}s')
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker: closed -> open -> half_open -> closed"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.failure_threshold > 0
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless a call may go through now"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == 'closed':
+                return
+            now = time.monotonic()
+            remaining = self.opened_at + self.reset_timeout - now
+            # Let one trial call through (another one if the last never reported back)
+            if ((self.state == 'open' and remaining <= 0)
+                    or (self.state == 'half_open' and now - self.probe_started > self.reset_timeout)):
+                self.state = 'half_open'
+                self.probe_started = now
+                return
+            self.rejected += 1
+            raise CircuitOpenError(remaining if self.state == 'open' else 1)
+
+    def record_success(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != 'closed':
+                self.state = 'closed'
+                print("✅ Database circuit closed")
+
+    def record_failure(self, error: BaseException) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self.failures += 1
+            self.last_error = f'{type(error).__name__}: {error}'
+            if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                print(f"⚠️ Database circuit opened for {self.reset_timeout:.0f}s after {self.failures} failures: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic() if self.state == 'open' else 0
+            return {
+                'enabled': self.enabled,
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_seconds': self.reset_timeout,
+                'retry_in_seconds': round(max(0.0, retry_in), 1),
+                'trips': self.trips,
+                'rejected': self.rejected,
+                'last_error': self.last_error,
+            }
+
+
+breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+
+
+class ResilientStorage:
+    """Wraps a storage backend (sync or async) with deadlines, read retries and the circuit breaker"""
+
+    def __init__(self, backend, operation_names: Dict[str, str], circuit: Optional[CircuitBreaker] = None):
+        self._backend = backend
+        self._operation_names = operation_names
+        self._breaker = circuit or breaker
+        self.name = backend.name
+
+    def reset(self) -> None:
+        # Not a database call
+        self._backend.reset()
+
+    async def aclose(self) -> None:
+        await self._backend.aclose()
+
+    def _before(self, operation: str) -> None:
+        try:
+            self._breaker.before_call()
+        except CircuitOpenError as e:
+            note_rejected(e)
+            metrics.observe_db_circuit_rejected(operation)
+            raise
+
+    def _after_error(self, error: Exception, operation: str, attempt: int, retries: int) -> bool:
+        """Record a failed attempt; returns True if it should be retried"""
+        if not is_transient(error):
+            # The database answered, so it is healthy
+            self._breaker.record_success()
+            return False
+        self._breaker.record_failure(error)
+        if attempt >= retries:
+            return False
+        metrics.observe_db_retry(operation)
+        return True
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._backend, attr)
+        if not callable(value) or attr.startswith('_'):
+            return value
+        operation = self._operation_names.get(attr, attr)
+        timeout = operation_timeout(operation)
+        retries = DB_READ_RETRIES if action_of(operation) in READ_ACTIONS else 0
+
+        if inspect.iscoroutinefunction(value):
+            async def call(*args, **kwargs):
+                attempt = 0
+                while True:
+                    self._before(operation)
+                    token = _deadline.set(call_deadline(timeout))
+                    try:
+                        result = await value(*args, **kwargs)
+                    except Exception as e:
+                        if not self._after_error(e, operation, attempt, retries):
+                            raise
+                    else:
+                        self._breaker.record_success()
+                        return result
+                    finally:
+                        _deadline.reset(token)
+                    await asyncio.sleep(retry_delay(attempt))
+                    attempt += 1
+        else:
+            def call(*args, **kwargs):
+                attempt = 0
+                while True:
+                    self._before(operation)
+                    token = _deadline.set(call_deadline(timeout))
+                    try:
+                        result = value(*args, **kwargs)
+                    except Exception as e:
+                        if not self._after_error(e, operation, attempt, retries):
+                            raise
+                    else:
+                        self._breaker.record_success()
+                        return result
+                    finally:
+                        _deadline.reset(token)
+                    time.sleep(retry_delay(attempt))
+                    attempt += 1
+
+        call.__name__ = attr
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, attr, call)
+        return call
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """Whether a data function failed because the database is down (so cached data may be served)"""
+    return isinstance(error, CircuitOpenError) or is_transient(error)
+
+
+def note_rejected(error: CircuitOpenError) -> None:
+    """Remember in the current context that the breaker rejected a call"""
+    _rejected.set(error.retry_after)
+
+
+def rejected_retry_after() -> Optional[int]:
+    """Retry-After seconds if the breaker rejected a call in the current context"""
+    return _rejected.get()
+
+
+def init_app(app) -> None:
+    """Turn error responses of requests the circuit breaker rejected into 503 with Retry-After"""
+    if not breaker.enabled:
+        return
+
+    @app.before_request
+    def clear_circuit_rejection():
+        _rejected.set(None)
+
+    @app.after_request
+    def circuit_open_response(response):
+        retry_after = rejected_retry_after()
+        if retry_after is not None and response.status_code == 500:
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+        return response
@@ -0,0 +1,67 @@
+"""
+JSON encoding for API responses and storage.
+
+Uses orjson when it is installed and falls back to the json module
+otherwise. FastJSONProvider plugs the same encoder into Flask's jsonify.
+"""
+
+import json
+from typing import Any, Union
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # Datetimes and dataclasses go through the default hook so output matches
+    # Flask's own provider
+    ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                      | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """Encode to compact UTF-8 JSON, falling back to str() for unknown types"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, default=str, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def dumps(obj: Any) -> str:
+    """Encode to a compact JSON string"""
+    return dumps_bytes(obj).decode('utf-8')
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Decode JSON from a string or bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson, with the default provider as fallback"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = ORJSON_OPTIONS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
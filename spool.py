@@ -0,0 +1,376 @@
+"""
+Durable on-disk spool for webhook messages.
+
+Each process appends rows to its own directory under the spool root as
+length + CRC32 framed JSON records in numbered segment files, and fsyncs
+before the webhook is acknowledged. Concurrent writers share one fsync
+(group commit). A background replay thread writes spooled rows to the
+database in batches and records how far it got in a checkpoint file, so a
+restart resumes where it stopped; fully replayed segments are deleted.
+
+A process holds an flock on its directory while it runs. Directories whose
+lock is free belong to a process that exited or crashed, and are adopted
+and drained by whichever process finds them first.
+
+Replaying a batch again after a crash is harmless because message inserts
+skip wamids that are already stored.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import serialization
+
+HEADER = struct.Struct('<II')  # payload length, CRC32 of the payload
+SEGMENT_SUFFIX = '.seg'
+LOCK_FILE = '.lock'
+CHECKPOINT_FILE = 'checkpoint'
+
+
+def segment_name(number: int) -> str:
+    return f'{number:012d}{SEGMENT_SUFFIX}'
+
+
+def list_segments(directory: str) -> List[int]:
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                  if name.endswith(SEGMENT_SUFFIX))
+
+
+def fsync_dir(directory: str) -> None:
+    """Persist file creations/renames in a directory"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_checkpoint(directory: str) -> Tuple[int, int]:
+    """(segment number, byte offset) of the first record not yet replayed"""
+    try:
+        with open(os.path.join(directory, CHECKPOINT_FILE)) as f:
+            data = json.load(f)
+        return int(data['segment']), int(data['offset'])
+    except (OSError, ValueError, KeyError):
+        return 0, 0
+
+
+def write_checkpoint(directory: str, segment: int, offset: int) -> None:
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'segment': segment, 'offset': offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_records(path: str, offset: int, limit: int, end: Optional[int] = None) -> Tuple[List[Any], int, bool]:
+    """Decode up to limit records from offset.
+
+    Returns (rows, next offset, corrupt). Stops quietly at an incomplete
+    record (still being written), and reports corrupt on a CRC mismatch.
+    """
+    rows: List[Any] = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while len(rows) < limit and (end is None or offset < end):
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            if zlib.crc32(payload) != crc:
+                return rows, offset, True
+            try:
+                rows.append(serialization.loads(payload))
+            except ValueError:
+                return rows, offset, True
+            offset += HEADER.size + length
+    return rows, offset, False
+
+
+class Spool:
+    """Append-only segment spool with a background replay thread"""
+
+    def __init__(self, root: str, write_batch: Callable[[List[Dict[str, Any]]], None],
+                 segment_bytes: int = 16 * 1024 * 1024, fsync: str = 'always',
+                 fsync_interval: float = 0.05, batch_size: int = 100,
+                 poll_interval: float = 0.2, adopt_interval: float = 10.0,
+                 max_backoff: float = 30.0):
+        self.root = root
+        self.write_batch = write_batch
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval
+        self.adopt_interval = adopt_interval
+        self.max_backoff = max_backoff
+
+        self._pid: Optional[int] = None
+        self._init_lock = threading.Lock()
+        self.appended = 0
+        self.replayed = 0
+        self.fsyncs = 0
+        self.replay_errors = 0
+        self.corrupt_segments = 0
+        self.adopted = 0
+        self.last_error: Optional[str] = None
+
+    # Writing
+
+    def start(self) -> None:
+        """Create this process's directory, lock and replay thread (again, after a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._init_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._sync_lock = threading.Lock()
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._stats_lock = threading.Lock()
+
+            os.makedirs(self.root, exist_ok=True)
+            self.directory = os.path.join(self.root, f'{os.getpid()}-{time.time_ns()}')
+            os.makedirs(self.directory)
+            self._lock_fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            fsync_dir(self.root)
+
+            self._segment = 0
+            self._fd = self._open_segment(self._segment)
+            self._size = 0
+            self._seq = 0
+            self._synced_seq = 0
+            self._last_sync = time.monotonic()
+
+            self._thread = threading.Thread(target=self._run, name='spool-replay', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _open_segment(self, number: int) -> int:
+        fd = os.open(os.path.join(self.directory, segment_name(number)),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fsync_dir(self.directory)
+        return fd
+
+    def append(self, row: Dict[str, Any]) -> bool:
+        """Spool a row; durable on return when fsync='always'. Returns False if it couldn't be written."""
+        payload = serialization.dumps_bytes(row)
+        record = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        try:
+            self.start()
+            with self._lock:
+                written = 0
+                try:
+                    while written < len(record):
+                        written += os.write(self._fd, record[written:])
+                except OSError:
+                    # Cut off a partial record (e.g. disk full) so the segment stays readable
+                    if written:
+                        os.ftruncate(self._fd, self._size)
+                    raise
+                self._size += len(record)
+                self._seq += 1
+                seq = self._seq
+                if self._size >= self.segment_bytes:
+                    self._roll()
+            if self.fsync == 'always':
+                self._sync(seq)
+            elif time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync(seq)
+        except OSError as e:
+            self.last_error = str(e)
+            print(f"❌ Spool write failed: {e}")
+            return False
+
+        with self._stats_lock:
+            self.appended += 1
+        self._wake.set()
+        return True
+
+    def _roll(self) -> None:
+        """Seal the current segment and start the next one (caller holds _lock)"""
+        os.fdatasync(self._fd)
+        os.close(self._fd)
+        self._synced_seq = self._seq
+        self._segment += 1
+        self._fd = self._open_segment(self._segment)
+        self._size = 0
+
+    def _sync(self, seq: int) -> None:
+        """fdatasync up to record seq; one call covers every writer waiting on it"""
+        with self._sync_lock:
+            if self._synced_seq >= seq:
+                return
+            with self._lock:
+                os.fdatasync(self._fd)
+                self._synced_seq = self._seq
+            self._last_sync = time.monotonic()
+            with self._stats_lock:
+                self.fsyncs += 1
+
+    # Replay
+
+    def _drain(self, directory: str, own: bool) -> bool:
+        """Replay one batch from a directory; returns True if anything was replayed"""
+        segment, offset = read_checkpoint(directory)
+        for number in list_segments(directory):
+            if number < segment:
+                continue
+            if number > segment:
+                segment, offset = number, 0
+            path = os.path.join(directory, segment_name(number))
+            with self._lock if own else nullcontext():
+                # Only complete records of the segment being appended to
+                active = own and number == self._segment
+                end = self._size if active else None
+            rows, next_offset, corrupt = read_records(path, offset, self.batch_size, end)
+
+            if rows:
+                self.write_batch(rows)
+                write_checkpoint(directory, number, next_offset)
+                with self._stats_lock:
+                    self.replayed += len(rows)
+                return True
+
+            if active:
+                return False
+            if corrupt:
+                # A torn write at the tail of a crashed process's segment
+                with self._stats_lock:
+                    self.corrupt_segments += 1
+                print(f"⚠️ Skipping corrupt spool data in {path} at offset {next_offset}")
+            # Sealed segment fully replayed
+            os.unlink(path)
+            write_checkpoint(directory, number + 1, 0)
+            segment, offset = number + 1, 0
+        return False
+
+    def _adopt_orphans(self) -> None:
+        """Drain and remove directories of processes that no longer hold their lock"""
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            directory = os.path.join(self.root, name)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            try:
+                fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # owner is alive
+                if not os.path.isdir(directory):
+                    continue  # drained by another process meanwhile
+                while not self._stop.is_set() and self._drain(directory, own=False):
+                    pass
+                if not list_segments(directory):
+                    shutil.rmtree(directory, ignore_errors=True)
+                    with self._stats_lock:
+                        self.adopted += 1
+                    print(f"✅ Replayed orphaned spool {name}")
+            finally:
+                os.close(fd)
+
+    def _run(self) -> None:
+        backoff = 0.0
+        next_adopt = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                if self.fsync != 'always' and self._synced_seq < self._seq:
+                    self._sync(self._seq)
+                if time.monotonic() >= next_adopt:
+                    self._adopt_orphans()
+                    next_adopt = time.monotonic() + self.adopt_interval
+                progressed = self._drain(self.directory, own=True)
+                backoff = 0.0
+            except Exception as e:
+                with self._stats_lock:
+                    self.replay_errors += 1
+                self.last_error = str(e)
+                backoff = min(self.max_backoff, max(0.5, backoff * 2))
+                print(f"⚠️ Spool replay failed, retrying in {backoff:.1f}s: {e}")
+                self._stop.wait(backoff)
+                continue
+            if not progressed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop replaying, try one last drain and release the directory"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        try:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and self._drain(self.directory, own=True):
+                pass
+        except Exception as e:
+            print(f"⚠️ Spool left {self.directory} for the next process to replay: {e}")
+        with self._lock:
+            os.fdatasync(self._fd)
+            os.close(self._fd)
+            self._segment += 1  # nothing is active any more
+        if self._drain_finished():
+            shutil.rmtree(self.directory, ignore_errors=True)
+        os.close(self._lock_fd)
+        self._pid = None
+
+    def _drain_finished(self) -> bool:
+        segment, offset = read_checkpoint(self.directory)
+        for number in list_segments(self.directory):
+            size = os.path.getsize(os.path.join(self.directory, segment_name(number)))
+            if number > segment or (number == segment and offset < size):
+                return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        pending_segments = 0
+        pending_bytes = 0
+        try:
+            for name in os.listdir(self.root):
+                directory = os.path.join(self.root, name)
+                if not os.path.isdir(directory):
+                    continue
+                segment, offset = read_checkpoint(directory)
+                for number in list_segments(directory):
+                    size = os.path.getsize(os.path.join(directory, segment_name(number)))
+                    pending_segments += 1
+                    pending_bytes += size - offset if number == segment else size
+        except OSError:
+            pass
+        with self._init_lock:
+            return {
+                'directory': self.root,
+                'fsync': self.fsync,
+                'pending_segments': pending_segments,
+                'pending_bytes': max(0, pending_bytes),
+                'appended': self.appended,
+                'replayed': self.replayed,
+                'fsyncs': self.fsyncs,
+                'replay_errors': self.replay_errors,
+                'corrupt_segments': self.corrupt_segments,
+                'adopted_directories': self.adopted,
+                'last_error': self.last_error,
+            }
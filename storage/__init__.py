@@ -0,0 +1,25 @@
+"""
+Storage backends for the WhatsApp Flow API.
+
+Every data function in app.py goes through a StorageBackend, so the service
+can run against Supabase or against a local SQLite database.
+"""
+
+from storage.base import (MESSAGE_COLUMNS, MESSAGE_FILTER_COLUMNS, OPERATION_NAMES, WISHLIST_STATUSES,
+                          StorageBackend)
+
+
+def create_storage(name: str, **options) -> StorageBackend:
+    """Create the storage backend selected by configuration"""
+    name = (name or 'supabase').lower()
+    if name == 'supabase':
+        from storage.supabase_backend import SupabaseStorage
+        return SupabaseStorage(options['url'], options['key'], client=options.get('client'))
+    if name == 'sqlite':
+        from storage.sqlite_backend import SQLiteStorage
+        return SQLiteStorage(options.get('path') or 'whatsapp_flow.db')
+    raise ValueError(f"Unknown storage backend: {name}. Use 'supabase' or 'sqlite'.")
+
+
+__all__ = ['MESSAGE_COLUMNS', 'MESSAGE_FILTER_COLUMNS', 'OPERATION_NAMES', 'WISHLIST_STATUSES', 'StorageBackend',
+           'create_storage']
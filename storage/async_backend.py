@@ -0,0 +1,228 @@
+"""
+Async storage backends for the ASGI app (asgi_app.py).
+
+AsyncSupabaseStorage talks to PostgREST directly over one shared
+httpx.AsyncClient, so concurrent requests reuse a keep-alive connection pool
+instead of blocking a worker each. ThreadedAsyncStorage adapts a synchronous
+backend (SQLite) by running its calls in worker threads.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import serialization
+from resilience import CircuitOpenError, current_timeout, note_rejected
+from storage.base import MESSAGE_FILTER_COLUMNS, group_by_keys
+
+
+def in_filter(values: Sequence[Any]) -> str:
+    """PostgREST in.(...) filter; values are quoted so commas and parentheses are safe"""
+    quoted = ('"{}"'.format(str(v).replace('\\', '\\\\').replace('"', '\\"')) for v in values)
+    return 'in.({})'.format(','.join(quoted))
+
+
+class ThreadedAsyncStorage:
+    """Runs every call of a synchronous backend in a worker thread"""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._backend, attr)
+        if not callable(value) or attr.startswith('_'):
+            return value
+
+        async def threaded(*args, **kwargs):
+            try:
+                return await asyncio.to_thread(value, *args, **kwargs)
+            except CircuitOpenError as e:
+                # Recorded in the worker thread's copy of the context only
+                note_rejected(e)
+                raise
+
+        threaded.__name__ = attr
+        setattr(self, attr, threaded)
+        return threaded
+
+    async def aclose(self) -> None:
+        pass
+
+
+class AsyncSupabaseStorage:
+    """PostgREST storage over a pooled httpx.AsyncClient, created on first use"""
+
+    name = 'supabase'
+
+    def __init__(self, url: str, key: str, max_connections: int = 100,
+                 max_keepalive_connections: int = 100, timeout: float = 10.0):
+        self.rest_url = url.rstrip('/') + '/rest/v1'
+        self.key = key
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.timeout = timeout
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                base_url=self.rest_url,
+                headers={
+                    'apikey': self.key,
+                    'Authorization': f'Bearer {self.key}',
+                    'Content-Type': 'application/json',
+                },
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive_connections),
+                timeout=self.timeout,
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method: str, table: str, params: Any = None,
+                      json: Any = None, prefer: Optional[str] = None) -> Any:
+        """Send one PostgREST request and return the decoded JSON body"""
+        headers = {'Prefer': prefer} if prefer else None
+        content = serialization.dumps_bytes(json) if json is not None else None
+        # Bounded by the time left for the backend call (see resilience.py)
+        timeout = current_timeout()
+        extra = {'timeout': timeout} if timeout is not None else {}
+        response = await self.client.request(method, f'/{table}', params=params, content=content,
+                                             headers=headers, **extra)
+        if response.status_code >= 400:
+            raise Exception(f"PostgREST {response.status_code}: {response.text}")
+        if not response.content:
+            return None
+        return serialization.loads(response.content)
+
+    async def ping(self) -> None:
+        await self.request('GET', 'users', {'select': 'id', 'limit': 1})
+
+    async def insert_messages(self, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        # Redelivered messages hit the unique wamid index and are skipped;
+        # only the ids of inserted rows come back
+        inserted = await self.request('POST', 'messages', {'on_conflict': 'wamid', 'select': 'id'}, json=rows,
+                                      prefer='resolution=ignore-duplicates,return=representation')
+        return len(inserted or [])
+
+    async def list_messages(self, limit: Optional[int] = None, after: Optional[Tuple[str, int]] = None,
+                            filters: Optional[Dict[str, str]] = None,
+                            columns: Optional[Sequence[str]] = None) -> List[dict]:
+        params: List[Tuple[str, Any]] = [('select', ','.join(columns) if columns else '*'),
+                                         ('order', 'timestamp.desc,id.desc')]
+        filters = filters or {}
+        for column in MESSAGE_FILTER_COLUMNS:
+            if filters.get(column):
+                params.append((column, f'eq.{filters[column]}'))
+        if filters.get('since'):
+            params.append(('timestamp', f'gte.{filters["since"]}'))
+        if filters.get('until'):
+            params.append(('timestamp', f'lt.{filters["until"]}'))
+        if after:
+            ts, last_id = after
+            params.append(('or', f'(timestamp.lt."{ts}",and(timestamp.eq."{ts}",id.lt.{int(last_id)}))'))
+        if limit is not None:
+            params.append(('limit', limit))
+        return await self.request('GET', 'messages', params)
+
+    async def get_message(self, message_id: int) -> Optional[dict]:
+        rows = await self.request('GET', 'messages', {'select': '*', 'id': f'eq.{int(message_id)}'})
+        return rows[0] if rows else None
+
+    async def get_user(self, phone: str) -> Optional[dict]:
+        rows = await self.request('GET', 'users', {'select': '*', 'phone': f'eq.{phone}'})
+        return rows[0] if rows else None
+
+    async def get_users(self, phones: Sequence[str], columns: Optional[Sequence[str]] = None) -> List[dict]:
+        if not phones:
+            return []
+        return await self.request('GET', 'users', {'select': ','.join(columns) if columns else '*',
+                                                   'phone': in_filter(phones)})
+
+    async def upsert_users(self, rows: List[Dict[str, Any]]) -> List[dict]:
+        if not rows:
+            return []
+        # PostgREST needs the same keys in every row of a bulk upsert
+        saved = []
+        for group in group_by_keys(rows):
+            saved.extend(await self.request('POST', 'users', {'on_conflict': 'phone'}, json=group,
+                                            prefer='resolution=merge-duplicates,return=representation'))
+        return saved
+
+    async def list_users(self, limit: Optional[int] = None, after_id: Optional[int] = None,
+                         columns: Optional[Sequence[str]] = None) -> List[dict]:
+        params: Dict[str, Any] = {'select': ','.join(columns) if columns else '*', 'order': 'id.asc'}
+        if after_id is not None:
+            params['id'] = f'gt.{int(after_id)}'
+        if limit is not None:
+            params['limit'] = limit
+        return await self.request('GET', 'users', params)
+
+    async def table_version(self, name: str) -> Optional[Any]:
+        rows = await self.request('GET', 'table_versions', {'select': 'version', 'name': f'eq.{name}'})
+        return rows[0]['version'] if rows else None
+
+    async def users_version(self) -> Optional[Any]:
+        return await self.table_version('users')
+
+    async def messages_version(self) -> Optional[Any]:
+        return await self.table_version('messages')
+
+    async def add_wishlist_item(self, phone: str, item: Dict[str, Any]) -> dict:
+        return await self.request('POST', 'rpc/wishlist_add_item', json={'p_phone': phone, 'p_item': item})
+
+    async def remove_wishlist_item(self, phone: str, item_id: Optional[str] = None,
+                                   item_name: Optional[str] = None) -> dict:
+        return await self.request('POST', 'rpc/wishlist_remove_item',
+                                  json={'p_phone': phone, 'p_item_id': item_id, 'p_item_name': item_name})
+
+    async def set_wishlist_item_status(self, phone: str, status: str, item_id: Optional[str] = None,
+                                       item_name: Optional[str] = None) -> dict:
+        return await self.request('POST', 'rpc/wishlist_set_item_status',
+                                  json={'p_phone': phone, 'p_status': status,
+                                        'p_item_id': item_id, 'p_item_name': item_name})
+
+    async def apply_flow_changes(self, phone: str, profile: Optional[Dict[str, str]] = None,
+                                 add: Sequence[Dict[str, Any]] = (),
+                                 remove: Sequence[Dict[str, Any]] = ()) -> Optional[dict]:
+        return await self.request('POST', 'rpc/flow_apply_changes',
+                                  json={'p_phone': phone, 'p_profile': profile,
+                                        'p_add': list(add), 'p_remove': list(remove)})
+
+    async def get_flow_session(self, flow_token: str, max_age_seconds: int) -> Optional[dict]:
+        since = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+        rows = await self.request('GET', 'flow_sessions', [('select', 'session,version'),
+                                                           ('flow_token', f'eq.{flow_token}'),
+                                                           ('updated_at', f'gte.{since.isoformat()}')])
+        return rows[0] if rows else None
+
+    async def save_flow_session(self, flow_token: str, session: Dict[str, Any], version: Optional[int],
+                                max_age_seconds: int) -> Optional[int]:
+        return await self.request('POST', 'rpc/flow_save_session',
+                                  json={'p_flow_token': flow_token, 'p_session': session, 'p_version': version,
+                                        'p_max_age_seconds': int(max_age_seconds)})
+
+    async def refresh_message_rollups(self, batch_size: int, settle_seconds: int = 60) -> int:
+        processed = await self.request('POST', 'rpc/refresh_message_rollups',
+                                       json={'batch_size': int(batch_size), 'settle_seconds': int(settle_seconds)})
+        return int(processed or 0)
+
+    async def message_stats(self, since: Optional[str] = None, until: Optional[str] = None, top: int = 100) -> dict:
+        return await self.request('POST', 'rpc/message_stats',
+                                  json={'p_since': since, 'p_until': until, 'p_top': int(top)})
+
+    async def list_menu_items(self) -> List[dict]:
+        return await self.request('GET', 'menu_items', {'select': '*', 'order': 'display_order.asc'})
+
+    async def list_primary_input_fields(self) -> List[dict]:
+        return await self.request('GET', 'primary_input_field',
+                                  {'select': 'no,field_name,created_at', 'order': 'no.asc'})
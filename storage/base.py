@@ -0,0 +1,222 @@
+"""
+Storage backend interface.
+
+Backends return plain table rows (dicts) with JSON columns decoded. Rows
+written by older versions may still hold JSON strings until
+migrate_payloads.py has converted them; app.py decodes those on read.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Indexed messages columns derived from the payload at ingest
+MESSAGE_FILTER_COLUMNS = ('sender_phone', 'message_type', 'flow_token')
+MESSAGE_COLUMNS = ('id', 'data', 'wamid', 'sender_phone', 'message_type', 'flow_token', 'timestamp', 'created_at')
+
+# Status values of a wishlist item (prd.txt FR-3)
+WISHLIST_STATUSES = ('Pending', 'Bought')
+
+# "<table>.<action>" name of each backend method, used for timing and error metrics
+OPERATION_NAMES = {
+    'ping': 'users.select',
+    'insert_messages': 'messages.insert',
+    'list_messages': 'messages.select',
+    'get_message': 'messages.select',
+    'list_messages_before': 'messages.select',
+    'delete_messages': 'messages.delete',
+    'messages_version': 'table_versions.select',
+    'get_user': 'users.select',
+    'get_users': 'users.select',
+    'upsert_users': 'users.upsert',
+    'list_users': 'users.select',
+    'users_version': 'table_versions.select',
+    'add_wishlist_item': 'users.patch',
+    'remove_wishlist_item': 'users.patch',
+    'set_wishlist_item_status': 'users.patch',
+    'apply_flow_changes': 'users.upsert',
+    'get_flow_session': 'flow_sessions.select',
+    'save_flow_session': 'flow_sessions.upsert',
+    'refresh_message_rollups': 'message_rollups.refresh',
+    'message_stats': 'message_rollups.select',
+    'list_menu_items': 'menu_items.select',
+    'list_primary_input_fields': 'primary_input_field.select',
+    'convert_json_strings': 'json.migrate',
+    'backfill_message_columns': 'messages.migrate',
+}
+
+
+def wishlist_item_index(items: Any, item_id: Optional[str], item_name: Optional[str]) -> Optional[int]:
+    """Position of the item with item_id, or named item_name (case-insensitive) when no id is given.
+
+    Plain string items written by older versions match by name.
+    """
+    if not isinstance(items, list):
+        return None
+    for index, item in enumerate(items):
+        if isinstance(item, dict):
+            if item_id is not None:
+                if item.get('item_id') == item_id:
+                    return index
+                continue
+            name = item.get('item_name')
+        else:
+            if item_id is not None:
+                continue
+            name = item
+        if isinstance(name, str) and item_name is not None and name.lower() == item_name.lower():
+            return index
+    return None
+
+
+def group_by_keys(rows: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Rows grouped by their set of keys, in first-seen order, for bulk writes that need one column list"""
+    groups: Dict[frozenset, List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(frozenset(row), []).append(row)
+    return list(groups.values())
+
+
+class StorageBackend:
+    """Operations the API needs from its database"""
+
+    name = 'base'
+
+    def reset(self) -> None:
+        """Drop open clients/connections so they are re-created on next use (e.g. after a fork)"""
+
+    def ping(self) -> None:
+        """Run a cheap query, raising if the database can't be reached"""
+        raise NotImplementedError
+
+    # Messages
+
+    def insert_messages(self, rows: List[Dict[str, Any]]) -> int:
+        """Insert message rows in one statement, skipping wamids already stored; returns rows inserted"""
+        raise NotImplementedError
+
+    def list_messages(self, limit: Optional[int] = None, after: Optional[Tuple[str, int]] = None,
+                      filters: Optional[Dict[str, str]] = None,
+                      columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Messages ordered newest first by (timestamp, id), starting after a keyset cursor.
+
+        filters may hold MESSAGE_FILTER_COLUMNS (exact match) and since/until
+        (timestamp >= since, timestamp < until).
+        """
+        raise NotImplementedError
+
+    def get_message(self, message_id: int) -> Optional[dict]:
+        """One message row by id"""
+        raise NotImplementedError
+
+    def list_messages_before(self, before: str, limit: int, after: Optional[Tuple[str, int]] = None) -> List[dict]:
+        """Up to limit full message rows with timestamp < before, oldest first by (timestamp, id), after a cursor"""
+        raise NotImplementedError
+
+    def delete_messages(self, ids: Sequence[int]) -> int:
+        """Delete messages by id; returns rows deleted"""
+        raise NotImplementedError
+
+    def messages_version(self) -> Optional[Any]:
+        """Counter bumped by every insert, update and delete of messages, or None when it isn't set up"""
+        raise NotImplementedError
+
+    # Users
+
+    def get_user(self, phone: str) -> Optional[dict]:
+        """One user row by phone"""
+        raise NotImplementedError
+
+    def get_users(self, phones: Sequence[str], columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Rows of the users among phones that exist, in one query, with optional column projection"""
+        raise NotImplementedError
+
+    def upsert_users(self, rows: List[Dict[str, Any]]) -> List[dict]:
+        """Insert or update users by phone and return the saved rows.
+
+        Each row only sets the columns it has, so rows may carry different keys.
+        """
+        raise NotImplementedError
+
+    def list_users(self, limit: Optional[int] = None, after_id: Optional[int] = None,
+                   columns: Optional[Sequence[str]] = None) -> List[dict]:
+        """Users ordered by id, starting after after_id, with optional column projection"""
+        raise NotImplementedError
+
+    def users_version(self) -> Optional[Any]:
+        """Counter bumped by every write to users, or None when it isn't set up"""
+        raise NotImplementedError
+
+    # Wishlist items
+    #
+    # Each call changes one item of users.wishlist atomically and returns
+    # {'result': ..., 'item': ...} where result is one of added, updated,
+    # removed, duplicate, user_not_found or item_not_found.
+
+    def add_wishlist_item(self, phone: str, item: Dict[str, Any]) -> dict:
+        """Append an item unless one with the same name is already listed"""
+        raise NotImplementedError
+
+    def remove_wishlist_item(self, phone: str, item_id: Optional[str] = None,
+                             item_name: Optional[str] = None) -> dict:
+        """Remove the item with item_id (or item_name)"""
+        raise NotImplementedError
+
+    def set_wishlist_item_status(self, phone: str, status: str, item_id: Optional[str] = None,
+                                 item_name: Optional[str] = None) -> dict:
+        """Set the status of the item with item_id (or item_name)"""
+        raise NotImplementedError
+
+    # WhatsApp Flow
+
+    def apply_flow_changes(self, phone: str, profile: Optional[Dict[str, str]] = None,
+                           add: Sequence[Dict[str, Any]] = (), remove: Sequence[Dict[str, Any]] = ()) -> Optional[dict]:
+        """Save one flow request's changes to a user in a single transaction and return the saved row.
+
+        profile ({parent_name, child_name}) creates or renames the user. The
+        remove refs ({item_id, item_name}) are removed, then the add items
+        are appended unless their item_id or name is already listed, so a
+        replay of the same changes leaves the row as it is. Returns None when
+        the user doesn't exist and no profile is given.
+        """
+        raise NotImplementedError
+
+    def get_flow_session(self, flow_token: str, max_age_seconds: int) -> Optional[dict]:
+        """{session, version} of a flow token saved less than max_age_seconds ago"""
+        raise NotImplementedError
+
+    def save_flow_session(self, flow_token: str, session: Dict[str, Any], version: Optional[int],
+                          max_age_seconds: int) -> Optional[int]:
+        """Store a session if it is still at version (None for a new token); returns the new version or None.
+
+        Sessions idle for more than max_age_seconds are deleted.
+        """
+        raise NotImplementedError
+
+    # Message rollups
+
+    def refresh_message_rollups(self, batch_size: int, settle_seconds: int = 60) -> int:
+        """Fold the next batch_size messages after the rollup watermark into the rollups; returns how many (0 once caught up)"""
+        raise NotImplementedError
+
+    def message_stats(self, since: Optional[str] = None, until: Optional[str] = None, top: int = 100) -> dict:
+        """Totals, hourly counts, top senders and message types from the rollups, plus the watermark"""
+        raise NotImplementedError
+
+    # Reference tables
+
+    def list_menu_items(self) -> List[dict]:
+        """Menu items ordered by display_order"""
+        raise NotImplementedError
+
+    def list_primary_input_fields(self) -> List[dict]:
+        """Primary input fields ordered by no"""
+        raise NotImplementedError
+
+    # Migrations
+
+    def backfill_message_columns(self, after_id: int, batch_size: int) -> Optional[int]:
+        """Fill the derived message columns of the next batch_size rows after after_id; returns the last id or None when done"""
+        raise NotImplementedError
+
+    def convert_json_strings(self, batch_size: int) -> int:
+        """Convert up to batch_size string-encoded JSON values per table into objects; returns rows converted"""
+        raise NotImplementedError
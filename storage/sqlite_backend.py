@@ -0,0 +1,652 @@
+"""
+SQLite storage backend.
+
+Uses the same tables and indexes as supabase_setup.sql, adapted to SQLite
+types. The database runs in WAL mode so readers don't block the writer, and
+each thread keeps its own connection with a statement cache, so the fixed
+SQL strings below are compiled once per connection and reused.
+
+SQLite has no JSONB type, so the JSON columns (messages.data, users.wishlist)
+are encoded to TEXT on write and decoded on read; callers see the same
+objects the Supabase backend returns.
+"""
+
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import serialization
+from resilience import deadline_passed
+from storage.base import MESSAGE_COLUMNS, MESSAGE_FILTER_COLUMNS, StorageBackend, group_by_keys, wishlist_item_index
+
+NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now')"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data TEXT NOT NULL,
+    wamid TEXT,
+    sender_phone TEXT,
+    message_type TEXT,
+    flow_token TEXT,
+    timestamp TEXT DEFAULT ({NOW}),
+    created_at TEXT DEFAULT ({NOW})
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    phone VARCHAR(20) UNIQUE NOT NULL,
+    parent_name VARCHAR(255) NOT NULL,
+    child_name VARCHAR(255) NOT NULL,
+    wishlist TEXT DEFAULT '[]',
+    created_at TEXT DEFAULT ({NOW}),
+    updated_at TEXT DEFAULT ({NOW})
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
+
+-- (timestamp, id) so keyset pages on messages are a single index range scan
+CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp, id);
+
+-- /stats rollups, maintained from messages past the rollup_state watermark
+CREATE TABLE IF NOT EXISTS message_rollups (
+    dimension TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL DEFAULT '',
+    messages INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, bucket, key)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL DEFAULT 0,
+    refreshed_at TEXT
+);
+
+INSERT INTO rollup_state (name) VALUES ('messages') ON CONFLICT (name) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS menu_items (
+    id VARCHAR(50) PRIMARY KEY,
+    title VARCHAR(255) NOT NULL,
+    display_order INTEGER DEFAULT 0,
+    created_at TEXT DEFAULT ({NOW}),
+    updated_at TEXT DEFAULT ({NOW})
+);
+
+CREATE INDEX IF NOT EXISTS idx_menu_items_display_order ON menu_items(display_order);
+
+INSERT INTO menu_items (id, title, display_order) VALUES
+    ('ADD', '➕ Add to Wishlist', 1),
+    ('VIEW', '📄 View Wishlist', 2),
+    ('REMOVE', '❌ Remove from Wishlist', 3)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS primary_input_field (
+    no INTEGER PRIMARY KEY,
+    field_name VARCHAR(255) NOT NULL,
+    created_at TEXT DEFAULT ({NOW})
+);
+
+INSERT INTO primary_input_field (no, field_name) VALUES
+    (1, 'parent_01'),
+    (2, 'child_01'),
+    (3, 'child_02')
+ON CONFLICT (no) DO NOTHING;
+
+-- Versions behind the /users and /messages ETags: bumped by every write to
+-- the table, so they move even when two writes share a timestamp, and on
+-- backdated inserts and deletes
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO table_versions (name) VALUES ('users'), ('messages') ON CONFLICT (name) DO NOTHING;
+
+-- WhatsApp Flow sessions not saved to users yet (no phone, or the profile
+-- isn't complete), shared by every worker; version guards concurrent saves
+CREATE TABLE IF NOT EXISTS flow_sessions (
+    flow_token TEXT PRIMARY KEY,
+    session TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TEXT DEFAULT ({NOW})
+);
+
+CREATE INDEX IF NOT EXISTS idx_flow_sessions_updated_at ON flow_sessions(updated_at);
+
+CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'users';
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_version_insert AFTER INSERT ON messages
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'messages';
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_version_update AFTER UPDATE ON messages
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'messages';
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_version_delete AFTER DELETE ON messages
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = 'messages';
+END;
+"""
+
+# Columns added after the first release, created on databases that predate them
+ADDED_COLUMNS = (
+    ('messages', 'wamid', 'TEXT'),
+    ('messages', 'sender_phone', 'TEXT'),
+    ('messages', 'message_type', 'TEXT'),
+    ('messages', 'flow_token', 'TEXT'),
+)
+
+# Indexes on added columns run after those columns exist
+INDEXES = """
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_wamid ON messages(wamid);
+-- Filtered /messages pages are a range scan on (filter, timestamp, id)
+CREATE INDEX IF NOT EXISTS idx_messages_sender_phone ON messages(sender_phone, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_messages_message_type ON messages(message_type, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_messages_flow_token ON messages(flow_token, timestamp, id);
+"""
+
+MESSAGE_WRITE_COLUMNS = ('data', 'wamid', 'sender_phone', 'message_type', 'flow_token', 'timestamp')
+USER_COLUMNS = ('id', 'phone', 'parent_name', 'child_name', 'wishlist', 'created_at', 'updated_at')
+# updated_at is always set from the database clock
+USER_WRITE_COLUMNS = ('phone', 'parent_name', 'child_name', 'wishlist')
+JSON_COLUMNS = ('data', 'wishlist', 'session')
+
+SQL_LIST_MESSAGES = 'SELECT * FROM messages ORDER BY timestamp DESC, id DESC'
+SQL_LIST_MESSAGES_PAGE = 'SELECT * FROM messages ORDER BY timestamp DESC, id DESC LIMIT ?'
+SQL_LIST_MESSAGES_AFTER = (
+    'SELECT * FROM messages WHERE (timestamp < ? OR (timestamp = ? AND id < ?)) '
+    'ORDER BY timestamp DESC, id DESC LIMIT ?'
+)
+# Same paths as in app.extract_message_columns
+SQL_BACKFILL_MESSAGE_COLUMNS = """
+UPDATE messages SET
+    sender_phone = COALESCE(
+        json_extract(data, '$.entry[0].changes[0].value.messages[0].from'),
+        json_extract(data, '$.message.from'), json_extract(data, '$.from')),
+    message_type = COALESCE(
+        json_extract(data, '$.entry[0].changes[0].value.messages[0].type'),
+        json_extract(data, '$.message.type'), json_extract(data, '$.type')),
+    flow_token = COALESCE(
+        json_extract(data, '$.flow_token'),
+        CASE WHEN json_valid(json_extract(data, '$.entry[0].changes[0].value.messages[0].interactive.nfm_reply.response_json'))
+             THEN json_extract(json_extract(data, '$.entry[0].changes[0].value.messages[0].interactive.nfm_reply.response_json'), '$.flow_token')
+        END)
+WHERE id > ? AND id <= ? AND json_valid(data) AND json_type(data) = 'object'
+"""
+SQL_GET_MESSAGE = 'SELECT * FROM messages WHERE id = ?'
+SQL_LIST_MESSAGES_BEFORE = 'SELECT * FROM messages WHERE timestamp < ? ORDER BY timestamp ASC, id ASC LIMIT ?'
+SQL_LIST_MESSAGES_BEFORE_AFTER = """
+SELECT * FROM messages WHERE timestamp < ? AND (timestamp > ? OR (timestamp = ? AND id > ?))
+ORDER BY timestamp ASC, id ASC LIMIT ?
+"""
+SQL_DELETE_MESSAGE = 'DELETE FROM messages WHERE id = ?'
+SQL_GET_USER = 'SELECT * FROM users WHERE phone = ?'
+SQL_UPSERT_PROFILE = f"""
+INSERT INTO users (phone, parent_name, child_name) VALUES (?, ?, ?)
+ON CONFLICT (phone) DO UPDATE SET parent_name = excluded.parent_name, child_name = excluded.child_name,
+    updated_at = {NOW}
+"""
+# Sessions saved within the last N seconds ('-N seconds' modifier)
+SQL_GET_FLOW_SESSION = f"SELECT session, version FROM flow_sessions WHERE flow_token = ? AND updated_at >= strftime('%Y-%m-%dT%H:%M:%f', 'now', ?)"
+SQL_PRUNE_FLOW_SESSIONS = "DELETE FROM flow_sessions WHERE updated_at < strftime('%Y-%m-%dT%H:%M:%f', 'now', ?)"
+SQL_INSERT_FLOW_SESSION = 'INSERT INTO flow_sessions (flow_token, session) VALUES (?, ?) ON CONFLICT (flow_token) DO NOTHING'
+SQL_UPDATE_FLOW_SESSION = f"""
+UPDATE flow_sessions SET session = ?, version = version + 1, updated_at = {NOW}
+WHERE flow_token = ? AND version = ?
+"""
+# Hour of a message as 'YYYY-MM-DDTHH:00:00'
+HOUR_BUCKET = "substr(replace(COALESCE(timestamp, created_at), ' ', 'T'), 1, 13) || ':00:00'"
+SQL_ROLLUP_STATE = "SELECT last_id, refreshed_at FROM rollup_state WHERE name = 'messages'"
+SQL_ROLLUP_BATCH = 'SELECT max(id) AS to_id, count(*) AS processed FROM (SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?)'
+SQL_ROLLUP_MESSAGES = f"""
+INSERT INTO message_rollups (dimension, bucket, key, messages)
+SELECT * FROM (
+    SELECT 'hour' AS dimension, {HOUR_BUCKET} AS bucket, '' AS key, count(*) AS messages
+    FROM messages WHERE id > :from_id AND id <= :to_id GROUP BY 2
+    UNION ALL
+    SELECT 'sender', {HOUR_BUCKET}, sender_phone, count(*)
+    FROM messages WHERE id > :from_id AND id <= :to_id AND sender_phone IS NOT NULL GROUP BY 2, 3
+    UNION ALL
+    SELECT 'type', {HOUR_BUCKET}, COALESCE(message_type, ''), count(*)
+    FROM messages WHERE id > :from_id AND id <= :to_id GROUP BY 2, 3
+) WHERE true
+ON CONFLICT (dimension, bucket, key) DO UPDATE SET messages = messages + excluded.messages
+"""
+SQL_ROLLUP_ADVANCE = f"UPDATE rollup_state SET last_id = ?, refreshed_at = {NOW} WHERE name = 'messages'"
+SQL_STATS_HOURLY = """
+SELECT bucket AS hour,
+       COALESCE(sum(CASE WHEN dimension = 'hour' THEN messages END), 0) AS messages,
+       count(CASE WHEN dimension = 'sender' THEN 1 END) AS unique_senders
+FROM message_rollups WHERE {where} GROUP BY bucket ORDER BY bucket
+"""
+SQL_STATS_UNIQUE_SENDERS = "SELECT count(DISTINCT key) AS n FROM message_rollups WHERE dimension = 'sender' AND {where}"
+SQL_STATS_SENDERS = (
+    "SELECT key AS sender_phone, sum(messages) AS messages FROM message_rollups "
+    "WHERE dimension = 'sender' AND {where} GROUP BY key ORDER BY messages DESC, key LIMIT ?"
+)
+SQL_STATS_TYPES = (
+    "SELECT NULLIF(key, '') AS message_type, sum(messages) AS messages FROM message_rollups "
+    "WHERE dimension = 'type' AND {where} GROUP BY key ORDER BY messages DESC, key"
+)
+SQL_LIST_MENU_ITEMS = 'SELECT * FROM menu_items ORDER BY display_order ASC'
+SQL_LIST_PRIMARY_INPUT_FIELDS = 'SELECT no, field_name, created_at FROM primary_input_field ORDER BY no ASC'
+# A JSON string stored where an object/array belongs is unwrapped one level
+SQL_CONVERT_JSON_STRINGS = (
+    "UPDATE {table} SET {column} = json_extract({column}, '$') WHERE id IN ("
+    "SELECT id FROM {table} WHERE json_valid({column}) AND json_type({column}) = 'text' LIMIT ?)"
+)
+
+
+def dict_factory(cursor: sqlite3.Cursor, row: tuple) -> dict:
+    result = {col[0]: row[i] for i, col in enumerate(cursor.description)}
+    for column in JSON_COLUMNS:
+        value = result.get(column)
+        if isinstance(value, str):
+            try:
+                result[column] = serialization.loads(value)
+            except ValueError:
+                pass
+    return result
+
+
+def encode_value(column: str, value: Any) -> Any:
+    """Encode JSON column values to TEXT"""
+    if column in JSON_COLUMNS and value is not None and not isinstance(value, str):
+        return serialization.dumps(value)
+    return value
+
+
+class SQLiteStorage(StorageBackend):
+    """Storage in a local SQLite database file"""
+
+    name = 'sqlite'
+
+    def __init__(self, path: str = 'whatsapp_flow.db'):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self.connection()
+        conn.executescript(SCHEMA)
+        for table, column, column_type in ADDED_COLUMNS:
+            existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in existing:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        conn.executescript(INDEXES)
+
+    def reset(self) -> None:
+        """Close the calling thread's connection and forget the rest; each thread re-opens on next use"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection (re-opened after a fork)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        conn.row_factory = dict_factory
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-16000')
+        # Abort a statement that runs past the deadline of its backend call
+        conn.set_progress_handler(deadline_passed, 10000)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def write(self, sql: str, params_seq: List[tuple]) -> int:
+        """Run one statement for many parameter sets in a single transaction; returns rows changed"""
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                changed = conn.executemany(sql, params_seq).rowcount
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return changed
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """A write transaction on the calling thread's connection, rolled back on error"""
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def ping(self) -> None:
+        self.connection().execute('SELECT 1').fetchone()
+
+    def insert_messages(self, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        inserted = 0
+        by_columns: Dict[Tuple[str, ...], List[tuple]] = {}
+        for row in rows:
+            columns = tuple(c for c in MESSAGE_WRITE_COLUMNS if c in row)
+            by_columns.setdefault(columns, []).append(tuple(encode_value(c, row[c]) for c in columns))
+        for columns, params in by_columns.items():
+            # Redelivered messages hit the unique wamid index and are skipped
+            sql = 'INSERT INTO messages ({}) VALUES ({}) ON CONFLICT (wamid) DO NOTHING'.format(
+                ', '.join(columns), ', '.join('?' for _ in columns))
+            inserted += self.write(sql, params)
+        return inserted
+
+    def list_messages(self, limit: Optional[int] = None, after: Optional[Tuple[str, int]] = None,
+                      filters: Optional[Dict[str, str]] = None,
+                      columns: Optional[Sequence[str]] = None) -> List[dict]:
+        conn = self.connection()
+        if filters or columns:
+            return self.query_messages(limit, after, filters or {}, columns)
+        if after:
+            ts, last_id = after
+            return conn.execute(SQL_LIST_MESSAGES_AFTER,
+                                (ts, ts, int(last_id), -1 if limit is None else limit)).fetchall()
+        if limit is not None:
+            return conn.execute(SQL_LIST_MESSAGES_PAGE, (limit,)).fetchall()
+        return conn.execute(SQL_LIST_MESSAGES).fetchall()
+
+    def query_messages(self, limit: Optional[int], after: Optional[Tuple[str, int]],
+                       filters: Dict[str, str], columns: Optional[Sequence[str]]) -> List[dict]:
+        """Filtered and/or projected message listing"""
+        if columns:
+            unknown = [c for c in columns if c not in MESSAGE_COLUMNS]
+            if unknown:
+                raise ValueError(f'Unknown messages column: {unknown[0]}')
+        conditions, params = [], []
+        for column in MESSAGE_FILTER_COLUMNS:
+            if filters.get(column):
+                conditions.append(f'{column} = ?')
+                params.append(filters[column])
+        if filters.get('since'):
+            conditions.append('timestamp >= ?')
+            params.append(filters['since'])
+        if filters.get('until'):
+            conditions.append('timestamp < ?')
+            params.append(filters['until'])
+        if after:
+            ts, last_id = after
+            conditions.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+            params += [ts, ts, int(last_id)]
+        sql = 'SELECT {} FROM messages {} ORDER BY timestamp DESC, id DESC LIMIT ?'.format(
+            ', '.join(columns) if columns else '*',
+            'WHERE ' + ' AND '.join(conditions) if conditions else '')
+        params.append(-1 if limit is None else limit)
+        return self.connection().execute(sql, params).fetchall()
+
+    def get_message(self, message_id: int) -> Optional[dict]:
+        return self.connection().execute(SQL_GET_MESSAGE, (message_id,)).fetchone()
+
+    def list_messages_before(self, before: str, limit: int, after: Optional[Tuple[str, int]] = None) -> List[dict]:
+        if after:
+            ts, last_id = after
+            return self.connection().execute(SQL_LIST_MESSAGES_BEFORE_AFTER,
+                                             (before, ts, ts, int(last_id), limit)).fetchall()
+        return self.connection().execute(SQL_LIST_MESSAGES_BEFORE, (before, limit)).fetchall()
+
+    def delete_messages(self, ids: Sequence[int]) -> int:
+        if not ids:
+            return 0
+        return self.write(SQL_DELETE_MESSAGE, [(int(message_id),) for message_id in ids])
+
+    def get_user(self, phone: str) -> Optional[dict]:
+        return self.connection().execute(SQL_GET_USER, (phone,)).fetchone()
+
+    def get_users(self, phones: Sequence[str], columns: Optional[Sequence[str]] = None) -> List[dict]:
+        if columns:
+            unknown = [c for c in columns if c not in USER_COLUMNS]
+            if unknown:
+                raise ValueError(f'Unknown users column: {unknown[0]}')
+            select = ', '.join(columns)
+        else:
+            select = '*'
+        rows = []
+        conn = self.connection()
+        # Chunks below SQLite's variable limit
+        for i in range(0, len(phones), 500):
+            chunk = list(phones[i:i + 500])
+            sql = 'SELECT {} FROM users WHERE phone IN ({})'.format(select, ', '.join('?' for _ in chunk))
+            rows.extend(conn.execute(sql, chunk).fetchall())
+        return rows
+
+    def upsert_users(self, rows: List[Dict[str, Any]]) -> List[dict]:
+        if not rows:
+            return []
+        # One statement per set of columns, so a row never clears columns it doesn't have
+        with self.transaction() as conn:
+            for group in group_by_keys(rows):
+                columns = [c for c in USER_WRITE_COLUMNS if c in group[0]]
+                updates = ', '.join([f'{c} = excluded.{c}' for c in columns if c != 'phone'] + [f'updated_at = {NOW}'])
+                sql = 'INSERT INTO users ({}) VALUES ({}) ON CONFLICT (phone) DO UPDATE SET {}'.format(
+                    ', '.join(columns), ', '.join('?' for _ in columns), updates)
+                conn.executemany(sql, [tuple(encode_value(c, row[c]) for c in columns) for row in group])
+
+        # Read the saved rows back in chunks below SQLite's variable limit
+        phones = [row['phone'] for row in rows]
+        saved = {}
+        conn = self.connection()
+        for i in range(0, len(phones), 500):
+            chunk = phones[i:i + 500]
+            sql = 'SELECT * FROM users WHERE phone IN ({})'.format(', '.join('?' for _ in chunk))
+            for row in conn.execute(sql, chunk):
+                saved[row['phone']] = row
+        return [saved[phone] for phone in phones if phone in saved]
+
+    def list_users(self, limit: Optional[int] = None, after_id: Optional[int] = None,
+                   columns: Optional[Sequence[str]] = None) -> List[dict]:
+        if columns:
+            unknown = [c for c in columns if c not in USER_COLUMNS]
+            if unknown:
+                raise ValueError(f'Unknown users column: {unknown[0]}')
+            select = ', '.join(columns)
+        else:
+            select = '*'
+        sql = f'SELECT {select} FROM users WHERE id > ? ORDER BY id ASC LIMIT ?'
+        params = (-1 if after_id is None else int(after_id), -1 if limit is None else limit)
+        return self.connection().execute(sql, params).fetchall()
+
+    def table_version(self, name: str) -> Optional[Any]:
+        row = self.connection().execute('SELECT version FROM table_versions WHERE name = ?', (name,)).fetchone()
+        return row['version'] if row else None
+
+    def users_version(self) -> Optional[Any]:
+        return self.table_version('users')
+
+    def messages_version(self) -> Optional[Any]:
+        return self.table_version('messages')
+
+    def update_wishlist(self, phone: str, change: Callable[[list], Tuple[Optional[list], dict]]) -> dict:
+        """Read, change and write one user's wishlist inside a single write transaction.
+
+        change(items) returns (new_items, result); new_items None leaves the row untouched.
+        """
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT wishlist FROM users WHERE phone = ?', (phone,)).fetchone()
+                if row is None:
+                    items, result = None, {'result': 'user_not_found'}
+                else:
+                    wishlist = row['wishlist']
+                    items, result = change(list(wishlist) if isinstance(wishlist, list) else [])
+                if items is not None:
+                    conn.execute(f'UPDATE users SET wishlist = ?, updated_at = {NOW} WHERE phone = ?',
+                                 (serialization.dumps(items), phone))
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return result
+
+    def add_wishlist_item(self, phone: str, item: Dict[str, Any]) -> dict:
+        def change(items):
+            if wishlist_item_index(items, None, item.get('item_name')) is not None:
+                return None, {'result': 'duplicate'}
+            return items + [item], {'result': 'added', 'item': item}
+        return self.update_wishlist(phone, change)
+
+    def remove_wishlist_item(self, phone: str, item_id: Optional[str] = None,
+                             item_name: Optional[str] = None) -> dict:
+        def change(items):
+            index = wishlist_item_index(items, item_id, item_name)
+            if index is None:
+                return None, {'result': 'item_not_found'}
+            removed = items.pop(index)
+            return items, {'result': 'removed', 'item': removed}
+        return self.update_wishlist(phone, change)
+
+    def set_wishlist_item_status(self, phone: str, status: str, item_id: Optional[str] = None,
+                                 item_name: Optional[str] = None) -> dict:
+        def change(items):
+            index = wishlist_item_index(items, item_id, item_name)
+            if index is None:
+                return None, {'result': 'item_not_found'}
+            item = items[index]
+            if not isinstance(item, dict):
+                # Upgrade a plain string item to an object
+                item = {'item_id': uuid.uuid4().hex, 'item_name': item}
+            items[index] = item = {**item, 'status': status}
+            return items, {'result': 'updated', 'item': item}
+        return self.update_wishlist(phone, change)
+
+    def apply_flow_changes(self, phone: str, profile: Optional[Dict[str, str]] = None,
+                           add: Sequence[Dict[str, Any]] = (), remove: Sequence[Dict[str, Any]] = ()) -> Optional[dict]:
+        with self.transaction() as conn:
+            if profile:
+                conn.execute(SQL_UPSERT_PROFILE, (phone, profile['parent_name'], profile['child_name']))
+            row = conn.execute('SELECT wishlist FROM users WHERE phone = ?', (phone,)).fetchone()
+            if row is None:
+                return None
+            items = list(row['wishlist']) if isinstance(row['wishlist'], list) else []
+            changed = False
+            for ref in remove:
+                index = wishlist_item_index(items, ref.get('item_id'), ref.get('item_name'))
+                if index is not None:
+                    items.pop(index)
+                    changed = True
+            for item in add:
+                if (wishlist_item_index(items, item['item_id'], None) is None
+                        and wishlist_item_index(items, None, item['item_name']) is None):
+                    items.append(item)
+                    changed = True
+            if changed:
+                conn.execute(f'UPDATE users SET wishlist = ?, updated_at = {NOW} WHERE phone = ?',
+                             (serialization.dumps(items), phone))
+            return conn.execute(SQL_GET_USER, (phone,)).fetchone()
+
+    def get_flow_session(self, flow_token: str, max_age_seconds: int) -> Optional[dict]:
+        return self.connection().execute(SQL_GET_FLOW_SESSION,
+                                         (flow_token, f'-{int(max_age_seconds)} seconds')).fetchone()
+
+    def save_flow_session(self, flow_token: str, session: Dict[str, Any], version: Optional[int],
+                          max_age_seconds: int) -> Optional[int]:
+        encoded = serialization.dumps(session)
+        with self.transaction() as conn:
+            conn.execute(SQL_PRUNE_FLOW_SESSIONS, (f'-{int(max_age_seconds)} seconds',))
+            if version is None:
+                saved = conn.execute(SQL_INSERT_FLOW_SESSION, (flow_token, encoded)).rowcount
+            else:
+                saved = conn.execute(SQL_UPDATE_FLOW_SESSION, (encoded, flow_token, int(version))).rowcount
+            if not saved:
+                return None
+            return conn.execute('SELECT version FROM flow_sessions WHERE flow_token = ?',
+                                (flow_token,)).fetchone()['version']
+
+    def refresh_message_rollups(self, batch_size: int, settle_seconds: int = 60) -> int:
+        # Writes are serialized, so every id up to the newest is committed and
+        # nothing needs to settle
+        conn = self.connection()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                from_id = conn.execute(SQL_ROLLUP_STATE).fetchone()['last_id']
+                batch = conn.execute(SQL_ROLLUP_BATCH, (from_id, batch_size)).fetchone()
+                if batch['processed']:
+                    conn.execute(SQL_ROLLUP_MESSAGES, {'from_id': from_id, 'to_id': batch['to_id']})
+                conn.execute(SQL_ROLLUP_ADVANCE, (batch['to_id'] or from_id,))
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return batch['processed']
+
+    def message_stats(self, since: Optional[str] = None, until: Optional[str] = None, top: int = 100) -> dict:
+        conditions, params = ['1 = 1'], []
+        if since:
+            conditions.append("bucket >= substr(replace(?, ' ', 'T'), 1, 13) || ':00:00'")
+            params.append(since)
+        if until:
+            conditions.append('bucket < ?')
+            params.append(until)
+        where = ' AND '.join(conditions)
+        conn = self.connection()
+        hourly = conn.execute(SQL_STATS_HOURLY.format(where=where), params).fetchall()
+        state = conn.execute(SQL_ROLLUP_STATE).fetchone()
+        return {
+            'messages': sum(row['messages'] for row in hourly),
+            'unique_senders': conn.execute(SQL_STATS_UNIQUE_SENDERS.format(where=where), params).fetchone()['n'],
+            'hourly': hourly,
+            'senders': conn.execute(SQL_STATS_SENDERS.format(where=where), params + [int(top)]).fetchall(),
+            'types': conn.execute(SQL_STATS_TYPES.format(where=where), params).fetchall(),
+            'last_message_id': state['last_id'],
+            'refreshed_at': state['refreshed_at'],
+        }
+
+    def list_menu_items(self) -> List[dict]:
+        return self.connection().execute(SQL_LIST_MENU_ITEMS).fetchall()
+
+    def list_primary_input_fields(self) -> List[dict]:
+        return self.connection().execute(SQL_LIST_PRIMARY_INPUT_FIELDS).fetchall()
+
+    def backfill_message_columns(self, after_id: int, batch_size: int) -> Optional[int]:
+        # One transaction per batch: the id range and its update see the same rows
+        with self.transaction() as conn:
+            row = conn.execute('SELECT max(id) AS last_id FROM (SELECT id FROM messages WHERE id > ? ORDER BY id LIMIT ?)',
+                               (int(after_id), int(batch_size))).fetchone()
+            if row['last_id'] is None:
+                return None
+            conn.execute(SQL_BACKFILL_MESSAGE_COLUMNS, (int(after_id), row['last_id']))
+        return row['last_id']
+
+    def convert_json_strings(self, batch_size: int) -> int:
+        converted = 0
+        with self.transaction() as conn:
+            for table, column in (('messages', 'data'), ('users', 'wishlist')):
+                converted += conn.execute(SQL_CONVERT_JSON_STRINGS.format(table=table, column=column),
+                                          (int(batch_size),)).rowcount
+        return converted
@@ -0,0 +1,271 @@
+"""
+Supabase (PostgREST) storage backend.
+
+The supabase client (and with it supabase/httpx/postgrest) is imported and
+created on first use, so importing the app does no network I/O and cold
+starts only pay for plain Flask.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from resilience import current_timeout
+from storage.base import MESSAGE_FILTER_COLUMNS, StorageBackend, group_by_keys
+
+
+def create_supabase_client(url: str, key: str):
+    """Create a supabase client, working around proxy argument issues in serverless environments"""
+    # Import Supabase - handle version compatibility
+    try:
+        from supabase import create_client
+    except ImportError:
+        from supabase.client import create_client
+
+    # Set NO_PROXY to prevent httpx from trying to use proxy settings
+    os.environ.setdefault('NO_PROXY', '*')
+    os.environ.setdefault('no_proxy', '*')
+    # Also disable proxy for httpx specifically
+    os.environ.setdefault('HTTP_PROXY', '')
+    os.environ.setdefault('HTTPS_PROXY', '')
+    os.environ.setdefault('http_proxy', '')
+    os.environ.setdefault('https_proxy', '')
+
+    try:
+        return create_client(url, key)
+    except TypeError as type_error:
+        # If there's a type error with proxy argument, it's likely a version compatibility issue
+        if 'proxy' not in str(type_error).lower():
+            raise
+        # The issue is likely that httpx (used by supabase) is trying to pass proxy
+        # but the Client doesn't accept it. Try to patch httpx or use alternative initialization
+        try:
+            import httpx
+            original_init = httpx.Client.__init__
+
+            def patched_init(self, *args, **kwargs):
+                kwargs.pop('proxy', None)
+                kwargs.pop('proxies', None)
+                return original_init(self, *args, **kwargs)
+            httpx.Client.__init__ = patched_init
+
+            # Now try creating the client again
+            return create_client(url, key)
+        except Exception:
+            # If patching fails, try using the client module directly
+            try:
+                from supabase.client import Client, ClientOptions
+                options = ClientOptions(
+                    auto_refresh_token=True,
+                    persist_session=False
+                )
+                return Client(url, key, options)
+            except Exception as alt_error:
+                print(f"⚠️ Alternative initialization failed: {alt_error}")
+                raise type_error  # Re-raise original error
+
+
+def apply_call_timeout(request) -> None:
+    """httpx request hook: bound each request by the time left for the backend call making it"""
+    timeout = current_timeout()
+    if timeout is not None:
+        request.extensions['timeout'] = {'connect': timeout, 'read': timeout, 'write': timeout, 'pool': timeout}
+
+
+class SupabaseStorage(StorageBackend):
+    """Storage backed by a supabase-py client, created on first use"""
+
+    name = 'supabase'
+
+    def __init__(self, url: str, key: str, client=None):
+        self.url = url
+        self.key = key
+        self._client = client
+        self._lock = threading.Lock()
+        self.init_error: Optional[str] = None
+
+    @property
+    def client_initialized(self) -> bool:
+        return self._client is not None
+
+    @property
+    def client(self):
+        """The supabase client, created on first use"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        self._client = create_supabase_client(self.url, self.key)
+                        self.init_error = None
+                    except Exception as e:
+                        self.init_error = str(e)
+                        print(f"❌ Failed to initialize Supabase: {e}")
+                        raise
+        self.install_timeout_hook(self._client)
+        return self._client
+
+    def install_timeout_hook(self, client) -> None:
+        """Add apply_call_timeout to the PostgREST HTTP session (again if the client replaced it)"""
+        session = getattr(getattr(client, 'postgrest', None), 'session', None)
+        hooks = getattr(session, 'event_hooks', None)
+        if hooks is not None and apply_call_timeout not in hooks['request']:
+            hooks['request'].append(apply_call_timeout)
+
+    def reset(self) -> None:
+        """Drop the client so the next call creates a new one (e.g. after a fork)"""
+        with self._lock:
+            self._client = None
+
+    def ping(self) -> None:
+        self.client.table('users').select('id').limit(1).execute()
+
+    def insert_messages(self, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        # Redelivered messages hit the unique wamid index and are skipped;
+        # count=exact reports how many rows were actually inserted
+        response = self.client.table('messages').upsert(
+            rows, on_conflict='wamid', ignore_duplicates=True, returning='minimal', count='exact'
+        ).execute()
+        return response.count if response.count is not None else len(rows)
+
+    def list_messages(self, limit: Optional[int] = None, after: Optional[Tuple[str, int]] = None,
+                      filters: Optional[Dict[str, str]] = None,
+                      columns: Optional[Sequence[str]] = None) -> List[dict]:
+        query = self.client.table('messages').select(','.join(columns) if columns else '*')
+        filters = filters or {}
+        for column in MESSAGE_FILTER_COLUMNS:
+            if filters.get(column):
+                query = query.eq(column, filters[column])
+        if filters.get('since'):
+            query = query.gte('timestamp', filters['since'])
+        if filters.get('until'):
+            query = query.lt('timestamp', filters['until'])
+        if after:
+            ts, last_id = after
+            query = query.or_(f'timestamp.lt."{ts}",and(timestamp.eq."{ts}",id.lt.{int(last_id)})')
+        query = query.order('timestamp', desc=True).order('id', desc=True)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.execute().data
+
+    def get_message(self, message_id: int) -> Optional[dict]:
+        response = self.client.table('messages').select('*').eq('id', message_id).execute()
+        return response.data[0] if response.data else None
+
+    def list_messages_before(self, before: str, limit: int, after: Optional[Tuple[str, int]] = None) -> List[dict]:
+        query = self.client.table('messages').select('*').lt('timestamp', before)
+        if after:
+            ts, last_id = after
+            query = query.or_(f'timestamp.gt."{ts}",and(timestamp.eq."{ts}",id.gt.{int(last_id)})')
+        query = query.order('timestamp', desc=False).order('id', desc=False).limit(limit)
+        return query.execute().data
+
+    def delete_messages(self, ids: Sequence[int]) -> int:
+        if not ids:
+            return 0
+        response = self.client.table('messages').delete(count='exact', returning='minimal').in_(
+            'id', [int(message_id) for message_id in ids]).execute()
+        return response.count if response.count is not None else len(ids)
+
+    def get_user(self, phone: str) -> Optional[dict]:
+        response = self.client.table('users').select('*').eq('phone', phone).execute()
+        return response.data[0] if response.data else None
+
+    def get_users(self, phones: Sequence[str], columns: Optional[Sequence[str]] = None) -> List[dict]:
+        if not phones:
+            return []
+        query = self.client.table('users').select(','.join(columns) if columns else '*')
+        return query.in_('phone', list(phones)).execute().data
+
+    def upsert_users(self, rows: List[Dict[str, Any]]) -> List[dict]:
+        if not rows:
+            return []
+        # PostgREST needs the same keys in every row of a bulk upsert
+        saved = []
+        for group in group_by_keys(rows):
+            response = self.client.table('users').upsert(group, on_conflict='phone').execute()
+            saved.extend(response.data if isinstance(response.data, list) else [response.data])
+        return saved
+
+    def list_users(self, limit: Optional[int] = None, after_id: Optional[int] = None,
+                   columns: Optional[Sequence[str]] = None) -> List[dict]:
+        query = self.client.table('users').select(','.join(columns) if columns else '*')
+        if after_id is not None:
+            query = query.gt('id', int(after_id))
+        query = query.order('id', desc=False)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.execute().data
+
+    def table_version(self, name: str) -> Optional[Any]:
+        response = self.client.table('table_versions').select('version').eq('name', name).execute()
+        return response.data[0]['version'] if response.data else None
+
+    def users_version(self) -> Optional[Any]:
+        return self.table_version('users')
+
+    def messages_version(self) -> Optional[Any]:
+        return self.table_version('messages')
+
+    def add_wishlist_item(self, phone: str, item: Dict[str, Any]) -> dict:
+        response = self.client.rpc('wishlist_add_item', {'p_phone': phone, 'p_item': item}).execute()
+        return response.data
+
+    def remove_wishlist_item(self, phone: str, item_id: Optional[str] = None,
+                             item_name: Optional[str] = None) -> dict:
+        response = self.client.rpc('wishlist_remove_item', {
+            'p_phone': phone, 'p_item_id': item_id, 'p_item_name': item_name}).execute()
+        return response.data
+
+    def set_wishlist_item_status(self, phone: str, status: str, item_id: Optional[str] = None,
+                                 item_name: Optional[str] = None) -> dict:
+        response = self.client.rpc('wishlist_set_item_status', {
+            'p_phone': phone, 'p_status': status, 'p_item_id': item_id, 'p_item_name': item_name}).execute()
+        return response.data
+
+    def apply_flow_changes(self, phone: str, profile: Optional[Dict[str, str]] = None,
+                           add: Sequence[Dict[str, Any]] = (), remove: Sequence[Dict[str, Any]] = ()) -> Optional[dict]:
+        response = self.client.rpc('flow_apply_changes', {
+            'p_phone': phone, 'p_profile': profile, 'p_add': list(add), 'p_remove': list(remove)}).execute()
+        return response.data
+
+    def get_flow_session(self, flow_token: str, max_age_seconds: int) -> Optional[dict]:
+        since = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+        response = self.client.table('flow_sessions').select('session, version').eq(
+            'flow_token', flow_token).gte('updated_at', since.isoformat()).execute()
+        return response.data[0] if response.data else None
+
+    def save_flow_session(self, flow_token: str, session: Dict[str, Any], version: Optional[int],
+                          max_age_seconds: int) -> Optional[int]:
+        response = self.client.rpc('flow_save_session', {
+            'p_flow_token': flow_token, 'p_session': session, 'p_version': version,
+            'p_max_age_seconds': int(max_age_seconds)}).execute()
+        return response.data
+
+    def refresh_message_rollups(self, batch_size: int, settle_seconds: int = 60) -> int:
+        response = self.client.rpc('refresh_message_rollups', {
+            'batch_size': int(batch_size), 'settle_seconds': int(settle_seconds)}).execute()
+        return int(response.data or 0)
+
+    def message_stats(self, since: Optional[str] = None, until: Optional[str] = None, top: int = 100) -> dict:
+        response = self.client.rpc('message_stats', {'p_since': since, 'p_until': until, 'p_top': int(top)}).execute()
+        return response.data
+
+    def list_menu_items(self) -> List[dict]:
+        response = self.client.table('menu_items').select('*').order('display_order', desc=False).execute()
+        return response.data
+
+    def list_primary_input_fields(self) -> List[dict]:
+        response = self.client.table('primary_input_field').select('no, field_name, created_at').order('no', desc=False).execute()
+        return response.data
+
+    def backfill_message_columns(self, after_id: int, batch_size: int) -> Optional[int]:
+        response = self.client.rpc('backfill_message_columns',
+                                   {'after_id': int(after_id), 'batch_size': int(batch_size)}).execute()
+        return int(response.data) if response.data is not None else None
+
+    def convert_json_strings(self, batch_size: int) -> int:
+        response = self.client.rpc('convert_json_strings', {'batch_size': int(batch_size)}).execute()
+        return int(response.data or 0)
@@ -23,9 +23,76 @@ CREATE TABLE IF NOT EXISTS users (
 -- Create index on phone for faster lookups
 CREATE INDEX IF NOT EXISTS idx_users_phone ON users(phone);
 
+-- updated_at always comes from the database clock, whichever path writes the row
+CREATE OR REPLACE FUNCTION touch_updated_at()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS users_touch_updated_at ON users;
+CREATE TRIGGER users_touch_updated_at
+    BEFORE INSERT OR UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+-- Versions behind the /users and /messages ETags: bumped by every statement
+-- that writes the table, so they move even when two writes share a
+-- timestamp, and on backdated inserts and deletes. Concurrent writers of a
+-- table wait on its table_versions row lock until they commit.
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO table_versions (name) VALUES ('users'), ('messages') ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_table_version()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+    UPDATE table_versions SET version = version + 1 WHERE name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS users_bump_version ON users;
+CREATE TRIGGER users_bump_version
+    AFTER INSERT OR UPDATE OR DELETE ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS messages_bump_version ON messages;
+CREATE TRIGGER messages_bump_version
+    AFTER INSERT OR UPDATE OR DELETE ON messages
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+-- Replaced by bump_table_version
+DROP FUNCTION IF EXISTS bump_users_version();
+
 -- Create index on timestamp for messages
 CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp);
 
+-- WhatsApp message id (wamid) of inbound messages. The unique index lets
+-- redelivered webhooks be skipped with ON CONFLICT DO NOTHING; rows without
+-- an id (status callbacks, older rows) are NULL and never conflict.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS wamid TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_wamid ON messages(wamid);
+
+-- Columns derived from the payload at ingest, so /messages can filter by
+-- sender, type and flow token with an index range scan instead of
+-- transferring the whole table
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS sender_phone TEXT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS message_type TEXT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS flow_token TEXT;
+CREATE INDEX IF NOT EXISTS idx_messages_sender_phone ON messages(sender_phone, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_message_type ON messages(message_type, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_flow_token ON messages(flow_token, timestamp DESC, id DESC);
+
 -- Create menu_items table
 CREATE TABLE IF NOT EXISTS menu_items (
     id VARCHAR(50) PRIMARY KEY,
@@ -59,14 +126,390 @@ INSERT INTO primary_input_field (no, field_name, created_at) VALUES
     (3, 'child_02', NOW())
 ON CONFLICT (no) DO NOTHING;
 
+-- Convert JSON values stored as JSON strings (payloads and wishlists written
+-- with json.dumps by older app versions) into real JSON objects/arrays.
+-- Converts up to batch_size rows per table per call and returns the number
+-- converted; run migrate_payloads.py to call it until nothing is left.
+CREATE OR REPLACE FUNCTION parse_json_string(value JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+IMMUTABLE
+AS $$
+DECLARE
+    parsed JSONB;
+BEGIN
+    parsed := (value #>> '{}')::jsonb;
+    IF jsonb_typeof(parsed) = 'string' THEN
+        RETURN NULL;
+    END IF;
+    RETURN parsed;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION convert_json_strings(batch_size INTEGER DEFAULT 1000)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    messages_converted INTEGER;
+    users_converted INTEGER;
+BEGIN
+    -- Unparseable payloads are kept under "raw" so no row is retried forever
+    UPDATE messages
+    SET data = COALESCE(parse_json_string(data), jsonb_build_object('raw', data))
+    WHERE id IN (
+        SELECT id FROM messages WHERE jsonb_typeof(data) = 'string' LIMIT batch_size
+    );
+    GET DIAGNOSTICS messages_converted = ROW_COUNT;
+
+    UPDATE users
+    SET wishlist = COALESCE(parse_json_string(wishlist), '[]'::jsonb)
+    WHERE id IN (
+        SELECT id FROM users WHERE jsonb_typeof(wishlist) = 'string' LIMIT batch_size
+    );
+    GET DIAGNOSTICS users_converted = ROW_COUNT;
+
+    RETURN messages_converted + users_converted;
+END;
+$$;
+
+-- Fill the derived columns of rows stored before they existed, batch_size
+-- rows at a time in id order. Returns the last id processed, or NULL when
+-- there are no rows after after_id (migrate_payloads.py loops over it).
+-- Uses the same payload paths as extract_message_columns in app.py.
+CREATE OR REPLACE FUNCTION backfill_message_columns(after_id BIGINT, batch_size INTEGER DEFAULT 1000)
+RETURNS BIGINT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id BIGINT;
+BEGIN
+    SELECT max(id) INTO last_id
+    FROM (SELECT id FROM messages WHERE id > after_id ORDER BY id LIMIT batch_size) batch;
+    IF last_id IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    UPDATE messages m
+    SET sender_phone = COALESCE(src.msg->>'from', m.data->'message'->>'from', m.data->>'from'),
+        message_type = COALESCE(src.msg->>'type', m.data->'message'->>'type', m.data->>'type'),
+        flow_token = COALESCE(
+            m.data->>'flow_token',
+            parse_json_string(src.msg->'interactive'->'nfm_reply'->'response_json')->>'flow_token'
+        )
+    FROM (
+        SELECT id, data->'entry'->0->'changes'->0->'value'->'messages'->0 AS msg
+        FROM messages
+        WHERE id > after_id AND id <= last_id AND jsonb_typeof(data) = 'object'
+    ) src
+    WHERE m.id = src.id;
+
+    RETURN last_id;
+END;
+$$;
+
+-- ============================================================================
+-- Item-level wishlist operations (called over RPC by /add-item, /remove-item
+-- and /mark-bought). Each one locks the user's row and changes a single
+-- element, so concurrent edits don't overwrite each other and the request
+-- and response carry one item instead of the whole wishlist. Items are
+-- objects {item_id, item_name, status}; plain strings from older versions
+-- match by name.
+-- ============================================================================
+
+-- Position (0-based) of the item matching p_item_id, or p_item_name
+-- (case-insensitive) when no id is given
+CREATE OR REPLACE FUNCTION wishlist_item_index(items JSONB, p_item_id TEXT, p_item_name TEXT)
+RETURNS INTEGER
+LANGUAGE sql
+IMMUTABLE
+AS $$
+    SELECT (ord - 1)::INTEGER
+    FROM jsonb_array_elements(COALESCE(items, '[]'::jsonb)) WITH ORDINALITY AS t(item, ord)
+    WHERE (p_item_id IS NOT NULL AND item->>'item_id' = p_item_id)
+       OR (p_item_id IS NULL AND lower(COALESCE(item->>'item_name', item #>> '{}')) = lower(p_item_name))
+    ORDER BY ord
+    LIMIT 1;
+$$;
+
+CREATE OR REPLACE FUNCTION wishlist_add_item(p_phone TEXT, p_item JSONB)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    items JSONB;
+BEGIN
+    SELECT wishlist INTO items FROM users WHERE phone = p_phone FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('result', 'user_not_found');
+    END IF;
+    IF wishlist_item_index(items, NULL, p_item->>'item_name') IS NOT NULL THEN
+        RETURN jsonb_build_object('result', 'duplicate');
+    END IF;
+
+    UPDATE users
+    SET wishlist = COALESCE(wishlist, '[]'::jsonb) || jsonb_build_array(p_item)
+    WHERE phone = p_phone;
+    RETURN jsonb_build_object('result', 'added', 'item', p_item);
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION wishlist_remove_item(p_phone TEXT, p_item_id TEXT DEFAULT NULL, p_item_name TEXT DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    items JSONB;
+    idx INTEGER;
+BEGIN
+    SELECT wishlist INTO items FROM users WHERE phone = p_phone FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('result', 'user_not_found');
+    END IF;
+    idx := wishlist_item_index(items, p_item_id, p_item_name);
+    IF idx IS NULL THEN
+        RETURN jsonb_build_object('result', 'item_not_found');
+    END IF;
+
+    UPDATE users SET wishlist = wishlist - idx WHERE phone = p_phone;
+    RETURN jsonb_build_object('result', 'removed', 'item', items -> idx);
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION wishlist_set_item_status(p_phone TEXT, p_status TEXT,
+                                                    p_item_id TEXT DEFAULT NULL, p_item_name TEXT DEFAULT NULL)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    items JSONB;
+    idx INTEGER;
+    item JSONB;
+BEGIN
+    SELECT wishlist INTO items FROM users WHERE phone = p_phone FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('result', 'user_not_found');
+    END IF;
+    idx := wishlist_item_index(items, p_item_id, p_item_name);
+    IF idx IS NULL THEN
+        RETURN jsonb_build_object('result', 'item_not_found');
+    END IF;
+
+    item := items -> idx;
+    IF jsonb_typeof(item) <> 'object' THEN
+        -- Upgrade a plain string item to an object
+        item := jsonb_build_object('item_id', replace(gen_random_uuid()::TEXT, '-', ''),
+                                   'item_name', item #>> '{}');
+    END IF;
+    item := item || jsonb_build_object('status', p_status);
+
+    UPDATE users SET wishlist = jsonb_set(wishlist, ARRAY[idx::TEXT], item)
+    WHERE phone = p_phone;
+    RETURN jsonb_build_object('result', 'updated', 'item', item);
+END;
+$$;
+
+-- ============================================================================
+-- WhatsApp Flow (/flow)
+-- ============================================================================
+
+-- Save one flow request's changes to a user in a single transaction and
+-- return the saved row (NULL when the user doesn't exist and no profile is
+-- given). p_profile ({parent_name, child_name}) creates or renames the user;
+-- p_remove refs ({item_id, item_name}) are removed, then p_add items are
+-- appended unless their item_id or name is already listed, so replaying the
+-- same changes after a failed response leaves the row as it is.
+CREATE OR REPLACE FUNCTION flow_apply_changes(p_phone TEXT, p_profile JSONB DEFAULT NULL,
+                                              p_add JSONB DEFAULT '[]'::jsonb, p_remove JSONB DEFAULT '[]'::jsonb)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    items JSONB;
+    ref JSONB;
+    item JSONB;
+    idx INTEGER;
+    saved users;
+BEGIN
+    IF p_profile IS NOT NULL THEN
+        INSERT INTO users (phone, parent_name, child_name)
+        VALUES (p_phone, p_profile->>'parent_name', p_profile->>'child_name')
+        ON CONFLICT (phone) DO UPDATE SET parent_name = EXCLUDED.parent_name, child_name = EXCLUDED.child_name;
+    END IF;
+
+    SELECT wishlist INTO items FROM users WHERE phone = p_phone FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    items := COALESCE(items, '[]'::jsonb);
+
+    FOR ref IN SELECT * FROM jsonb_array_elements(COALESCE(p_remove, '[]'::jsonb)) LOOP
+        idx := wishlist_item_index(items, ref->>'item_id', ref->>'item_name');
+        IF idx IS NOT NULL THEN
+            items := items - idx;
+        END IF;
+    END LOOP;
+    FOR item IN SELECT * FROM jsonb_array_elements(COALESCE(p_add, '[]'::jsonb)) LOOP
+        IF wishlist_item_index(items, item->>'item_id', NULL) IS NULL
+           AND wishlist_item_index(items, NULL, item->>'item_name') IS NULL THEN
+            items := items || jsonb_build_array(item);
+        END IF;
+    END LOOP;
+
+    UPDATE users SET wishlist = items WHERE phone = p_phone AND wishlist IS DISTINCT FROM items;
+    SELECT * INTO saved FROM users WHERE phone = p_phone;
+    RETURN to_jsonb(saved);
+END;
+$$;
+
+-- Flow sessions not saved to users yet (no phone, or the profile isn't
+-- complete), shared by every worker; version guards concurrent saves
+CREATE TABLE IF NOT EXISTS flow_sessions (
+    flow_token TEXT PRIMARY KEY,
+    session JSONB NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_flow_sessions_updated_at ON flow_sessions(updated_at);
+
+-- Store a session if it is still at p_version (NULL for a new token) and
+-- return its new version, or NULL when another request saved it first.
+-- Sessions idle for more than p_max_age_seconds are deleted.
+CREATE OR REPLACE FUNCTION flow_save_session(p_flow_token TEXT, p_session JSONB, p_version BIGINT,
+                                             p_max_age_seconds INTEGER DEFAULT 3600)
+RETURNS BIGINT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    new_version BIGINT;
+BEGIN
+    DELETE FROM flow_sessions WHERE updated_at < NOW() - make_interval(secs => p_max_age_seconds);
+    IF p_version IS NULL THEN
+        INSERT INTO flow_sessions (flow_token, session) VALUES (p_flow_token, p_session)
+        ON CONFLICT (flow_token) DO NOTHING
+        RETURNING version INTO new_version;
+    ELSE
+        UPDATE flow_sessions SET session = p_session, version = version + 1, updated_at = NOW()
+        WHERE flow_token = p_flow_token AND version = p_version
+        RETURNING version INTO new_version;
+    END IF;
+    RETURN new_version;
+END;
+$$;
+
+-- Message analytics rollups for /stats: message counts per hour ('hour'),
+-- per hour and sender ('sender') and per hour and message type ('type').
+-- refresh_message_rollups() folds in messages stored after the watermark in
+-- rollup_state, so /stats reads a few hundred summary rows instead of the
+-- messages table. Rollups keep counting messages after compact_messages.py
+-- has moved them to the archive.
+CREATE TABLE IF NOT EXISTS message_rollups (
+    dimension TEXT NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    key TEXT NOT NULL DEFAULT '',
+    messages BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, bucket, key)
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMPTZ
+);
+
+INSERT INTO rollup_state (name) VALUES ('messages') ON CONFLICT (name) DO NOTHING;
+
+-- Roll up the next batch_size messages after the watermark; returns how many
+-- were rolled up (0 once caught up). Messages are only counted once they are
+-- settle_seconds old, so an insert that commits after a higher id isn't
+-- skipped. Concurrent calls wait on the rollup_state row lock.
+CREATE OR REPLACE FUNCTION refresh_message_rollups(batch_size INTEGER DEFAULT 10000, settle_seconds INTEGER DEFAULT 60)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    from_id BIGINT;
+    settled_id BIGINT;
+    to_id BIGINT;
+    processed INTEGER;
+BEGIN
+    SELECT last_id INTO from_id FROM rollup_state WHERE name = 'messages' FOR UPDATE;
+    SELECT max(id) INTO settled_id FROM messages
+    WHERE created_at < NOW() - make_interval(secs => settle_seconds);
+
+    SELECT max(id), count(*) INTO to_id, processed FROM (
+        SELECT id FROM messages WHERE id > from_id AND id <= settled_id ORDER BY id LIMIT batch_size
+    ) batch;
+
+    IF processed > 0 THEN
+        INSERT INTO message_rollups (dimension, bucket, key, messages)
+        SELECT 'hour', date_trunc('hour', COALESCE(timestamp, created_at)), '', count(*)
+        FROM messages WHERE id > from_id AND id <= to_id GROUP BY 2
+        UNION ALL
+        SELECT 'sender', date_trunc('hour', COALESCE(timestamp, created_at)), sender_phone, count(*)
+        FROM messages WHERE id > from_id AND id <= to_id AND sender_phone IS NOT NULL GROUP BY 2, 3
+        UNION ALL
+        SELECT 'type', date_trunc('hour', COALESCE(timestamp, created_at)), COALESCE(message_type, ''), count(*)
+        FROM messages WHERE id > from_id AND id <= to_id GROUP BY 2, 3
+        ON CONFLICT (dimension, bucket, key) DO UPDATE SET messages = message_rollups.messages + EXCLUDED.messages;
+    END IF;
+
+    UPDATE rollup_state SET last_id = COALESCE(to_id, from_id), refreshed_at = NOW() WHERE name = 'messages';
+    RETURN processed;
+END;
+$$;
+
+-- Totals, hourly series, top senders and message types from the rollups.
+-- since is rounded down to the hour; until is exclusive.
+CREATE OR REPLACE FUNCTION message_stats(p_since TIMESTAMPTZ DEFAULT NULL, p_until TIMESTAMPTZ DEFAULT NULL,
+                                         p_top INTEGER DEFAULT 100)
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    WITH r AS (
+        SELECT * FROM message_rollups
+        WHERE (p_since IS NULL OR bucket >= date_trunc('hour', p_since))
+          AND (p_until IS NULL OR bucket < p_until)
+    )
+    SELECT jsonb_build_object(
+        'messages', (SELECT COALESCE(sum(messages), 0) FROM r WHERE dimension = 'hour'),
+        'unique_senders', (SELECT count(DISTINCT key) FROM r WHERE dimension = 'sender'),
+        'hourly', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('hour', bucket, 'messages', messages,
+                                                'unique_senders', senders) ORDER BY bucket)
+            FROM (SELECT bucket,
+                         COALESCE(sum(messages) FILTER (WHERE dimension = 'hour'), 0) AS messages,
+                         count(*) FILTER (WHERE dimension = 'sender') AS senders
+                  FROM r GROUP BY bucket) hours
+        ), '[]'::jsonb),
+        'senders', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('sender_phone', key, 'messages', total) ORDER BY total DESC, key)
+            FROM (SELECT key, sum(messages) AS total FROM r WHERE dimension = 'sender'
+                  GROUP BY key ORDER BY total DESC, key LIMIT p_top) senders
+        ), '[]'::jsonb),
+        'types', COALESCE((
+            SELECT jsonb_agg(jsonb_build_object('message_type', NULLIF(key, ''), 'messages', total) ORDER BY total DESC, key)
+            FROM (SELECT key, sum(messages) AS total FROM r WHERE dimension = 'type' GROUP BY key) types
+        ), '[]'::jsonb),
+        'last_message_id', (SELECT last_id FROM rollup_state WHERE name = 'messages'),
+        'refreshed_at', (SELECT refreshed_at FROM rollup_state WHERE name = 'messages')
+    );
+$$;
+
 -- Enable Row Level Security (RLS) - Optional
 -- ALTER TABLE messages ENABLE ROW LEVEL SECURITY;
 -- ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 -- ALTER TABLE menu_items ENABLE ROW LEVEL SECURITY;
+-- ALTER TABLE table_versions ENABLE ROW LEVEL SECURITY;
 
 -- Create policies if using RLS (adjust as needed)
 -- Policy to allow all operations (for API key access)
 -- CREATE POLICY "Allow all operations" ON messages FOR ALL USING (true);
 -- CREATE POLICY "Allow all operations" ON users FOR ALL USING (true);
 -- CREATE POLICY "Allow all operations" ON menu_items FOR ALL USING (true);
+-- CREATE POLICY "Allow read" ON table_versions FOR SELECT USING (true);
 
@@ -0,0 +1,92 @@
+"""Tests for admission control on the Flask app"""
+
+import pytest
+from flask import Flask, Response, jsonify
+
+import admission
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    controller = admission.AdmissionController(1, max_queue=0)
+    monkeypatch.setattr(admission, 'controller', controller)
+    return controller
+
+
+@pytest.fixture
+def client(controller):
+    app = Flask(__name__)
+    seen = app.config['SEEN_ACTIVE'] = []
+
+    @app.route('/stream')
+    def stream():
+        def rows():
+            for i in range(3):
+                seen.append(controller.active)
+                yield f'{i}\n'
+        return Response(rows(), mimetype='application/x-ndjson')
+
+    @app.route('/write', methods=['POST'])
+    def write():
+        return jsonify({'status': 'success'})
+
+    @app.route('/lookup', methods=['POST'])
+    def lookup():
+        return jsonify({'status': 'success'})
+
+    @app.route('/health')
+    def health():
+        return jsonify({'status': 'healthy'})
+
+    admission.init_app(app, exempt_endpoints=('health',), read_endpoints=('lookup',))
+    return app.test_client()
+
+
+def test_full_worker_answers_503_to_writes_and_429_to_reads(client, controller):
+    controller.active = 1  # another request holds the only slot
+
+    write = client.post('/write')
+    assert write.status_code == 503 and int(write.headers['Retry-After']) >= 1
+    assert write.get_json()['status'] == 'error'
+    for response in (client.get('/stream'), client.post('/lookup')):
+        assert response.status_code == 429 and response.headers['Retry-After']
+    assert client.get('/health').status_code == 200
+    assert controller.rejected == {'queue_full': 3}
+
+
+def test_stream_holds_its_slot_until_closed(client, controller):
+    response = client.get('/stream')
+    assert response.get_data(as_text=True) == '0\n1\n2\n'
+    assert client.application.config['SEEN_ACTIVE'] == [1, 1, 1]
+    assert controller.active == 1
+
+    response.close()
+    assert controller.active == 0 and controller.admitted == 1
+
+
+def test_plain_response_releases_its_slot(client, controller):
+    assert client.post('/write').status_code == 200
+    assert client.post('/write').status_code == 200
+    assert controller.active == 0 and controller.admitted == 2
+
+
+def test_request_queued_too_long_upstream_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_QUEUE_TIME_MS', 100)
+    assert client.post('/write', headers={'X-Request-Start': 't=1000000000000'}).status_code == 503
+    assert client.post('/write').status_code == 200
+
+
+def test_reads_use_only_their_share_of_slots():
+    controller = admission.AdmissionController(2, low_priority_share=0.5)
+    assert controller.acquire('low') is None
+    assert controller._can_run('high') and not controller._can_run('low')
+    controller.waiting['high'] = 1
+    controller.release(0.01)
+    # A free slot, but a write is waiting for it
+    assert not controller._can_run('low')
+
+
+@pytest.mark.parametrize('header, waited', [('t=1000000000', 2), ('t=1000000000000', 2),
+                                            ('t=1000000000000000', 2), (None, None), ('t=soon', None)])
+def test_queue_time_accepts_seconds_milliseconds_and_microseconds(header, waited):
+    assert admission.queue_time(header, now=1000000002) == waited
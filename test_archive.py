@@ -0,0 +1,141 @@
+"""Tests for the message archive (archive.py), compact_messages.py and the /messages fall-through"""
+
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app as wsgi
+import archive
+import compact_messages
+from archive import MessageArchive
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+def days_ago(days, minutes=0):
+    moment = datetime.now(timezone.utc) - timedelta(days=days, minutes=minutes)
+    return moment.replace(tzinfo=None).isoformat()
+
+
+def store_messages(sender, timestamps):
+    """Insert one message per timestamp for sender; returns their ids, oldest first"""
+    rows = [wsgi.build_message_row({'from': sender, 'type': 'text', 'id': f'wamid.{uuid.uuid4().hex}',
+                                    'timestamp': ts}) for ts in timestamps]
+    assert wsgi.save_messages(rows) == len(rows)
+    stored = wsgi.get_storage().list_messages(filters={'sender_phone': sender})
+    return sorted(row['id'] for row in stored)
+
+
+def listed_ids(client, sender, **params):
+    response = client.get('/messages', query_string={'phone': sender, **params})
+    assert response.status_code == 200
+    return [message['id'] for message in response.get_json()['messages']]
+
+
+def compact(*args):
+    return compact_messages.main(['--days', '1', '--pause', '0', *args])
+
+
+def test_archive_get_list_and_skip_rewrites(tmp_path):
+    store = MessageArchive(str(tmp_path), block_rows=2)
+    rows = [{'id': i, 'timestamp': f'2026-01-0{1 + i % 2}T10:00:0{i}', 'sender_phone': str(i % 3), 'data': {}}
+            for i in range(1, 8)]
+    assert store.write(rows) == 7
+    assert store.write(rows[:3]) == 0
+
+    assert store.get(5)['timestamp'] == '2026-01-02T10:00:05'
+    assert store.get(99) is None
+    assert [row['id'] for row in store.list()] == [7, 5, 3, 1, 6, 4, 2]
+    assert [row['id'] for row in store.list(limit=2, after=('2026-01-02T10:00:05', 5))] == [3, 1]
+    assert [row['id'] for row in store.list(filters={'sender_phone': '1'})] == [7, 1, 4]
+    assert store.last_key() == ('2026-01-02T10:00:07', 7)
+    assert store.stats()['rows'] == 7
+
+
+def test_compaction_with_keep_copies_rows(client):
+    sender = 'keep-' + uuid.uuid4().hex[:8]
+    ids = store_messages(sender, [days_ago(3, minutes=m) for m in (3, 2, 1)])
+
+    assert compact('--keep') == 0
+    for message_id in ids:
+        assert wsgi.get_storage().get_message(message_id) is not None
+        assert wsgi.message_archive.get(message_id) is not None
+    # Rows in both places are listed once
+    assert listed_ids(client, sender, limit=10) == ids[::-1]
+
+    # The next run carries on after the archived rows
+    later = store_messages(sender, [days_ago(2)])[-1]
+    assert compact('--keep') == 0
+    assert wsgi.message_archive.get(later) is not None
+    assert wsgi.message_archive.stats()['rows'] >= len(ids) + 1
+
+
+def test_compaction_deletes_from_sqlite_by_default_and_reads_fall_through(client):
+    sender = 'delete-' + uuid.uuid4().hex[:8]
+    old = store_messages(sender, [days_ago(5, minutes=m) for m in (4, 3, 2, 1)])
+    recent = store_messages(sender, [days_ago(0)])[-1]
+
+    assert compact('--batch-size', '3') == 0
+    for message_id in old:
+        assert wsgi.get_storage().get_message(message_id) is None
+    assert wsgi.get_storage().get_message(recent) is not None
+
+    response = client.get(f'/messages/{old[0]}')
+    assert response.status_code == 200
+    assert response.get_json()['message']['from'] == sender
+
+    newest_first = [recent] + old[::-1]
+    # An unbounded listing only reads the table; a time range reaches the archive
+    assert listed_ids(client, sender) == [recent]
+    assert listed_ids(client, sender, since=days_ago(6)) == newest_first
+    assert listed_ids(client, sender, until=days_ago(1)) == newest_first[1:]
+    # Keyset pages cross from the table into the archive
+    page = client.get('/messages', query_string={'phone': sender, 'limit': 2}).get_json()
+    assert [message['id'] for message in page['messages']] == newest_first[:2]
+    rest = listed_ids(client, sender, limit=10, after=page['next_cursor'])
+    assert rest == newest_first[2:]
+
+
+class RemoteStorage:
+    name = 'supabase'
+
+    def __getattr__(self, attr):
+        raise AssertionError(f'{attr} called on a refused compaction')
+
+
+class CopyOnlyStorage:
+    """A remote backend with one old message, which must not be deleted"""
+    name = 'supabase'
+
+    def __init__(self):
+        self.rows = [{'id': 1, 'timestamp': days_ago(400), 'sender_phone': 'remote', 'data': {}}]
+
+    def list_messages_before(self, before, limit, after=None):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def delete_messages(self, ids):
+        raise AssertionError('deleted from an unshared archive')
+
+
+def test_remote_backend_keeps_rows_without_shared_archive(monkeypatch, tmp_path):
+    store = MessageArchive(str(tmp_path))
+    monkeypatch.setattr(wsgi, 'get_storage', CopyOnlyStorage)
+    monkeypatch.setattr(wsgi, 'message_archive', store)
+    monkeypatch.setattr(wsgi, 'refresh_message_rollups', lambda: 0)
+    assert compact() == 0
+    assert store.get(1)['sender_phone'] == 'remote'
+
+
+def test_delete_from_remote_backend_needs_shared_archive(monkeypatch):
+    monkeypatch.setattr(wsgi, 'get_storage', lambda: RemoteStorage())
+    assert compact('--delete') == 2
+
+    monkeypatch.setattr(archive, 'ARCHIVE_SHARED', True)
+    monkeypatch.setattr(wsgi, 'refresh_message_rollups', lambda: 0)
+    with pytest.raises(AssertionError, match='list_messages_before'):
+        compact('--delete')
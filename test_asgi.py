@@ -0,0 +1,132 @@
+"""Tests for the ASGI app: parity with the Flask routes, compression and admission control"""
+
+import json
+import uuid
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import admission
+import app as wsgi
+import asgi_app
+import compression
+
+
+@pytest.fixture
+def client():
+    return TestClient(asgi_app.app)
+
+
+def save_users(client, count=3):
+    phones = []
+    for i in range(count):
+        phone = '93' + str(uuid.uuid4().int)[:10]
+        body = {'user': phone, 'parent_name': f'Parent {i}', 'child_name': f'Child {i}', 'wishlist': [f'toy {i}']}
+        assert client.post('/save-user', json=body).status_code == 200
+        phones.append(phone)
+    return phones
+
+
+def test_messages_without_limit_returns_every_row(client, monkeypatch):
+    monkeypatch.setattr(wsgi, 'DEFAULT_PAGE_SIZE', 2)
+    sender = 'asgi-' + uuid.uuid4().hex[:8]
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': f'2026-03-06T10:00:0{i}'})
+                        for i in range(3)])
+
+    body = client.get('/messages', params={'phone': sender}).json()
+    assert body['count'] == 3 and 'next_cursor' not in body
+    paged = client.get('/messages', params={'phone': sender, 'limit': 2}).json()
+    assert paged['count'] == 2 and paged['next_cursor']
+
+
+def test_users_match_the_flask_app(client, monkeypatch):
+    save_users(client)
+    monkeypatch.setattr(wsgi, 'DEFAULT_PAGE_SIZE', 2)
+    expected = wsgi.app.test_client().get('/users').get_json()
+
+    assert client.get('/users').json() == expected
+    array = client.get('/users', params={'stream': 'json', 'limit': 2}).json()
+    assert array['status'] == 'success'
+    assert {user['phone']: user for user in array['users']} == expected['users']
+
+
+def test_operational_routes(client):
+    client.get('/users/nobody')
+    assert 'route="/users/{phone}"' in client.get('/metrics').text
+    assert client.get('/ingest/stats').json()['mode'] == wsgi.INGEST_MODE
+    assert client.get('/archive/stats').json()['status'] == 'success'
+    assert client.post('/cache/invalidate', json={'key': 'menu'}).json()['key'] == 'menu'
+    assert client.post('/cache/invalidate', json={'key': 'nope'}).status_code == 400
+
+
+@pytest.mark.parametrize('encoding', ['br', 'gzip'])
+def test_compression_negotiation(client, monkeypatch, encoding):
+    monkeypatch.setattr(compression, 'COMPRESS_MIN_SIZE', 1)
+    save_users(client)
+    accept = {'Accept-Encoding': f'{encoding}, identity;q=0.5'}
+
+    response = client.get('/users', headers=accept)
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.headers['ETag'].startswith('W/')
+    assert response.json()['users']
+
+    streamed = client.get('/users', params={'format': 'ndjson'}, headers=accept)
+    assert streamed.headers['Content-Encoding'] == encoding
+    assert 'Content-Length' not in streamed.headers
+    assert all(json.loads(line) for line in streamed.text.splitlines())
+
+    plain = client.get('/users', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in plain.headers
+
+
+def test_small_bodies_are_not_compressed(client):
+    response = client.get('/health', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+def admission_app(controller, seen=None):
+    async def stream(request):
+        async def rows():
+            for i in range(3):
+                seen.append(controller.active)
+                yield f'{i}\n'
+        return StreamingResponse(rows(), media_type='application/x-ndjson')
+
+    async def ok(request):
+        return JSONResponse({'status': 'success'})
+
+    app = Starlette(routes=[Route('/stream', stream), Route('/write', ok, methods=['POST']), Route('/read', ok)])
+    return admission.AdmissionMiddleware(app, controller=controller)
+
+
+def test_full_server_answers_503_to_writes_and_429_to_reads():
+    controller = admission.AsyncAdmissionController(1, max_queue=0)
+    client = TestClient(admission_app(controller))
+    controller.active = 1  # another request holds the only slot
+
+    write = client.post('/write')
+    assert write.status_code == 503 and int(write.headers['Retry-After']) >= 1
+    read = client.get('/read')
+    assert read.status_code == 429 and read.headers['Retry-After']
+    assert controller.rejected == {'queue_full': 2}
+
+
+def test_stream_holds_its_slot_until_sent():
+    controller = admission.AsyncAdmissionController(1)
+    seen = []
+    client = TestClient(admission_app(controller, seen))
+    assert client.get('/stream').text == '0\n1\n2\n'
+    assert seen == [1, 1, 1]
+    assert controller.active == 0 and controller.admitted == 1
+
+
+def test_request_queued_too_long_upstream_is_rejected(monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_QUEUE_TIME_MS', 100)
+    client = TestClient(admission_app(admission.AsyncAdmissionController(0)))
+    assert client.post('/write', headers={'X-Request-Start': 't=1000000000'}).status_code == 503
+    assert client.post('/write').status_code == 200
@@ -0,0 +1,48 @@
+"""Tests for the benchmark helpers in benchmark.py (no full benchmark run, no results file)"""
+
+import random
+
+import pytest
+
+import app as wsgi
+import benchmark
+from storage.sqlite_backend import SQLiteStorage
+
+
+@pytest.mark.parametrize('pct, expected', [(50, 5), (95, 10), (99, 10), (10, 1), (0, 1)])
+def test_nearest_rank_percentile(pct, expected):
+    assert benchmark.percentile([float(v) for v in range(1, 11)], pct) == expected
+    assert benchmark.percentile([], pct) == 0.0
+
+
+@pytest.mark.parametrize('name', list(benchmark.ENDPOINTS))
+def test_every_endpoint_request_is_served(name):
+    method, path, body = benchmark.ENDPOINTS[name](random.Random(1), 10)
+    response = wsgi.app.test_client().open(path, method=method, json=body)
+    assert response.status_code < 500, response.get_data(as_text=True)
+
+
+def test_seed_database(tmp_path):
+    db_path = str(tmp_path / 'bench.db')
+    benchmark.seed_database(db_path, users=12, messages=30)
+    db = SQLiteStorage(db_path)
+    assert len(db.list_users()) == 12
+    assert len(db.list_messages()) == 30
+    assert db.get_user(benchmark.seed_phone(11))['child_name'] == 'Child 11'
+
+
+def test_run_endpoint_reports_latency_and_throughput():
+    server = benchmark.InProcessServer({})
+    server.start()
+    try:
+        result = benchmark.run_endpoint(server.port, 'menu', concurrency=2, duration=0, requests_per_worker=3,
+                                        seeded_users=1, sample_rss=server.rss_kb)
+    finally:
+        server.server.shutdown()
+
+    assert result['requests'] == 6 and result['errors'] == 0
+    assert result['status_codes'] == {'200': 6}
+    latency = result['latency_ms']
+    assert 0 < latency['p50'] <= latency['p95'] <= latency['p99'] <= latency['max']
+    assert result['throughput_rps'] > 0
+    assert result['server_rss_kb']['peak'] > 0 and result['server_rss_kb']['after'] > 0
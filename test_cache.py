@@ -0,0 +1,413 @@
+"""Tests for the user cache (cache.LRUCache), single-flight request coalescing
+(cache.SingleFlight) and their use in app.py"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app as wsgi
+import cache
+from cache import LRUCache, SingleFlight
+
+
+class Clock:
+    """Stands in for time.monotonic in cache.py"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    users = LRUCache(ttl=30, negative_ttl=5)
+    users.set('a', {'name': 'A'})
+    users.set('missing', None)
+    assert users.get('a') == (True, {'name': 'A'})
+    assert users.get('missing') == (True, None)
+
+    clock.now += 5
+    # A "not found" result expires sooner than a found user
+    assert users.get('missing') == (False, None)
+    assert users.get('a') == (True, {'name': 'A'})
+    clock.now += 25
+    assert users.get('a') == (False, None)
+    assert users.stats()['expirations'] == 2
+
+
+def test_expired_user_is_served_stale_only_within_max_stale(clock):
+    users = LRUCache(ttl=30, max_stale=60)
+    users.set('a', {'name': 'A'})
+    users.set('missing', None)
+    clock.now += 31
+    assert users.get('a') == (False, None)
+    assert users.get_stale('a') == (True, {'name': 'A'})
+    # Negative results are never served stale
+    assert users.get_stale('missing') == (False, None)
+    clock.now += 60
+    assert users.get_stale('a') == (False, None)
+
+
+def test_least_recently_used_is_evicted():
+    users = LRUCache(max_size=2)
+    users.set('a', 1)
+    users.set('b', 2)
+    users.get('a')
+    users.set('c', 3)
+    assert users.get('b') == (False, None)
+    assert users.get('a') == (True, 1) and users.get('c') == (True, 3)
+    assert users.stats()['evictions'] == 1
+
+
+def test_values_are_copied_in_and_out():
+    users = LRUCache()
+    user = {'wishlist': ['ball']}
+    users.set('a', user)
+    user['wishlist'].append('bike')
+    _, cached = users.get('a')
+    cached['wishlist'].append('kite')
+    assert users.get('a') == (True, {'wishlist': ['ball']})
+
+
+def test_disabled_cache_stores_nothing():
+    for users in (LRUCache(max_size=0), LRUCache(ttl=0)):
+        users.set('a', 1)
+        assert users.get('a') == (False, None)
+
+
+def test_zero_negative_ttl_drops_the_old_value():
+    users = LRUCache(negative_ttl=0)
+    users.set('a', {'name': 'A'})
+    users.set('a', None)
+    assert users.get('a') == (False, None)
+
+
+def test_fill_from_a_load_started_before_a_write_is_skipped():
+    users = LRUCache()
+    stamp = users.stamp()
+    users.set('a', {'name': 'new'})
+    assert not users.fill('a', {'name': 'old'}, stamp)
+    assert users.get('a') == (True, {'name': 'new'})
+
+    stamp = users.stamp()
+    users.invalidate('a')
+    assert not users.fill('a', {'name': 'new'}, stamp)
+    assert users.get('a') == (False, None)
+    assert users.stats()['stale_fills'] == 2
+
+    # Writes to other keys don't block the fill
+    stamp = users.stamp()
+    users.set('b', 2)
+    assert users.fill('a', {'name': 'newer'}, stamp)
+    assert users.get('a') == (True, {'name': 'newer'})
+
+
+def test_fill_after_clear_or_forgotten_write_is_skipped():
+    users = LRUCache(max_size=2)
+    stamp = users.stamp()
+    users.clear()
+    assert not users.fill('a', 1, stamp)
+
+    # Once more keys are written than the cache holds, the oldest write is
+    # forgotten and any fill from before it is refused
+    stamp = users.stamp()
+    for key in ('a', 'b', 'c'):
+        users.invalidate(key)
+    assert not users.fill('a', 1, stamp)
+    assert users.fill('a', 1, users.stamp())
+
+
+class BlockingLoader:
+    """Loader that holds every call until released, counting the calls"""
+
+    def __init__(self, result=None, error=None):
+        self.result = result if result is not None else {'items': [1, 2]}
+        self.error = error
+        self.calls = 0
+        self.release = threading.Event()
+
+    def __call__(self, *args):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return self.result
+
+    async def acall(self, *args):
+        self.calls += 1
+        while not self.release.is_set():
+            await asyncio.sleep(0.005)
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return condition()
+
+
+def run_threads(flight, loader, count, *args):
+    """Start count threads calling loader through flight; returns (threads, results, errors)"""
+    results, errors = [], []
+
+    def worker():
+        try:
+            results.append(flight.call('load', loader, *args))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_calls_share_one_backend_call():
+    flight = SingleFlight()
+    loader = BlockingLoader()
+    threads, results, errors = run_threads(flight, loader, 8, 'key')
+    assert wait_for(lambda: flight.stats()['coalesced'] == 7)
+    loader.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert loader.calls == 1
+    assert errors == [] and results == [loader.result] * 8
+    # Waiters get copies, so one caller mutating its result can't affect another
+    assert len({id(result) for result in results}) == 8
+    stats = flight.stats()
+    assert stats['executed'] == 1 and stats['in_flight'] == 0
+    assert stats['by_name']['load']['coalesce_ratio'] == 0.875
+
+
+def test_different_arguments_are_not_coalesced():
+    flight = SingleFlight()
+    loader = BlockingLoader()
+    loader.release.set()
+    assert flight.call('load', loader, 'a') == flight.call('load', loader, 'b')
+    # Nothing is kept once a call returns
+    flight.call('load', loader, 'a')
+    assert loader.calls == 3
+    assert flight.stats()['coalesced'] == 0
+
+
+def test_error_is_shared_with_waiters():
+    flight = SingleFlight()
+    loader = BlockingLoader(error=TimeoutError('slow'))
+    threads, results, errors = run_threads(flight, loader, 4, 'key')
+    assert wait_for(lambda: flight.stats()['coalesced'] == 3)
+    loader.release.set()
+    for thread in threads:
+        thread.join()
+    assert loader.calls == 1
+    assert results == [] and len(errors) == 4
+    assert all(isinstance(error, TimeoutError) for error in errors)
+
+
+def test_disabled_runs_every_call():
+    flight = SingleFlight(enabled=False)
+    loader = BlockingLoader()
+    loader.release.set()
+    threads, results, _ = run_threads(flight, loader, 3, 'key')
+    for thread in threads:
+        thread.join()
+    assert loader.calls == 3
+
+
+def test_async_tasks_and_threads_share_one_call():
+    flight = SingleFlight()
+    loader = BlockingLoader()
+
+    async def main():
+        tasks = [asyncio.create_task(flight.acall('load', loader.acall, 'key')) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        # A thread outside the loop joins the async leader's flight
+        threads, thread_results, _ = run_threads(flight, loader, 2, 'key')
+        while flight.stats()['coalesced'] < 6:
+            await asyncio.sleep(0.005)
+        loader.release.set()
+        results = await asyncio.gather(*tasks)
+        await asyncio.to_thread(lambda: [thread.join() for thread in threads])
+        return results + thread_results
+
+    results = asyncio.run(main())
+    assert loader.calls == 1
+    assert results == [loader.result] * 7
+
+
+def test_sync_call_on_the_leaders_loop_thread_runs_alone():
+    flight = SingleFlight()
+    loader = BlockingLoader()
+
+    async def main():
+        task = asyncio.create_task(flight.acall('load', loader.acall, 'key'))
+        await asyncio.sleep(0.01)
+        # Waiting here would block the loop the leader needs; the call runs itself
+        sync_loader = BlockingLoader()
+        sync_loader.release.set()
+        result = flight.call('load', sync_loader, 'key')
+        loader.release.set()
+        return result, sync_loader.calls, await task
+
+    result, sync_calls, leader_result = asyncio.run(main())
+    assert sync_calls == 1
+    assert result == leader_result == loader.result
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+def test_concurrent_user_reads_hit_storage_once(client, monkeypatch):
+    phone = '93' + str(time.time_ns())[-10:]
+    assert client.post('/save-user', json={'user': phone, 'parent_name': 'Mom', 'child_name': 'Kid'}).status_code == 200
+    wsgi.user_cache.clear()
+
+    release = threading.Event()
+    calls = []
+    load_user = wsgi.load_user
+
+    def slow_load_user(key):
+        calls.append(key)
+        release.wait(5)
+        return load_user(key)
+
+    monkeypatch.setattr(wsgi, 'load_user', slow_load_user)
+    flight = SingleFlight()
+    monkeypatch.setattr(wsgi, 'single_flight', flight)
+
+    responses = []
+
+    def request():
+        with wsgi.app.test_client() as c:
+            responses.append(c.post('/check-or-create-user', json={'phone': phone}))
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    assert wait_for(lambda: flight.stats()['coalesced'] == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [phone]
+    assert [response.status_code for response in responses] == [200] * 5
+    assert all(response.get_json()['exists'] and response.get_json()['child_name'] == 'Kid'
+               for response in responses)
+
+
+def test_save_during_a_user_read_keeps_the_saved_user_cached(client, monkeypatch):
+    phone = '94' + str(time.time_ns())[-10:]
+    body = {'user': phone, 'parent_name': 'Mom', 'child_name': 'Kid'}
+    assert client.post('/save-user', json=body).status_code == 200
+    wsgi.user_cache.clear()
+
+    loaded, release = threading.Event(), threading.Event()
+    load_user = wsgi.load_user
+
+    def slow_load_user(key):
+        user = load_user(key)
+        loaded.set()
+        release.wait(5)
+        return user
+
+    monkeypatch.setattr(wsgi, 'load_user', slow_load_user)
+    reader = threading.Thread(target=wsgi.get_user, args=(phone,))
+    reader.start()
+    assert loaded.wait(5)
+    # The read has the old row; the save lands before the read finishes
+    monkeypatch.setattr(wsgi, 'load_user', load_user)
+    assert client.post('/save-user', json={**body, 'child_name': 'Renamed'}).status_code == 200
+    release.set()
+    reader.join()
+
+    assert wsgi.user_cache.get(phone) == (True, wsgi.load_user(phone))
+    assert wsgi.user_cache.get(phone)[1]['child_name'] == 'Renamed'
+
+
+def test_forget_starts_a_fresh_call_for_later_callers():
+    flight = SingleFlight()
+    old, new = BlockingLoader(result={'v': 'old'}), BlockingLoader(result={'v': 'new'})
+    threads, results, _ = run_threads(flight, old, 2, 'key')
+    assert wait_for(lambda: flight.stats()['coalesced'] == 1)
+
+    flight.forget('load', 'key')
+    later, later_results, _ = run_threads(flight, new, 2, 'key')
+    assert wait_for(lambda: flight.stats()['coalesced'] == 2)
+    # The old call finishing doesn't end the new one
+    old.release.set()
+    for thread in threads:
+        thread.join()
+    assert flight.stats()['in_flight'] == 1
+    new.release.set()
+    for thread in later:
+        thread.join()
+
+    assert results == [{'v': 'old'}] * 2 and later_results == [{'v': 'new'}] * 2
+    assert old.calls == new.calls == 1
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_save_during_a_coalesced_read_is_seen_by_later_readers(client, monkeypatch):
+    phone = '95' + str(time.time_ns())[-10:]
+    body = {'user': phone, 'parent_name': 'Mom', 'child_name': 'Kid'}
+    assert client.post('/save-user', json=body).status_code == 200
+    wsgi.user_cache.clear()
+    flight = SingleFlight()
+    monkeypatch.setattr(wsgi, 'single_flight', flight)
+
+    loaded, release = threading.Event(), threading.Event()
+    load_user = wsgi.load_user
+    calls = []
+
+    def slow_load_user(key):
+        user = load_user(key)
+        calls.append(user['child_name'])
+        if len(calls) == 1:
+            loaded.set()
+            release.wait(5)
+        return user
+
+    monkeypatch.setattr(wsgi, 'load_user', slow_load_user)
+    results = {}
+
+    def read(name):
+        results[name] = wsgi.get_user(phone)
+
+    before = [threading.Thread(target=read, args=(name,)) for name in ('leader', 'early')]
+    for thread in before:
+        thread.start()
+    assert loaded.wait(5) and wait_for(lambda: flight.stats()['coalesced'] == 1)
+
+    assert client.post('/save-user', json={**body, 'child_name': 'Renamed'}).status_code == 200
+    # Drop the saved row again so the next read has to go to the database
+    # while the old flight is still running
+    wsgi.user_cache.invalidate(phone)
+    late = threading.Thread(target=read, args=('late',))
+    late.start()
+    late.join(5)
+    release.set()
+    for thread in before:
+        thread.join()
+
+    assert calls == ['Kid', 'Renamed']
+    assert results['late']['child_name'] == 'Renamed'
+    # Readers that joined before the save get the row as it was, but can't cache it
+    assert results['early']['child_name'] == 'Kid'
+    assert wsgi.user_cache.get(phone)[1]['child_name'] == 'Renamed'
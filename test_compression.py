@@ -0,0 +1,86 @@
+"""Tests for response compression on the Flask app (compression.init_app)"""
+
+import gzip
+import json
+import uuid
+
+import brotli
+import pytest
+
+import app as wsgi
+import compression
+
+DECODERS = {'br': brotli.decompress, 'gzip': gzip.decompress}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(compression, 'COMPRESS_MIN_SIZE', 1)
+    client = wsgi.app.test_client()
+    body = {'user': '92' + str(uuid.uuid4().int)[:10], 'parent_name': 'Mom', 'child_name': 'Kid'}
+    assert client.post('/save-user', json=body).status_code == 200
+    return client
+
+
+@pytest.mark.parametrize('accept, encoding', [('br, gzip', 'br'), ('gzip;q=1, br;q=0.5', 'gzip'),
+                                              ('gzip', 'gzip'), ('*', 'br')])
+def test_best_accepted_encoding_is_used(client, accept, encoding):
+    response = client.get('/users', headers={'Accept-Encoding': accept})
+    assert response.headers['Content-Encoding'] == encoding
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert json.loads(DECODERS[encoding](response.get_data()))['users']
+
+
+@pytest.mark.parametrize('headers', [{}, {'Accept-Encoding': 'identity'}, {'Accept-Encoding': 'deflate'}])
+def test_identity_when_nothing_supported_is_accepted(client, headers):
+    response = client.get('/users', headers=headers)
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.get_json()['users']
+
+
+def test_compressed_etag_is_weak_and_still_matches(client):
+    accept = {'Accept-Encoding': 'gzip'}
+    etag = client.get('/users', headers=accept).headers['ETag']
+    assert etag.startswith('W/')
+    assert client.get('/users', headers={**accept, 'If-None-Match': etag}).status_code == 304
+
+
+def test_streamed_ndjson_is_compressed_without_a_length(client, monkeypatch):
+    monkeypatch.setattr(compression, 'COMPRESS_STREAM_FLUSH', 1)
+    sender = 'gz-' + uuid.uuid4().hex[:8]
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'text'}) for _ in range(3)])
+    response = client.get('/messages', query_string={'phone': sender, 'format': 'ndjson'},
+                          headers={'Accept-Encoding': 'gzip'})
+    assert response.is_streamed and response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    lines = gzip.decompress(response.get_data()).decode('utf-8').splitlines()
+    assert len(lines) == 3 and all(json.loads(line)['id'] for line in lines)
+
+
+def test_small_bodies_are_left_alone(monkeypatch):
+    monkeypatch.setattr(compression, 'COMPRESS_MIN_SIZE', 1024)
+    response = wsgi.app.test_client().get('/health', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+
+
+class Chunks:
+    """Body iterator that records being closed, like a streamed response's generator"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('encoding', ['br', 'gzip'])
+def test_compress_stream_round_trips_and_closes_the_body(encoding):
+    chunks = Chunks(['ab', b'cd', 'é'])
+    data = b''.join(compression.compress_stream(chunks, encoding))
+    assert DECODERS[encoding](data) == 'abcdé'.encode('utf-8')
+    assert chunks.closed
@@ -0,0 +1,156 @@
+"""Tests for the ETag / 304 handling of /users and /messages"""
+
+import time
+import uuid
+
+import pytest
+
+import app as wsgi
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+@pytest.fixture
+def india_time(monkeypatch):
+    """Run with a local clock ahead of UTC, as on a server in Asia/Kolkata"""
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def phone_number():
+    return '91' + str(uuid.uuid4().int)[:10]
+
+
+def save_user(client, phone, wishlist=None):
+    body = {'user': phone, 'parent_name': 'Mom', 'child_name': 'Kid', 'wishlist': wishlist or []}
+    assert client.post('/save-user', json=body).status_code == 200
+
+
+def conditional_get(client, path, etag):
+    return client.get(path, headers={'If-None-Match': etag})
+
+
+def test_unchanged_users_return_304(client):
+    save_user(client, phone_number())
+    first = client.get('/users')
+    assert first.status_code == 200 and first.headers['ETag'].startswith('W/')
+
+    again = conditional_get(client, '/users', first.headers['ETag'])
+    assert again.status_code == 304
+    assert again.data == b''
+
+
+def test_item_change_after_local_time_save_changes_users_etag(client, india_time):
+    phone = phone_number()
+    save_user(client, phone)
+    save_user(client, phone_number())
+    etag = client.get('/users').headers['ETag']
+
+    assert client.post('/add-item', json={'user': phone, 'item_name': 'Bike'}).status_code == 200
+
+    response = conditional_get(client, '/users', etag)
+    assert response.status_code == 200
+    wishlist = response.get_json()['users'][phone]['wishlist']
+    assert [item['item_name'] for item in wishlist] == ['Bike']
+
+
+def test_every_users_write_changes_users_etag(client):
+    phone = phone_number()
+    save_user(client, phone)
+    etags = [client.get('/users').headers['ETag']]
+    for path, body in (('/add-item', {'user': phone, 'item_name': 'Ball'}),
+                       ('/mark-bought', {'user': phone, 'item_name': 'Ball'}),
+                       ('/remove-item', {'user': phone, 'item_name': 'Ball'})):
+        assert client.post(path, json=body).status_code in (200, 201)
+        etags.append(client.get('/users').headers['ETag'])
+    save_user(client, phone)
+    etags.append(client.get('/users').headers['ETag'])
+
+    assert len(set(etags)) == len(etags)
+
+
+def test_users_etag_depends_on_query(client):
+    save_user(client, phone_number())
+    full = client.get('/users').headers['ETag']
+    projected = client.get('/users?fields=phone').headers['ETag']
+    assert full != projected
+    assert conditional_get(client, '/users?fields=phone', full).status_code == 200
+
+
+def test_new_message_changes_messages_etag(client):
+    sender = phone_number()
+    path = f'/messages?phone={sender}'
+    assert client.post('/webhook', json={'from': sender, 'text': 'hi'}).status_code == 200
+    etag = client.get(path).headers['ETag']
+    assert conditional_get(client, path, etag).status_code == 304
+
+    assert client.post('/webhook', json={'from': sender, 'text': 'again'}).status_code == 200
+    response = conditional_get(client, path, etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('path', ['/menu', '/primary-input-fields'])
+def test_reference_data_returns_304_for_its_etag(client, path):
+    first = client.get(path)
+    assert first.status_code == 200
+    again = conditional_get(client, path, first.headers['ETag'])
+    assert again.status_code == 304
+    assert again.data == b''
+
+
+def test_reference_etag_follows_content(client, monkeypatch):
+    etag = client.get('/menu').headers['ETag']
+    # Reloading the same rows keeps the ETag
+    assert client.post('/cache/invalidate', json={'key': 'menu'}).status_code == 200
+    assert conditional_get(client, '/menu', etag).status_code == 304
+
+    items = wsgi.get_menu_items() + [{'id': 'SHARE', 'title': 'Share Wishlist'}]
+    monkeypatch.setitem(wsgi.REFERENCE_LOADERS, 'menu', lambda: items)
+    client.post('/cache/invalidate', json={'key': 'menu'})
+    response = conditional_get(client, '/menu', etag)
+    assert response.status_code == 200
+    assert response.get_json()['count'] == len(items)
+
+    monkeypatch.undo()
+    client.post('/cache/invalidate', json={'key': 'menu'})
+    assert conditional_get(client, '/menu', etag).status_code == 304
+
+
+def test_backdated_message_changes_messages_etag(client):
+    sender = phone_number()
+    path = f'/messages?phone={sender}'
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': '2026-05-01T10:00:00'})])
+    etag = client.get(path).headers['ETag']
+
+    # A late delivery (or spool replay) sorts below the newest message
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': '2026-04-01T10:00:00'})])
+    response = conditional_get(client, path, etag)
+    assert response.status_code == 200
+    assert len(response.get_json()['messages']) == 2
+
+
+def test_deleted_message_changes_messages_etag(client):
+    sender = phone_number()
+    path = f'/messages?phone={sender}'
+    for text in ('one', 'two'):
+        assert client.post('/webhook', json={'from': sender, 'text': text}).status_code == 200
+    etag = client.get(path).headers['ETag']
+    oldest = min(row['id'] for row in wsgi.get_storage().list_messages(filters={'sender_phone': sender}))
+
+    wsgi.get_storage().delete_messages([oldest])
+    response = conditional_get(client, path, etag)
+    assert response.status_code == 200
+    assert len(response.get_json()['messages']) == 1
+
+
+def test_no_etag_without_a_table_version(client, monkeypatch):
+    monkeypatch.setattr(wsgi, 'messages_version', lambda: None)
+    response = client.get('/messages')
+    assert response.status_code == 200 and 'ETag' not in response.headers
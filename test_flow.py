@@ -0,0 +1,262 @@
+"""Tests for the /flow data_exchange endpoint (flow.py and its wiring in app.py)"""
+
+import uuid
+
+import pytest
+
+import app as wsgi
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+def exchange(client, action, screen=None, data=None, token=None, phone=None):
+    token = token or f'token-{phone}'
+    body = {'data_exchange': {'action': action, 'screen': screen, 'data': data or {}, 'flow_token': token}}
+    if phone:
+        body['user'] = phone
+    response = client.post('/flow', json=body)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def add_item(client, phone, title, token=None):
+    return exchange(client, 'data_exchange', 'ADD_ITEM', {'add_action': 'add_item', 'new_item': title},
+                    token=token, phone=phone)
+
+
+def start_profile(client, phone, token=None):
+    exchange(client, 'INIT', token=token, phone=phone)
+    return exchange(client, 'data_exchange', 'PARENT_INFO', {'parent_name': 'Mom', 'child_name': 'Kid'},
+                    token=token, phone=phone)
+
+
+def test_ping(client):
+    assert exchange(client, 'ping') == {'data': {'status': 'active'}}
+
+
+def test_flow_token_is_required(client):
+    assert client.post('/flow', json={'data_exchange': {'action': 'INIT'}}).status_code == 400
+
+
+def test_changes_are_saved_before_the_screen_is_answered(client):
+    phone = '+15550001'
+    assert start_profile(client, phone)['screen'] == 'ADD_ITEM'
+    add_item(client, phone, 'Bike')
+
+    # No background writer: the row is already there
+    user = wsgi.load_user(phone)
+    assert (user['parent_name'], user['child_name']) == ('Mom', 'Kid')
+    assert [item['item_name'] for item in user['wishlist']] == ['Bike']
+
+
+def test_user_is_visible_right_after_the_flow(client):
+    phone = '+15550002'
+    # Caches a "not found" for the phone
+    assert client.get(f'/users/{phone}').status_code == 404
+
+    start_profile(client, phone)
+    add_item(client, phone, 'Kite')
+    done = exchange(client, 'data_exchange', 'ADD_ITEM', {'done': 'true'}, phone=phone)
+    assert done['screen'] == 'CHECKOUT'
+    assert done['data']['wishlist'] == ['Kite']
+
+    response = client.get(f'/users/{phone}')
+    assert response.status_code == 200
+    assert [item['item_name'] for item in response.get_json()['user']['wishlist']] == ['Kite']
+    check = client.post('/check-or-create-user', json={'phone': phone})
+    assert check.get_json()['exists'] is True
+
+
+def test_next_screen_can_be_served_by_another_worker(client):
+    phone = '+15550003'
+    start_profile(client, phone)
+    add_item(client, phone, 'Ball')
+
+    # Another process has none of this one's memory
+    wsgi.flow_sessions.clear()
+    wsgi.user_cache.clear()
+    screen = add_item(client, phone, 'Doll')
+    assert [item['title'] for item in screen['data']['wishlist_items']] == ['Ball', 'Doll']
+    assert [item['item_name'] for item in wsgi.load_user(phone)['wishlist']] == ['Ball', 'Doll']
+
+
+def test_removing_an_item(client):
+    phone = '+15550004'
+    start_profile(client, phone)
+    add_item(client, phone, 'Ball')
+    screen = add_item(client, phone, 'Bike')
+    ball = screen['data']['wishlist_items'][0]['id']
+    screen = exchange(client, 'data_exchange', 'ADD_ITEM',
+                      {'remove_action': 'remove_items', 'remove_item_ids': [ball]}, phone=phone)
+    assert [item['title'] for item in screen['data']['wishlist_items']] == ['Bike']
+    assert [item['item_name'] for item in wsgi.load_user(phone)['wishlist']] == ['Bike']
+
+
+def test_duplicate_items_are_not_added(client):
+    phone = '+15550005'
+    start_profile(client, phone)
+    add_item(client, phone, 'Ball')
+    screen = add_item(client, phone, ' ball ')
+    assert [item['title'] for item in screen['data']['wishlist_items']] == ['Ball']
+
+
+def test_session_without_phone_stays_in_memory(client):
+    exchange(client, 'data_exchange', 'PARENT_INFO', {'parent_name': 'A', 'child_name': 'B'}, token='anon')
+    add_item(client, None, 'Train', token='anon')
+    done = exchange(client, 'data_exchange', 'ADD_ITEM', {'done': 'true'}, token='anon')
+    assert done['data']['wishlist'] == ['Train']
+
+
+def test_asgi_flow_saves_before_answering():
+    from starlette.testclient import TestClient
+
+    import asgi_app
+
+    phone = '+15550006'
+    client = TestClient(asgi_app.app)
+
+    def post(data, screen):
+        body = {'user': phone, 'data_exchange': {'action': 'data_exchange', 'screen': screen, 'data': data,
+                                                 'flow_token': 'asgi-token'}}
+        return client.post('/flow', json=body).json()
+
+    post({'parent_name': 'Mom', 'child_name': 'Kid'}, 'PARENT_INFO')
+    post({'add_action': 'add_item', 'new_item': 'Yo-yo'}, 'ADD_ITEM')
+    assert [item['item_name'] for item in wsgi.load_user(phone)['wishlist']] == ['Yo-yo']
+    assert client.get(f'/users/{phone}').status_code == 200
+
+
+def test_flow_does_not_overwrite_concurrent_item_changes(client):
+    phone = '+15550007'
+    start_profile(client, phone)
+    screen = add_item(client, phone, 'Ball')
+    ball = screen['data']['wishlist_items'][0]['id']
+
+    # Another client edits the wishlist while the flow is open
+    assert client.post('/add-item', json={'user': phone, 'item_name': 'Puzzle'}).status_code == 200
+    assert client.post('/mark-bought', json={'user': phone, 'item_id': ball}).status_code == 200
+
+    add_item(client, phone, 'Bike')
+    exchange(client, 'data_exchange', 'PARENT_INFO', {'parent_name': 'Dad', 'child_name': 'Kid'}, phone=phone)
+
+    user = wsgi.load_user(phone)
+    assert user['parent_name'] == 'Dad'
+    items = {item['item_name']: item['status'] for item in user['wishlist']}
+    assert items == {'Ball': 'Bought', 'Puzzle': 'Pending', 'Bike': 'Pending'}
+
+
+def test_legacy_items_are_removed_by_name(client):
+    phone = '+15550008'
+    client.post('/save-user', json={'user': phone, 'parent_name': 'Mom', 'child_name': 'Kid',
+                                    'wishlist': ['Robot', 'Drum']})
+    screen = exchange(client, 'BACK', 'ADD_ITEM', phone=phone)
+    robot = screen['data']['wishlist_items'][0]['id']
+    exchange(client, 'data_exchange', 'ADD_ITEM',
+             {'remove_action': 'remove_items', 'remove_item_ids': [robot]}, phone=phone)
+    assert wsgi.load_user(phone)['wishlist'] == ['Drum']
+
+
+def test_items_collected_before_the_profile_are_saved_with_it(client):
+    phone = '+15550009'
+    exchange(client, 'INIT', phone=phone)
+    add_item(client, phone, 'Sled')
+    assert wsgi.load_user(phone) is None
+    exchange(client, 'data_exchange', 'PARENT_INFO', {'parent_name': 'Mom', 'child_name': 'Kid'}, phone=phone)
+    assert [item['item_name'] for item in wsgi.load_user(phone)['wishlist']] == ['Sled']
+
+
+class CountingStorage:
+    """Delegates to the app's storage and records the name of every call"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def __getattr__(self, attr):
+        method = getattr(self.storage, attr)
+
+        def call(*args, **kwargs):
+            self.calls.append(attr)
+            return method(*args, **kwargs)
+        return call
+
+
+@pytest.fixture
+def counting(monkeypatch):
+    storage = CountingStorage(wsgi.get_storage())
+    monkeypatch.setattr(wsgi, 'get_storage', lambda: storage)
+    return storage
+
+
+def test_unchanged_screens_are_served_from_memory(client, counting):
+    phone = '+15550010'
+    start_profile(client, phone)
+    add_item(client, phone, 'Ball')
+    counting.calls.clear()
+
+    exchange(client, 'INIT', phone=phone)
+    back = exchange(client, 'BACK', 'ADD_ITEM', phone=phone)
+    done = exchange(client, 'data_exchange', 'ADD_ITEM', {'done': 'true'}, phone=phone)
+    assert [item['title'] for item in back['data']['wishlist_items']] == ['Ball']
+    assert done['data']['wishlist'] == ['Ball']
+    assert counting.calls == []
+
+
+def test_each_change_is_one_backend_call(client, counting):
+    phone = '+15550011'
+    start_profile(client, phone)
+    screen = add_item(client, phone, 'Ball')
+    ball = screen['data']['wishlist_items'][0]['id']
+    counting.calls.clear()
+
+    # Removing one item and adding another in the same request
+    exchange(client, 'data_exchange', 'ADD_ITEM',
+             {'remove_action': 'remove_items', 'remove_item_ids': [ball],
+              'add_action': 'add_item', 'new_item': 'Kite'}, phone=phone)
+    assert counting.calls == ['apply_flow_changes']
+    assert [item['item_name'] for item in wsgi.load_user(phone)['wishlist']] == ['Kite']
+
+
+def test_replayed_changes_are_applied_once():
+    phone = '+15550012'
+    storage = wsgi.get_storage()
+    kite = {'item_id': 'item_1', 'item_name': 'Kite', 'status': 'Pending'}
+    changes = ({'parent_name': 'Mom', 'child_name': 'Kid'}, [kite], [])
+    first = storage.apply_flow_changes(phone, *changes)
+    # A retry after a lost response sends the same changes again
+    again = storage.apply_flow_changes(phone, *changes)
+    assert first['wishlist'] == again['wishlist'] == [kite]
+
+    removal = (None, [], [{'item_id': 'item_1', 'item_name': None}])
+    storage.apply_flow_changes(phone, *removal)
+    assert storage.apply_flow_changes(phone, *removal)['wishlist'] == []
+    assert storage.apply_flow_changes('+15550099', None, [kite], []) is None
+
+
+def test_session_without_phone_is_shared_by_flow_token(client):
+    token = 'shared-' + uuid.uuid4().hex
+    exchange(client, 'data_exchange', 'PARENT_INFO', {'parent_name': 'A', 'child_name': 'B'}, token=token)
+    # Each request lands on another worker
+    wsgi.flow_sessions.clear()
+    add_item(client, None, 'Train', token=token)
+    wsgi.flow_sessions.clear()
+    done = exchange(client, 'data_exchange', 'ADD_ITEM', {'done': 'true'}, token=token)
+    assert done['data']['wishlist'] == ['Train']
+
+
+def test_stale_session_copy_is_not_saved_over_a_newer_one(client):
+    token = 'stale-' + uuid.uuid4().hex
+    add_item(client, None, 'Train', token=token)
+    found, stale = wsgi.flow_sessions.get(token)
+    assert found
+
+    # Another worker adds an item while this one still holds its copy
+    wsgi.flow_sessions.clear()
+    add_item(client, None, 'Plane', token=token)
+    wsgi.flow_sessions.set(token, stale)
+
+    screen = add_item(client, None, 'Boat', token=token)
+    assert [item['title'] for item in screen['data']['wishlist_items']] == ['Train', 'Plane', 'Boat']
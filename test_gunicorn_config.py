@@ -0,0 +1,57 @@
+"""Tests for the gunicorn worker presets and fork hooks in gunicorn_config.py"""
+
+import os
+import runpy
+
+import pytest
+
+import app as wsgi
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn_config.py')
+
+
+@pytest.fixture
+def load(monkeypatch, tmp_path):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3})
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+    for name in ('GUNICORN_WORKERS', 'WEB_CONCURRENCY', 'GUNICORN_THREADS', 'GUNICORN_PRELOAD'):
+        monkeypatch.delenv(name, raising=False)
+
+    def load(**env):
+        for name, value in env.items():
+            monkeypatch.setenv(name, value)
+        return runpy.run_path(CONFIG)
+    return load
+
+
+@pytest.mark.parametrize('worker_class, workers, threads', [('gthread', 5, 8), ('sync', 9, 1)])
+def test_presets_follow_the_cpu_count(load, worker_class, workers, threads):
+    config = load(GUNICORN_WORKER_CLASS=worker_class)
+    assert (config['worker_class'], config['workers'], config['threads']) == (worker_class, workers, threads)
+    assert config['preload_app'] is True
+
+
+def test_environment_overrides_the_preset(load):
+    config = load(GUNICORN_WORKER_CLASS='gthread', WEB_CONCURRENCY='3', GUNICORN_THREADS='2', GUNICORN_PRELOAD='false')
+    assert (config['workers'], config['threads'], config['preload_app']) == (3, 2, False)
+    assert load(GUNICORN_WORKERS='7', WEB_CONCURRENCY='3')['workers'] == 7
+
+
+def test_unknown_worker_class_is_rejected(load):
+    with pytest.raises(ValueError, match='GUNICORN_WORKER_CLASS'):
+        load(GUNICORN_WORKER_CLASS='eventlet')
+
+
+def test_fork_hooks_reset_the_database_connections(load, monkeypatch):
+    config = load(GUNICORN_WORKER_CLASS='gthread')
+    resets = []
+    monkeypatch.setattr(wsgi, 'reset_storage', lambda: resets.append(True))
+    config['pre_fork'](None, None)
+    config['post_fork'](None, None)
+    assert len(resets) == 2
+
+
+def test_storage_works_after_a_reset():
+    wsgi.get_storage().ping()
+    wsgi.reset_storage()
+    wsgi.get_storage().ping()
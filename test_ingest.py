@@ -0,0 +1,100 @@
+"""Tests for the write-behind ingest queue (ingest.py)"""
+
+import threading
+import time
+
+from ingest import IngestQueue
+
+
+class SlowWriter:
+    """flush_fn that takes a while and records every row it wrote"""
+
+    def __init__(self, delay=0.0, failures=0):
+        self.delay = delay
+        self.failures = failures
+        self.rows = []
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, batch):
+        with self.lock:
+            self.calls += 1
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('database unavailable')
+        time.sleep(self.delay)
+        with self.lock:
+            self.rows.extend(batch)
+
+
+def test_rows_are_written_in_batches():
+    writer = SlowWriter()
+    q = IngestQueue(writer, batch_size=10, max_delay=0.05)
+    for i in range(25):
+        assert q.put({'n': i})
+    q.stop()
+    assert [row['n'] for row in writer.rows] == list(range(25))
+    assert writer.calls <= 5
+    assert q.stats()['flushed'] == 25
+
+
+def test_flush_waits_for_the_batch_the_flusher_is_writing():
+    writer = SlowWriter(delay=0.3)
+    q = IngestQueue(writer, batch_size=1, max_delay=0)
+    q.put({'n': 1})
+    # Let the flusher take the row off the queue and start writing it
+    time.sleep(0.1)
+    assert q.stats()['queue_depth'] == 0
+    q.flush()
+    assert writer.rows == [{'n': 1}]
+    q.stop()
+
+
+def test_stop_drains_everything_queued():
+    writer = SlowWriter(delay=0.01)
+    q = IngestQueue(writer, batch_size=7, max_delay=1.0)
+    for i in range(50):
+        q.put({'n': i})
+    q.stop()
+    assert sorted(row['n'] for row in writer.rows) == list(range(50))
+
+
+def test_full_queue_rejects_rows():
+    gate = threading.Event()
+    q = IngestQueue(lambda batch: gate.wait(), max_size=2, batch_size=100, max_delay=10)
+    assert q.put({'n': 1}) and q.put({'n': 2})
+    assert not q.put({'n': 3})
+    assert q.stats()['rejected'] == 1
+    gate.set()
+    q.stop()
+
+
+def test_failed_batches_are_retried():
+    writer = SlowWriter(failures=2)
+    q = IngestQueue(writer, batch_size=5, max_delay=0, max_retries=3)
+    q.put({'n': 1})
+    q.stop()
+    assert writer.rows == [{'n': 1}]
+    assert q.stats()['flush_errors'] == 2
+
+
+def test_batches_that_keep_failing_go_to_the_dead_letter_store():
+    dead = []
+    q = IngestQueue(SlowWriter(failures=100), batch_size=5, max_delay=0, max_retries=1,
+                    dead_letter=dead.extend)
+    q.put({'n': 1})
+    q.put({'n': 2})
+    q.stop()
+    assert sorted(row['n'] for row in dead) == [1, 2]
+    stats = q.stats()
+    assert stats['dead_lettered'] == 2 and stats['dropped'] == 0
+
+
+def test_batches_are_dropped_when_dead_lettering_fails():
+    def broken(rows):
+        raise OSError('disk full')
+
+    q = IngestQueue(SlowWriter(failures=100), max_delay=0, max_retries=0, dead_letter=broken)
+    q.put({'n': 1})
+    q.stop()
+    assert q.stats()['dropped'] == 1
@@ -0,0 +1,139 @@
+"""Tests for GET /messages keyset pagination, NDJSON streaming, filters and field projection"""
+
+import json
+import os
+import sqlite3
+import uuid
+
+import pytest
+
+import app as wsgi
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+def store(sender, timestamps):
+    """Insert one message per timestamp; returns ids newest first, in /messages order"""
+    rows = [wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': ts}) for ts in timestamps]
+    wsgi.save_messages(rows)
+    stored = wsgi.get_storage().list_messages(filters={'sender_phone': sender})
+    return [row['id'] for row in sorted(stored, key=lambda row: (row['timestamp'], row['id']), reverse=True)]
+
+
+def page(client, sender, **params):
+    response = client.get('/messages', query_string={'phone': sender, **params})
+    assert response.status_code == 200
+    body = response.get_json()
+    return [message['id'] for message in body['messages']], body['next_cursor']
+
+
+def walk(client, sender, limit):
+    ids, cursor = page(client, sender, limit=limit)
+    while cursor:
+        more, cursor = page(client, sender, limit=limit, after=cursor)
+        ids.extend(more)
+    return ids
+
+
+@pytest.fixture
+def sender():
+    return 'page-' + uuid.uuid4().hex[:8]
+
+
+def test_pages_cover_every_message_once_with_timestamp_ties(client, sender):
+    # Five messages share a timestamp, so the id decides their order
+    expected = store(sender, ['2026-03-01T10:00:00'] * 5 + ['2026-03-01T09:00:00', '2026-03-01T11:00:00'])
+    assert walk(client, sender, 2) == expected
+    assert walk(client, sender, 7) == expected
+    assert walk(client, sender, 100) == expected
+
+
+def test_new_messages_do_not_shift_later_pages(client, sender):
+    expected = store(sender, [f'2026-03-02T10:00:0{i}' for i in range(6)])
+    first, cursor = page(client, sender, limit=3)
+    store(sender, ['2026-03-02T12:00:00'])
+    rest, _ = page(client, sender, limit=3, after=cursor)
+    assert first + rest == expected
+
+
+def test_last_full_page_has_a_cursor_to_an_empty_page(client, sender):
+    store(sender, ['2026-03-03T10:00:00', '2026-03-03T11:00:00'])
+    ids, cursor = page(client, sender, limit=2)
+    assert len(ids) == 2 and cursor
+    assert page(client, sender, limit=2, after=cursor) == ([], None)
+
+
+def test_ndjson_streams_every_message_in_order(client, sender):
+    expected = store(sender, [f'2026-03-04T10:00:0{i}' for i in range(5)])
+    response = client.get('/messages', query_string={'phone': sender, 'format': 'ndjson', 'limit': 2})
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line['id'] for line in lines] == expected
+
+
+def test_ndjson_with_accept_header_and_cursor(client, sender):
+    expected = store(sender, [f'2026-03-05T10:00:0{i}' for i in range(4)])
+    _, cursor = page(client, sender, limit=1)
+    response = client.get('/messages', query_string={'phone': sender, 'after': cursor},
+                          headers={'Accept': 'application/x-ndjson'})
+    assert [json.loads(line)['id'] for line in response.get_data(as_text=True).splitlines()] == expected[1:]
+
+
+@pytest.mark.parametrize('params', [{'limit': 0}, {'limit': 'ten'}, {'after': 'not-a-cursor'},
+                                    {'after': 'eyJhIjoxfQ'}])
+def test_bad_page_arguments_are_rejected(client, params):
+    assert client.get('/messages', query_string=params).status_code == 400
+
+
+def test_filters_by_type_flow_token_and_time_range(client, sender):
+    wsgi.save_messages([
+        wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': '2026-03-06T09:00:00'}),
+        wsgi.build_message_row({'from': sender, 'type': 'interactive', 'flow_token': 'ft-' + sender,
+                                'timestamp': '2026-03-06T10:00:00'}),
+        wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': '2026-03-06T11:00:00'}),
+    ])
+
+    def types(**params):
+        response = client.get('/messages', query_string={'phone': sender, 'fields': 'message_type', **params})
+        assert response.status_code == 200
+        return [message['message_type'] for message in response.get_json()['messages']]
+
+    assert types() == ['text', 'interactive', 'text']
+    assert types(type='text') == ['text', 'text']
+    assert types(flow_token='ft-' + sender) == ['interactive']
+    assert types(since='2026-03-06T10:00:00', until='2026-03-06T10:59:59') == ['interactive']
+    assert types(since='2026-03-06T09:30:00Z', type='text') == ['text']
+
+
+def test_fields_returns_only_the_requested_columns(client, sender):
+    store(sender, ['2026-03-07T10:00:00', '2026-03-07T11:00:00'])
+    response = client.get('/messages', query_string={'phone': sender, 'fields': 'sender_phone,message_type',
+                                                     'limit': 1})
+    body = response.get_json()
+    assert body['messages'] == [{'sender_phone': sender, 'message_type': 'text'}]
+    # The cursor still works though id and timestamp weren't requested
+    more = client.get('/messages', query_string={'phone': sender, 'fields': 'id', 'after': body['next_cursor']})
+    assert len(more.get_json()['messages']) == 1 and set(more.get_json()['messages'][0]) == {'id'}
+
+
+@pytest.mark.parametrize('params', [{'fields': 'id,password'}, {'since': 'yesterday'}, {'until': '2026-13-01'}])
+def test_bad_filters_are_rejected(client, params):
+    response = client.get('/messages', query_string=params)
+    assert response.status_code == 400 and response.get_json()['status'] == 'error'
+
+
+@pytest.mark.parametrize('column', ['sender_phone', 'message_type', 'flow_token'])
+def test_filtered_queries_use_an_index(client, column):
+    client.get('/health')
+    conn = sqlite3.connect(os.environ['SQLITE_PATH'])
+    try:
+        plan = conn.execute(f'EXPLAIN QUERY PLAN SELECT id FROM messages WHERE {column} = ? '
+                            'ORDER BY timestamp DESC, id DESC LIMIT 10', ('x',)).fetchall()
+    finally:
+        conn.close()
+    detail = ' '.join(row[-1] for row in plan)
+    assert f'idx_messages_{column}' in detail and 'TEMP B-TREE' not in detail
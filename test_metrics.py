@@ -0,0 +1,50 @@
+"""Tests for the Prometheus request and exception metrics of the Flask and ASGI apps"""
+
+import pytest
+from prometheus_client import REGISTRY
+from starlette.testclient import TestClient
+
+import app as wsgi
+import asgi_app
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError('database unavailable')
+
+
+@pytest.fixture(params=['wsgi', 'asgi'])
+def client(request, monkeypatch):
+    if request.param == 'wsgi':
+        monkeypatch.setattr(wsgi, 'get_messages', fail)
+        return wsgi.app.test_client()
+    monkeypatch.setattr(asgi_app, 'get_messages', fail)
+    return TestClient(asgi_app.app)
+
+
+def test_handled_exception_is_counted_by_route_and_type(client):
+    labels = {'route': '/messages', 'exception': 'RuntimeError'}
+    before = sample('whatsapp_flow_http_exceptions_total', **labels)
+
+    assert client.get('/messages').status_code == 500
+    assert sample('whatsapp_flow_http_exceptions_total', **labels) == before + 1
+
+
+def test_requests_are_labelled_by_route_template(client):
+    route = '/users/{phone}' if isinstance(client, TestClient) else '/users/<phone>'
+    labels = {'method': 'GET', 'route': route, 'status': '404'}
+    before = sample('whatsapp_flow_http_requests_total', **labels)
+
+    for phone in ('90000000011', '90000000012'):
+        assert client.get(f'/users/{phone}').status_code == 404
+    assert sample('whatsapp_flow_http_requests_total', **labels) == before + 2
+    assert sample('whatsapp_flow_http_requests_total', method='GET', route='/users/90000000011', status='404') == 0
+
+
+def test_unknown_path_is_unmatched(client):
+    before = sample('whatsapp_flow_http_requests_total', method='GET', route='unmatched', status='404')
+    assert client.get('/no-such-path').status_code == 404
+    assert sample('whatsapp_flow_http_requests_total', method='GET', route='unmatched', status='404') == before + 1
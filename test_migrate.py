@@ -0,0 +1,46 @@
+"""Tests for migrate_payloads.py against rows written by older versions"""
+
+import json
+import os
+import sqlite3
+import uuid
+
+import app as wsgi
+import migrate_payloads
+
+
+def legacy(sql, params):
+    """Rewrite rows the way older versions stored them, behind the app's back"""
+    conn = sqlite3.connect(os.environ['SQLITE_PATH'], timeout=30)
+    try:
+        with conn:
+            conn.execute(sql, params)
+    finally:
+        conn.close()
+
+
+def test_migration_converts_strings_and_is_idempotent(capsys):
+    sender = 'legacy-' + uuid.uuid4().hex[:8]
+    phone = '94' + str(uuid.uuid4().int)[:10]
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'image', 'flow_token': 'ft-1'})])
+    wsgi.save_users([{'phone': phone, 'parent_name': 'P', 'child_name': 'C', 'wishlist': ['Kite']}])
+    message_id = wsgi.get_storage().list_messages(filters={'sender_phone': sender})[0]['id']
+
+    # JSON stored as a string, and no derived columns
+    legacy('UPDATE messages SET data = json_quote(data), sender_phone = NULL, message_type = NULL, '
+           'flow_token = NULL WHERE id = ?', (message_id,))
+    legacy('UPDATE users SET wishlist = json_quote(wishlist) WHERE phone = ?', (phone,))
+    assert wsgi.get_storage().list_messages(filters={'sender_phone': sender}) == []
+
+    assert migrate_payloads.main(['--batch-size', '1', '--pause', '0']) == 0
+    row = wsgi.get_storage().get_message(message_id)
+    assert (row['sender_phone'], row['message_type'], row['flow_token']) == (sender, 'image', 'ft-1')
+    assert isinstance(json.loads(row['data']) if isinstance(row['data'], str) else row['data'], dict)
+    wishlist = wsgi.get_storage().get_user(phone)['wishlist']
+    assert isinstance(json.loads(wishlist) if isinstance(wishlist, str) else wishlist, list)
+
+    capsys.readouterr()
+    assert migrate_payloads.main(['--batch-size', '1', '--pause', '0']) == 0
+    assert '✅ Converted 0 rows' in capsys.readouterr().out
+    assert wsgi.get_storage().get_message(message_id) == row
+    assert wsgi.get_storage().get_user(phone)['wishlist'] == wishlist
@@ -0,0 +1,197 @@
+"""Tests for transient-error detection, the circuit breaker and ResilientStorage (resilience.py)"""
+
+import sqlite3
+import time
+
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, CircuitOpenError, ResilientStorage, is_transient
+
+
+def sqlite_error(tmp_path, sql, setup=None):
+    """Run sql on a fresh database and return the error SQLite raises"""
+    conn = sqlite3.connect(str(tmp_path / 'test.db'), timeout=0)
+    if setup:
+        setup(conn)
+    try:
+        conn.execute(sql)
+    except sqlite3.Error as e:
+        return e
+    finally:
+        conn.close()
+    raise AssertionError(f'{sql} did not fail')
+
+
+def test_sqlite_lock_is_transient(tmp_path):
+    holder = sqlite3.connect(str(tmp_path / 'test.db'))
+    holder.execute('CREATE TABLE t (x)')
+    holder.commit()
+    holder.execute('BEGIN EXCLUSIVE')
+    try:
+        error = sqlite_error(tmp_path, 'SELECT * FROM t')
+    finally:
+        holder.rollback()
+        holder.close()
+    assert 'locked' in str(error)
+    assert is_transient(error)
+
+
+def test_sqlite_interrupt_is_transient(tmp_path):
+    error = sqlite_error(tmp_path, 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT count(*) FROM n',
+                         setup=lambda conn: conn.set_progress_handler(lambda: 1, 100))
+    assert is_transient(error)
+
+
+@pytest.mark.parametrize('sql', ['SELECT * FROM missing', 'SELEC 1'])
+def test_other_sqlite_errors_are_not_transient(tmp_path, sql):
+    assert not is_transient(sqlite_error(tmp_path, sql))
+
+
+def test_sqlite_messages_are_used_without_error_names():
+    assert is_transient(sqlite3.OperationalError('database is locked'))
+    assert is_transient(sqlite3.OperationalError('database table is locked'))
+    assert not is_transient(sqlite3.OperationalError('disk I/O error'))
+    assert not is_transient(sqlite3.IntegrityError('UNIQUE constraint failed: messages.wamid'))
+
+
+def test_other_transient_errors():
+    class APIError(Exception):
+        def __init__(self, code):
+            self.code = code
+
+    assert is_transient(TimeoutError())
+    assert is_transient(ConnectionResetError())
+    assert is_transient(APIError('503'))
+    assert is_transient(APIError('57014'))
+    assert not is_transient(APIError('404'))
+    assert not is_transient(APIError('23505'))
+    assert is_transient(RuntimeError('PostgREST 502: bad gateway'))
+    assert not is_transient(RuntimeError('PostgREST 400: bad request'))
+    assert not is_transient(CircuitOpenError(5))
+
+
+def test_breaker_opens_after_threshold_then_half_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.before_call()
+    breaker.record_failure(TimeoutError('slow'))
+    assert breaker.state == 'closed'
+    breaker.record_failure(TimeoutError('slow'))
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == 'half_open'
+    # Only the one trial call goes through
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+    assert breaker.stats()['trips'] == 1
+    assert breaker.stats()['rejected'] == 2
+
+
+def test_failed_trial_call_reopens_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure(TimeoutError('slow'))
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure(TimeoutError('still slow'))
+    assert breaker.state == 'open'
+    assert breaker.stats()['trips'] == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_disabled_breaker_never_opens():
+    breaker = CircuitBreaker(failure_threshold=0)
+    for _ in range(10):
+        breaker.record_failure(TimeoutError('slow'))
+        breaker.before_call()
+    assert breaker.state == 'closed'
+
+
+class FlakyBackend:
+    name = 'flaky'
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def get_user(self, phone):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'phone': phone}
+
+    def upsert_users(self, rows):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return rows
+
+
+OPERATIONS = {'get_user': 'users.select', 'upsert_users': 'users.upsert'}
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(resilience, 'retry_delay', lambda attempt: 0)
+
+
+def test_reads_are_retried_after_transient_errors():
+    backend = FlakyBackend([sqlite3.OperationalError('database is locked')] * 2)
+    storage = ResilientStorage(backend, OPERATIONS, CircuitBreaker(failure_threshold=5))
+    assert storage.get_user('1') == {'phone': '1'}
+    assert backend.calls == 3
+
+
+def test_writes_and_permanent_errors_are_not_retried():
+    backend = FlakyBackend([sqlite3.OperationalError('database is locked')])
+    storage = ResilientStorage(backend, OPERATIONS, CircuitBreaker(failure_threshold=5))
+    with pytest.raises(sqlite3.OperationalError):
+        storage.upsert_users([{'phone': '1'}])
+    assert backend.calls == 1
+
+    backend = FlakyBackend([sqlite3.OperationalError('no such table: users')])
+    breaker = CircuitBreaker(failure_threshold=1)
+    storage = ResilientStorage(backend, OPERATIONS, breaker)
+    with pytest.raises(sqlite3.OperationalError):
+        storage.get_user('1')
+    assert backend.calls == 1
+    assert breaker.state == 'closed'
+
+
+def test_open_breaker_rejects_without_calling_backend():
+    backend = FlakyBackend([TimeoutError('slow')] * 3)
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    storage = ResilientStorage(backend, OPERATIONS, breaker)
+    with pytest.raises(TimeoutError):
+        storage.get_user('1')
+    assert breaker.state == 'open'
+
+    with pytest.raises(CircuitOpenError):
+        storage.get_user('1')
+    assert backend.calls == 3
+
+
+def test_time_budget_caps_call_deadlines():
+    class TimedBackend:
+        name = 'timed'
+
+        def get_user(self, phone):
+            return resilience.current_timeout()
+
+    storage = ResilientStorage(TimedBackend(), OPERATIONS, CircuitBreaker(failure_threshold=5))
+    assert storage.get_user('1') == pytest.approx(resilience.DB_TIMEOUT_READ, abs=0.1)
+    with resilience.time_budget(0.5):
+        assert storage.get_user('1') <= 0.5
+        with resilience.time_budget(60):
+            # An inner budget can't extend the outer one
+            assert storage.get_user('1') <= 0.5
+    assert resilience.budget_left() is None
@@ -0,0 +1,182 @@
+"""Tests for the durable webhook spool (spool.py)"""
+
+import fcntl
+import os
+import threading
+import time
+import zlib
+
+import serialization
+from spool import CHECKPOINT_FILE, HEADER, LOCK_FILE, Spool, list_segments, segment_name, write_checkpoint
+
+
+class Recorder:
+    """write_batch that records every row and can fail a number of times first"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, rows):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('database unavailable')
+            self.batches.append(list(rows))
+
+    @property
+    def rows(self):
+        with self.lock:
+            return [row for batch in self.batches for row in batch]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def record(row):
+    payload = serialization.dumps_bytes(row)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def write_orphan(root, segments):
+    """A spool directory left by a crashed process: {segment number: bytes}"""
+    directory = os.path.join(root, '999-0')
+    os.makedirs(directory)
+    open(os.path.join(directory, LOCK_FILE), 'w').close()
+    for number, data in segments.items():
+        with open(os.path.join(directory, segment_name(number)), 'wb') as f:
+            f.write(data)
+    return directory
+
+
+def test_appended_rows_are_replayed_in_batches(tmp_path):
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, batch_size=3, poll_interval=0.01)
+    rows = [{'n': i} for i in range(7)]
+    try:
+        for row in rows:
+            assert spool.append(row)
+        assert wait_for(lambda: len(writer.rows) == 7)
+    finally:
+        spool.stop()
+    assert writer.rows == rows
+    assert all(len(batch) <= 3 for batch in writer.batches)
+    assert spool.stats()['appended'] == 7
+    # A fully replayed spool leaves nothing behind
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_full_segments_roll_over_and_are_deleted(tmp_path):
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, segment_bytes=64, poll_interval=0.01)
+    try:
+        for i in range(20):
+            assert spool.append({'n': i, 'padding': 'x' * 20})
+        assert spool._segment > 0
+        assert wait_for(lambda: len(writer.rows) == 20)
+        assert wait_for(lambda: list_segments(spool.directory) == [spool._segment])
+    finally:
+        spool.stop()
+    assert [row['n'] for row in writer.rows] == list(range(20))
+
+
+def test_failed_replay_is_retried(tmp_path):
+    writer = Recorder(failures=1)
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, max_backoff=0.5)
+    try:
+        assert spool.append({'n': 1})
+        assert wait_for(lambda: writer.rows == [{'n': 1}])
+    finally:
+        spool.stop()
+    assert spool.stats()['replay_errors'] == 1
+
+
+def test_stop_leaves_unreplayed_rows_for_the_next_process(tmp_path):
+    writer = Recorder(failures=1000)
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, max_backoff=0.05)
+    assert spool.append({'n': 1})
+    spool.stop(timeout=0.2)
+    assert len(os.listdir(str(tmp_path))) == 1
+
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, adopt_interval=0.01)
+    try:
+        spool.start()
+        assert wait_for(lambda: writer.rows == [{'n': 1}])
+        assert wait_for(lambda: spool.stats()['adopted_directories'] == 1)
+    finally:
+        spool.stop()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_orphan_resumes_from_checkpoint(tmp_path):
+    first = record({'n': 0})
+    directory = write_orphan(str(tmp_path), {0: first + record({'n': 1}) + record({'n': 2})})
+    write_checkpoint(directory, 0, len(first))
+
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, adopt_interval=0.01)
+    try:
+        spool.start()
+        assert wait_for(lambda: not os.path.exists(directory))
+    finally:
+        spool.stop()
+    assert writer.rows == [{'n': 1}, {'n': 2}]
+
+
+def test_corrupt_record_is_skipped_and_later_segments_replayed(tmp_path):
+    bad = bytearray(record({'n': 2}))
+    bad[-2] ^= 0xFF
+    directory = write_orphan(str(tmp_path), {
+        0: record({'n': 0}) + record({'n': 1}) + bytes(bad) + record({'n': 3}),
+        1: record({'n': 4}),
+    })
+
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, adopt_interval=0.01)
+    try:
+        spool.start()
+        assert wait_for(lambda: not os.path.exists(directory))
+    finally:
+        spool.stop()
+    # Everything after the bad record in its segment is lost, the next segment isn't
+    assert writer.rows == [{'n': 0}, {'n': 1}, {'n': 4}]
+    assert spool.stats()['corrupt_segments'] == 1
+
+
+def test_torn_tail_record_is_dropped(tmp_path):
+    directory = write_orphan(str(tmp_path), {0: record({'n': 0}) + record({'n': 1})[:-3]})
+
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, adopt_interval=0.01)
+    try:
+        spool.start()
+        assert wait_for(lambda: not os.path.exists(directory))
+    finally:
+        spool.stop()
+    assert writer.rows == [{'n': 0}]
+
+
+def test_directory_of_a_live_process_is_not_adopted(tmp_path):
+    directory = write_orphan(str(tmp_path), {0: record({'n': 0})})
+    fd = os.open(os.path.join(directory, LOCK_FILE), os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+
+    writer = Recorder()
+    spool = Spool(str(tmp_path), writer, poll_interval=0.01, adopt_interval=0.01)
+    try:
+        spool.start()
+        time.sleep(0.1)
+        assert writer.rows == []
+        assert os.path.exists(os.path.join(directory, segment_name(0)))
+        assert not os.path.exists(os.path.join(directory, CHECKPOINT_FILE))
+    finally:
+        spool.stop()
+        os.close(fd)
@@ -0,0 +1,32 @@
+"""Tests that importing app.py with the Supabase backend does no network I/O (cold starts)"""
+
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+SNIPPET = '''
+import json, socket, sys
+
+def refuse(*args, **kwargs):
+    raise AssertionError('network I/O at import')
+
+socket.socket.connect = socket.create_connection = socket.getaddrinfo = refuse
+import app
+print(json.dumps({
+    'client_initialized': app.storage.client_initialized,
+    'heavy_modules': sorted(m for m in ('supabase', 'httpx', 'postgrest') if m in sys.modules),
+    'health': app.app.test_client().get('/health').get_json()['status'],
+}))
+'''
+
+
+def test_import_creates_no_client_and_loads_no_http_stack(tmp_path):
+    env = dict(os.environ, STORAGE_BACKEND='supabase', SUPABASE_URL='https://example.invalid', SUPABASE_KEY='key',
+               SPOOL_DIR=str(tmp_path / 'spool'), INGEST_DEAD_LETTER_DIR=str(tmp_path / 'dead-letter'))
+    out = subprocess.run([sys.executable, '-c', SNIPPET], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    assert result == {'client_initialized': False, 'heavy_modules': [], 'health': 'healthy'}
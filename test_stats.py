@@ -0,0 +1,135 @@
+"""Tests for /stats: incremental rollup refresh, late messages and refresh failures"""
+
+import time
+import uuid
+
+import pytest
+from starlette.testclient import TestClient
+
+import app as wsgi
+import asgi_app
+
+DAY = {'since': '2019-05-04T00:00:00', 'until': '2019-05-06T00:00:00'}
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+@pytest.fixture
+def due(monkeypatch):
+    """Make every /stats request refresh the rollups"""
+    monkeypatch.setattr(wsgi, 'STATS_REFRESH_SECONDS', 0)
+
+
+def store(sender, timestamps):
+    wsgi.save_messages([wsgi.build_message_row({'from': sender, 'type': 'text', 'timestamp': ts})
+                        for ts in timestamps])
+
+
+def stats(client, **params):
+    response = client.get('/stats', query_string={**DAY, **params})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def sent_by(body, sender):
+    return {row['sender_phone']: row['messages'] for row in body['senders']}.get(sender, 0)
+
+
+def test_refresh_is_incremental(client, due):
+    sender = 'stats-' + uuid.uuid4().hex[:8]
+    store(sender, ['2019-05-05T10:00:00'] * 3)
+    first = stats(client)
+    assert sent_by(first, sender) == 3
+    assert first['last_message_id'] == max(row['id'] for row in wsgi.get_storage().list_messages())
+
+    store(sender, ['2019-05-05T10:30:00'] * 2)
+    second = stats(client)
+    # Only the new rows are added; the three already rolled up aren't counted again
+    assert sent_by(second, sender) == 5
+    assert second['messages'] == first['messages'] + 2
+    assert {'hour', 'messages', 'unique_senders'} <= set(second['hourly'][0])
+    assert {row['message_type'] for row in second['types']} >= {'text'}
+
+
+def test_late_message_is_counted_in_its_own_hour(client, due):
+    sender = 'late-' + uuid.uuid4().hex[:8]
+    store(sender, ['2019-05-05T12:00:00'])
+    stats(client)
+
+    # Delivered after the refresh, timestamped an hour that was already rolled up
+    store(sender, ['2019-05-04T09:15:00'])
+    body = stats(client, phone=sender)
+    hours = {row['hour']: row['messages'] for row in body['hourly']}
+    assert hours['2019-05-04T09:00:00'] >= 1
+    assert sent_by(body, sender) == 2
+
+
+def test_refresh_waits_for_the_interval(client, monkeypatch):
+    monkeypatch.setattr(wsgi, 'STATS_REFRESH_SECONDS', 3600)
+    monkeypatch.setitem(wsgi.stats_refresh, 'at', time.monotonic())
+    sender = 'wait-' + uuid.uuid4().hex[:8]
+    store(sender, ['2019-05-05T13:00:00'])
+    assert sent_by(stats(client), sender) == 0
+
+
+class RollupStorage:
+    """Delegates to the app's storage; refresh_message_rollups is scripted"""
+
+    def __init__(self, storage, refresh):
+        self.storage = storage
+        self.refresh = refresh
+        self.calls = []
+
+    def refresh_message_rollups(self, batch_size, settle_seconds=60):
+        self.calls.append(settle_seconds)
+        return self.refresh(batch_size)
+
+    def __getattr__(self, attr):
+        return getattr(self.storage, attr)
+
+
+@pytest.fixture
+def scripted(monkeypatch, due):
+    def install(refresh):
+        storage = RollupStorage(wsgi.get_storage(), refresh)
+        monkeypatch.setattr(wsgi, 'get_storage', lambda: storage)
+        return storage
+    return install
+
+
+def test_failed_refresh_serves_current_rollups_and_backs_off(client, scripted, monkeypatch):
+    def fail(batch_size):
+        raise RuntimeError('rpc failed')
+
+    storage = scripted(fail)
+    monkeypatch.setattr(wsgi, 'STATS_REFRESH_SECONDS', 3600)
+    monkeypatch.setitem(wsgi.stats_refresh, 'at', 0.0)
+    assert stats(client)['status'] == 'success'
+    assert stats(client)['status'] == 'success'
+    assert len(storage.calls) == 1
+
+
+def test_refresh_stops_at_its_time_budget(client, scripted, monkeypatch):
+    def endless(batch_size):
+        time.sleep(0.02)
+        return batch_size
+
+    storage = scripted(endless)
+    monkeypatch.setattr(wsgi, 'STATS_REFRESH_TIMEOUT', 0.05)
+    monkeypatch.setattr(wsgi, 'STATS_REFRESH_MAX_ROWS', 10 ** 9)
+    stats(client)
+    assert 2 <= len(storage.calls) <= 4
+    # The settle window reaches the backend, which skips rows younger than it
+    assert set(storage.calls) == {wsgi.STATS_SETTLE_SECONDS}
+
+
+def test_asgi_failed_refresh_serves_current_rollups(monkeypatch, due):
+    async def fail(batch_size, settle_seconds):
+        raise RuntimeError('rpc failed')
+
+    monkeypatch.setattr(asgi_app.storage, 'refresh_message_rollups', fail)
+    response = TestClient(asgi_app.app).get('/stats', params=DAY)
+    assert response.status_code == 200 and response.json()['status'] == 'success'
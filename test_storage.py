@@ -0,0 +1,59 @@
+"""Tests that every storage backend implements the StorageBackend operations"""
+
+import asyncio
+import inspect
+import os
+import re
+
+import pytest
+
+from storage import OPERATION_NAMES, StorageBackend, create_storage
+from storage.async_backend import AsyncSupabaseStorage, ThreadedAsyncStorage
+from storage.sqlite_backend import SQLiteStorage
+from storage.supabase_backend import SupabaseStorage
+
+ASGI_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'asgi_app.py')
+
+
+def test_interface_declares_every_operation():
+    for name in OPERATION_NAMES:
+        assert callable(getattr(StorageBackend, name, None)), name
+
+
+@pytest.mark.parametrize('backend', [SQLiteStorage, SupabaseStorage])
+def test_backend_implements_every_operation(backend):
+    missing = [name for name in OPERATION_NAMES if getattr(backend, name) is getattr(StorageBackend, name)]
+    assert missing == []
+
+
+def test_async_backend_implements_what_the_asgi_app_awaits():
+    with open(ASGI_APP, encoding='utf-8') as f:
+        used = set(re.findall(r'storage\.(\w+)\(', f.read())) & set(OPERATION_NAMES)
+    assert used
+    missing = [name for name in sorted(used)
+               if not inspect.iscoroutinefunction(getattr(AsyncSupabaseStorage, name, None))]
+    assert missing == []
+
+
+def test_create_storage_selects_the_backend(tmp_path):
+    sqlite = create_storage('SQLite', path=str(tmp_path / 'app.db'))
+    assert isinstance(sqlite, SQLiteStorage)
+    sqlite.ping()
+    supabase = create_storage('supabase', url='https://example.supabase.co', key='key')
+    # The client is created on first use, not here
+    assert isinstance(supabase, SupabaseStorage) and not supabase.client_initialized
+    with pytest.raises(ValueError, match='Unknown storage backend'):
+        create_storage('mysql')
+
+
+def test_threaded_async_storage_returns_what_the_backend_returns(tmp_path):
+    db = SQLiteStorage(str(tmp_path / 'app.db'))
+    db.upsert_users([{'phone': '9100000001', 'parent_name': 'P', 'child_name': 'C', 'wishlist': ['Kite']}])
+    threaded = ThreadedAsyncStorage(db)
+
+    async def read():
+        return await threaded.get_user('9100000001'), await threaded.users_version()
+
+    user, version = asyncio.run(read())
+    assert user == db.get_user('9100000001') and user['wishlist'] == ['Kite']
+    assert version == db.users_version() and threaded.name == 'sqlite'
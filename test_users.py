@@ -0,0 +1,159 @@
+"""Tests for GET /users pagination, streaming and projection"""
+
+import json
+import uuid
+
+import pytest
+
+import app as wsgi
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+@pytest.fixture
+def phones(client):
+    """Five saved users"""
+    saved = []
+    for i in range(5):
+        phone = '92' + str(uuid.uuid4().int)[:10]
+        body = {'user': phone, 'parent_name': f'Parent {i}', 'child_name': f'Child {i}', 'wishlist': [f'toy {i}']}
+        assert client.post('/save-user', json=body).status_code == 200
+        saved.append(phone)
+    return saved
+
+
+def all_phones():
+    return [row['phone'] for row in wsgi.get_storage().list_users(columns=['phone'])]
+
+
+def page(client, **params):
+    response = client.get('/users', query_string=params)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['count'] == len(body['users'])
+    return body['users'], body['next_cursor']
+
+
+def test_pages_walk_every_user_by_id(client, phones):
+    users, cursor = page(client, limit=2)
+    while cursor:
+        more, cursor = page(client, limit=2, after=cursor)
+        users.extend(more)
+    ids = [user['id'] for user in users]
+    assert ids == sorted(ids)
+    assert [user['phone'] for user in users] == all_phones()
+    assert set(phones) <= {user['phone'] for user in users}
+
+
+def test_cursor_starts_after_the_last_user(client, phones):
+    first, cursor = page(client, limit=1)
+    rest, _ = page(client, limit=1000, after=cursor)
+    assert first[0]['id'] < rest[0]['id']
+    assert [user['phone'] for user in first + rest] == all_phones()
+
+
+def test_projection_returns_only_requested_fields(client, phones):
+    users, _ = page(client, limit=3, fields='phone,child_name')
+    assert users and all(set(user) == {'phone', 'child_name'} for user in users)
+
+    full = client.get('/users', query_string={'fields': 'wishlist'}).get_json()['users']
+    assert full[phones[0]] == {'phone': phones[0], 'wishlist': ['toy 0']}
+
+
+def test_streams_match_the_full_list(client, phones):
+    expected = client.get('/users').get_json()['users']
+
+    ndjson = client.get('/users', query_string={'format': 'ndjson', 'limit': 2})
+    assert ndjson.mimetype == 'application/x-ndjson'
+    streamed = [json.loads(line) for line in ndjson.get_data(as_text=True).splitlines()]
+    assert {user['phone']: user for user in streamed} == expected
+
+    array = client.get('/users', query_string={'stream': 'json', 'limit': 2}).get_json()
+    assert {user['phone']: user for user in array['users']} == expected
+
+
+def test_unknown_field_is_rejected(client):
+    assert client.get('/users', query_string={'fields': 'password'}).status_code == 400
+
+
+class CountingStorage:
+    """Delegates to the app's storage and records the phones of every get_users call"""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.calls = []
+
+    def get_users(self, phones, columns=None):
+        self.calls.append(list(phones))
+        return self.storage.get_users(phones, columns)
+
+    def __getattr__(self, attr):
+        return getattr(self.storage, attr)
+
+
+@pytest.fixture
+def counting(monkeypatch):
+    storage = CountingStorage(wsgi.get_storage())
+    monkeypatch.setattr(wsgi, 'get_storage', lambda: storage)
+    wsgi.user_cache.clear()
+    return storage
+
+
+def lookup(client, body, status=200, **params):
+    response = client.post('/users/lookup', json=body, query_string=params)
+    assert response.status_code == status
+    return response.get_json()
+
+
+def test_lookup_queries_in_chunks_and_reports_every_phone(client, phones, counting, monkeypatch):
+    monkeypatch.setattr(wsgi, 'USERS_LOOKUP_CHUNK_SIZE', 2)
+    missing = ['90000000001', '90000000002']
+    requested = [phones[3], missing[0], phones[0], phones[3], phones[1], missing[1], phones[4]]
+
+    body = lookup(client, {'phones': requested})
+    assert set(body['users']) == set(requested)
+    assert body['missing'] == missing
+    assert body['count'] == 4
+    assert body['users'][phones[0]]['child_name'] == 'Child 0'
+    assert [len(chunk) for chunk in counting.calls] == [2, 2, 2]
+
+
+def test_lookup_beyond_sqlite_variable_limit(client, phones, counting):
+    requested = phones + [f'91{i:010d}' for i in range(1200)]
+    body = lookup(client, {'phones': requested})
+    assert body['count'] == len(phones)
+    assert len(body['missing']) == 1200
+    assert len(counting.calls) == len(requested) // wsgi.USERS_LOOKUP_CHUNK_SIZE + 1
+
+
+def test_lookup_projection(client, phones, counting):
+    body = lookup(client, {'phones': phones[:2], 'fields': ['child_name']})
+    assert body['users'][phones[0]] == {'child_name': 'Child 0'}
+    body = lookup(client, {'phones': phones[:1]}, fields='wishlist')
+    assert body['users'][phones[0]] == {'wishlist': ['toy 0']}
+
+
+@pytest.mark.parametrize('body', [{'phones': []}, {'phones': 'not a list'}, {'phones': ['1', None]},
+                                  {'phones': ['1', True]}, {'phones': ['1'], 'fields': ['password']}])
+def test_lookup_rejects_bad_requests(client, body):
+    assert lookup(client, body, status=400)['status'] == 'error'
+
+
+def test_lookup_limits_phones_per_request(client, monkeypatch):
+    monkeypatch.setattr(wsgi, 'MAX_USERS_LOOKUP', 3)
+    lookup(client, {'phones': ['1', '2', '3', '4']}, status=400)
+
+
+def test_upsert_rows_with_different_columns(phones):
+    new_phone = '95' + str(uuid.uuid4().int)[:10]
+    rows = [{'phone': phones[0], 'parent_name': 'Parent 0', 'child_name': 'Renamed'},
+            {'phone': new_phone, 'parent_name': 'New', 'child_name': 'Kid', 'wishlist': ['Drum']}]
+    saved = {row['phone']: wsgi.decode_user(row) for row in wsgi.get_storage().upsert_users(rows)}
+
+    # The row without a wishlist keeps the stored one
+    assert saved[phones[0]]['child_name'] == 'Renamed'
+    assert saved[phones[0]]['wishlist'] == ['toy 0']
+    assert saved[new_phone]['wishlist'] == ['Drum']
@@ -0,0 +1,90 @@
+"""Tests for webhook ingestion and WhatsApp message id (wamid) deduplication"""
+
+import uuid
+
+import pytest
+
+import app as wsgi
+from cache import SeenSet
+
+
+@pytest.fixture
+def client():
+    return wsgi.app.test_client()
+
+
+def whatsapp_payload(wamid):
+    # Each wamid gets its own sender, so its stored rows can be listed by sender
+    message = {'from': 'sender-' + wamid, 'id': wamid, 'type': 'text', 'text': {'body': 'hi'}}
+    return {'entry': [{'changes': [{'value': {'messages': [message]}}]}]}
+
+
+def new_wamid():
+    return f'wamid.{uuid.uuid4().hex}'
+
+
+def stored(wamid):
+    rows = wsgi.get_storage().list_messages(filters={'sender_phone': 'sender-' + wamid})
+    assert all(row['wamid'] == wamid for row in rows)
+    return rows
+
+
+def post(client, payload):
+    response = client.post('/webhook', json=payload)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_redelivery_is_acknowledged_once(client):
+    wamid = new_wamid()
+    assert not post(client, whatsapp_payload(wamid)).get('duplicate')
+    assert post(client, whatsapp_payload(wamid))['duplicate'] is True
+    assert len(stored(wamid)) == 1
+
+
+def test_redelivery_to_another_worker_is_caught_by_the_database(client, monkeypatch):
+    wamid = new_wamid()
+    post(client, whatsapp_payload(wamid))
+    # A fresh process hasn't seen the wamid in memory
+    monkeypatch.setattr(wsgi, 'webhook_dedup', SeenSet())
+    assert post(client, whatsapp_payload(wamid))['duplicate'] is True
+    assert len(stored(wamid)) == 1
+
+
+def test_batch_insert_skips_stored_and_repeated_wamids():
+    wamid, other = new_wamid(), new_wamid()
+    assert wsgi.save_message(whatsapp_payload(wamid)) == 1
+    rows = [wsgi.build_message_row(whatsapp_payload(w)) for w in (wamid, other, other)]
+    assert wsgi.save_messages(rows) == 1
+    assert len(stored(wamid)) == 1 and len(stored(other)) == 1
+
+
+def test_failed_write_accepts_the_redelivery(client, monkeypatch):
+    wamid = new_wamid()
+
+    def fail(rows):
+        raise RuntimeError('database unavailable')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(wsgi, 'save_messages', fail)
+        assert client.post('/webhook', json=whatsapp_payload(wamid)).status_code == 500
+    assert not post(client, whatsapp_payload(wamid)).get('duplicate')
+    assert len(stored(wamid)) == 1
+
+
+def test_messages_without_wamid_are_all_stored(client):
+    sender = 'no-wamid-' + uuid.uuid4().hex[:8]
+    for _ in range(2):
+        assert not post(client, {'from': sender, 'text': 'hello'}).get('duplicate')
+    assert len(wsgi.get_storage().list_messages(filters={'sender_phone': sender})) == 2
+
+
+def test_seen_set_evicts_oldest():
+    seen = SeenSet(max_size=2)
+    assert seen.add('a') and seen.add('b')
+    assert not seen.add('a')
+    assert seen.add('c')
+    # 'b' was the least recently seen
+    assert seen.add('b')
+    seen.discard('b')
+    assert seen.add('b')